@@ -0,0 +1,188 @@
+# Stream cohorts in Arrow record batches, so that the memory a worker needs
+# does not grow with the population:
+# (1) batch_plan() keeps one worker per CPU (and input file) and, if the
+#     whole input files of all workers do not fit into the memory limit
+#     (--memory-limit, see parallel.py), sizes batches of rows so that one
+#     batch per worker fits; the size of a row in memory is estimated from
+#     the largest file like parallel.memory_per_file(). If the batches would
+#     be smaller than MIN_BATCH_ROWS, fewer workers are started (down to
+#     one) instead.
+# (2) read_batches() reads a feather file or Parquet partition as tables of
+#     at most that many rows (the whole file if batch_rows is None)
+# (3) SortedReader joins files sorted by patient_id (e.g., the bp_windows
+#     and registration files) onto the batches of a cohort with a merge
+#     join, reading them batch by batch as well
+# (4) BatchWriter appends the processed batches to one feather file
+#
+# Results of streamed and whole files are the same; the steps merge their
+# partial results (e.g., the measure sums of every batch, see
+# generate_measures.py) at the end.
+
+import os
+import pathlib
+import warnings
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.ipc as ipc
+
+from parallel import MEMORY_PER_INPUT_BYTE, available_memory, memory_per_file, worker_count
+
+# Smallest batch, below which the overhead per batch dominates
+MIN_BATCH_ROWS = 10_000
+
+# Rows per record batch in written feather files (as feather.write_feather)
+FEATHER_CHUNK_ROWS = 64 * 1024
+
+
+def file_format(path):
+    return "parquet" if pathlib.Path(path).suffix == ".parquet" else "feather"
+
+
+def count_rows(path):
+    return ds.dataset(str(path), format=file_format(path)).count_rows()
+
+
+def batch_plan(paths, workers=None, memory_limit=None):
+    # (workers, batch rows) of a step that reads every file once. batch rows
+    # is None if the whole files of all workers fit into the memory limit.
+    paths = list(paths)
+    workers = worker_count(len(paths), workers)
+    if memory_limit is None:
+        memory_limit = available_memory()
+    if memory_limit is None or memory_per_file(paths) * workers <= memory_limit:
+        return workers, None
+    row_bytes = max(
+        MEMORY_PER_INPUT_BYTE * pathlib.Path(path).stat().st_size / max(count_rows(path), 1)
+        for path in paths
+    )
+    # Fewer workers rather than batches below MIN_BATCH_ROWS
+    workers = max(1, min(workers, int(memory_limit // (MIN_BATCH_ROWS * row_bytes))))
+    if memory_per_file(paths) * workers <= memory_limit:
+        return workers, None
+    batch_rows = int(memory_limit / workers / row_bytes)
+    if batch_rows < MIN_BATCH_ROWS:
+        warnings.warn(
+            f"A batch of {MIN_BATCH_ROWS} rows needs about {MIN_BATCH_ROWS * row_bytes:.0f} "
+            f"bytes, more than the memory limit of {memory_limit} bytes"
+        )
+        batch_rows = MIN_BATCH_ROWS
+    return workers, batch_rows
+
+
+def read_batches(path, columns=None, batch_rows=None):
+    # Yield the rows of a file as pyarrow Tables of at most batch_rows rows,
+    # at least one (possibly empty) table
+    dataset = ds.dataset(str(path), format=file_format(path))
+    if batch_rows is None:
+        yield dataset.to_table(columns=columns)
+        return
+    # Stored record batches are sliced to at most batch_rows rows and
+    # combined up to batch_rows rows. Only one batch is read ahead.
+    pending = []
+    rows = 0
+    empty = True
+    for batch in dataset.to_batches(
+        columns=columns, batch_size=batch_rows, batch_readahead=1, fragment_readahead=1
+    ):
+        if pending and rows + batch.num_rows > batch_rows:
+            yield pa.Table.from_batches(pending)
+            empty = False
+            pending = []
+            rows = 0
+        if batch.num_rows:
+            pending.append(batch)
+            rows += batch.num_rows
+    if pending:
+        yield pa.Table.from_batches(pending)
+    elif empty:
+        schema = dataset.schema
+        if columns is not None:
+            schema = pa.schema([schema.field(column) for column in columns])
+        yield schema.empty_table()
+
+
+class SortedReader:
+    # Rows of a file sorted by patient_id, read batch by batch for cohort
+    # batches with increasing patient_ids. With batch_rows None the whole
+    # file is read at once and need not be sorted.
+
+    def __init__(self, path, batch_rows=None):
+        self.path = path
+        self.streaming = batch_rows is not None
+        self.batches = read_batches(path, batch_rows=batch_rows)
+        self.buffer = None
+        # Last patient_id read and last patient_id asked for
+        self.last = None
+        self.asked = None
+        self.done = False
+
+    def read(self):
+        table = next(self.batches, None)
+        if table is None:
+            self.done = True
+            return
+        if self.streaming:
+            patient_id = table.column("patient_id").to_numpy()
+            if (np.diff(patient_id) < 0).any() or (
+                len(patient_id) and self.last is not None and patient_id[0] < self.last
+            ):
+                raise ValueError(f"{self.path} is not sorted by patient_id")
+            if len(patient_id):
+                self.last = patient_id[-1]
+        self.buffer = table if self.buffer is None else pa.concat_tables([self.buffer, table])
+
+    def complete(self, last):
+        # Whether the buffer holds all rows up to patient_id last
+        if self.done:
+            return True
+        if self.buffer is None or not self.streaming or self.last is None:
+            return False
+        return self.last > last
+
+    def rows(self, patient_id):
+        # Rows of the patients of a cohort batch (numpy patient_ids); the
+        # batches of a streamed cohort must follow each other in patient_id
+        # order
+        if len(patient_id) == 0:
+            while self.buffer is None and not self.done:
+                self.read()
+            return self.buffer.slice(0, 0)
+        first, last = patient_id.min(), patient_id.max()
+        if self.streaming and self.asked is not None and first <= self.asked:
+            raise ValueError(f"Cohort batches joined to {self.path} are not sorted by patient_id")
+        self.asked = last
+        while not self.complete(last):
+            self.read()
+        ids = self.buffer.column("patient_id").to_numpy()
+        rows = self.buffer.filter(pa.array((ids >= first) & (ids <= last)))
+        if self.streaming:
+            self.buffer = self.buffer.filter(pa.array(ids > last))
+        return rows
+
+
+class BatchWriter:
+    # Append tables to a feather file (written to a temporary file first)
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.tmp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        self.writer = None
+        self.schema = None
+
+    def write(self, table):
+        if self.writer is None:
+            self.schema = table.schema
+            self.writer = ipc.new_file(
+                str(self.tmp_path), self.schema, options=ipc.IpcWriteOptions(compression="lz4")
+            )
+        self.writer.write_table(table.cast(self.schema), max_chunksize=FEATHER_CHUNK_ROWS)
+
+    def close(self):
+        # Returns the paths written
+        if self.writer is None:
+            return []
+        self.writer.close()
+        os.replace(self.tmp_path, self.path)
+        return [self.path]
@@ -0,0 +1,284 @@
+# This script benchmarks the BP002 pipeline stages on dummy data (see
+# dummy_data.py) at several population sizes and writes the results as JSON
+# (output/benchmarks/benchmark_<commit>_<time>.json), so that the run time
+# and memory use of every stage can be compared across commits:
+#
+#   python analysis/benchmark.py --sizes 1000 100000
+#   python analysis/benchmark.py --compare <old>.json <new>.json
+#
+# Every stage runs as its own process, like an action. For each stage the
+# wall clock time, CPU time and peak resident memory (of the largest
+# process, i.e., the stage or one of its workers) are recorded.
+# The stages are:
+#   dummy_data        generate the cohorts (setup, timed for reference)
+#   bp_windows        lookback flags from the latest event dates
+#   rules             local equivalent of the BP002 extraction (rule engine)
+#   join_ethnicity    join ethnicity and write the Parquet dataset
+#   generate_measures all measures, long measures file and sketches
+#   deciles           deciles tables (and charts if matplotlib is installed)
+#   disclosure        suppression and rounding of the long measures file
+#   flowchart         select / reject cascade counts of the BP002 rules
+
+import argparse
+import datetime
+import importlib.util
+import json
+import os
+import pathlib
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+ANALYSIS_DIR = pathlib.Path(__file__).resolve().parent
+ROOT_DIR = ANALYSIS_DIR.parent
+
+DEFAULT_SIZES = [1_000, 100_000, 1_000_000, 10_000_000]
+
+
+def python_stage(script, *args):
+    return [sys.executable, str(ANALYSIS_DIR / script), *args]
+
+
+def stages(size, months, parallel_args):
+    deciles_args = [] if importlib.util.find_spec("matplotlib") else ["--no-charts"]
+    dummy_args = ["--population-size", str(size), "--output-dir", "output"]
+    if months:
+        dummy_args += ["--months", str(months)]
+    return [
+        ("dummy_data", python_stage("dummy_data.py", *dummy_args)),
+        (
+            "bp_windows",
+            python_stage(
+                "bp_windows.py",
+                "--input",
+                "output/input_bp_events.feather",
+                "--output-dir",
+                "output/bp_windows",
+            ),
+        ),
+        (
+            "rules",
+            python_stage(
+                "rule_engine.py",
+                "--input-files",
+                "output/input_bp002_*.feather",
+                "--output-dir",
+                "output/rules",
+                "--bp-windows-dir",
+                "output/bp_windows",
+                "--demographics",
+                *parallel_args,
+            ),
+        ),
+        (
+            "join_ethnicity",
+            python_stage(
+                "join_ethnicity.py",
+                "--lhs",
+                "output/rules/input_bp002_*.feather",
+                "--rhs",
+                "output/input_ethnicity.feather",
+                "--output-dir",
+                "output/joined/bp002",
+                "--output-format",
+                "parquet",
+                *parallel_args,
+            ),
+        ),
+        (
+            "generate_measures",
+            python_stage(
+                "generate_measures.py",
+                "--input-dataset",
+                "output/joined/bp002",
+                "--output-dir",
+                "output/joined",
+                "--long-output",
+                "output/joined/measures_bp002_achievem_long.csv",
+                *parallel_args,
+            ),
+        ),
+        (
+            "deciles",
+            python_stage(
+                "deciles_charts.py",
+                "--input-files",
+                "output/joined/sketch_*_practice_breakdown_rate.json",
+                "--output-dir",
+                "output/joined",
+                *deciles_args,
+            ),
+        ),
+        (
+            "disclosure",
+            python_stage(
+                "disclosure.py",
+                "--input",
+                "output/joined/measures_bp002_achievem_long.csv",
+                "--output",
+                "output/joined/measures/measures_bp002_achievem.csv",
+                "--audit-output",
+                "output/joined/measures/disclosure_audit_bp002_achievem.csv",
+            ),
+        ),
+        (
+            "flowchart",
+            python_stage(
+                "flowchart.py",
+                "--input-dataset",
+                "output/joined/bp002",
+                *parallel_args,
+            ),
+        ),
+    ]
+
+
+def run_stage(command, cwd, log_path):
+    # Run command and return its wall clock time, CPU time and peak memory
+    if shutil.which(command[0]) is None and not os.path.exists(command[0]):
+        return {"status": "skipped", "reason": f"{command[0]} not found"}
+    start = time.perf_counter()
+    with open(log_path, "w") as log:
+        process = subprocess.Popen(command, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    if os.WIFEXITED(status):
+        returncode = os.WEXITSTATUS(status)
+    else:
+        returncode = -os.WTERMSIG(status)
+    # The process has been waited for with os.wait4()
+    process.returncode = returncode
+    return {
+        "status": "ok" if returncode == 0 else "failed",
+        "returncode": returncode,
+        "seconds": round(seconds, 3),
+        "cpu_seconds": round(usage.ru_utime + usage.ru_stime, 3),
+        # ru_maxrss is in KiB on Linux
+        "max_rss_bytes": usage.ru_maxrss * 1024,
+    }
+
+
+def prepare_work_dir(work_dir):
+    if work_dir.exists():
+        shutil.rmtree(work_dir)
+    (work_dir / "output").mkdir(parents=True)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_benchmarks(sizes, work_dir, months=None, parallel_args=(), keep=False):
+    results = {
+        "commit": git_commit(),
+        "started": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "months": months,
+        "sizes": {},
+    }
+    for size in sizes:
+        size_dir = pathlib.Path(work_dir) / str(size)
+        prepare_work_dir(size_dir)
+        results["sizes"][str(size)] = size_results = {}
+        for name, command in stages(size, months, list(parallel_args)):
+            result = run_stage(command, size_dir, size_dir / f"{name}.log")
+            size_results[name] = result
+            print(f"{size:>10} {name:<18} {format_result(result)}", flush=True)
+            if result["status"] == "failed":
+                print(f"See {size_dir / f'{name}.log'}")
+                break
+        if not keep:
+            shutil.rmtree(size_dir / "output")
+    return results
+
+
+def format_result(result):
+    if result["status"] == "skipped":
+        return f"skipped ({result['reason']})"
+    return (
+        f"{result['status']:<7} {result['seconds']:>9.2f}s "
+        f"{result['max_rss_bytes'] / 1024**2:>9.0f} MiB"
+    )
+
+
+def compare(old_path, new_path):
+    # Print the change in time and memory of every stage in both results
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{old['commit']} -> {new['commit']}")
+    for size, size_stages in new["sizes"].items():
+        for name, result in size_stages.items():
+            previous = old["sizes"].get(size, {}).get(name)
+            if not previous or "seconds" not in previous or "seconds" not in result:
+                continue
+            time_ratio = result["seconds"] / max(previous["seconds"], 1e-9)
+            memory_ratio = result["max_rss_bytes"] / max(previous["max_rss_bytes"], 1)
+            print(
+                f"{size:>10} {name:<18} time x{time_ratio:5.2f} "
+                f"({previous['seconds']:.2f}s -> {result['seconds']:.2f}s) "
+                f"memory x{memory_ratio:5.2f}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument(
+        "--months",
+        type=int,
+        default=None,
+        help="Only benchmark the first N index dates (default: all)",
+    )
+    parser.add_argument("--work-dir", default="output/benchmarks/work")
+    parser.add_argument("--output-dir", default="output/benchmarks")
+    parser.add_argument("--workers", default=None, help="Passed to the python stages")
+    parser.add_argument("--memory-limit", default=None, help="Passed to the python stages")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated data")
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("OLD", "NEW"),
+        help="Compare two benchmark results instead of running the benchmarks",
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    parallel_args = []
+    if args.workers:
+        parallel_args += ["--workers", args.workers]
+    if args.memory_limit:
+        parallel_args += ["--memory-limit", args.memory_limit]
+
+    results = run_benchmarks(
+        args.sizes, pathlib.Path(args.work_dir).resolve(), args.months, parallel_args, args.keep
+    )
+
+    output_dir = pathlib.Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    timestamp = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+    path = output_dir / f"benchmark_{results['commit']}_{timestamp}.json"
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+# Measures for blood pressure indicator BP002
+# The measures are defined as dictionaries of `Measure()` arguments. They
+# are calculated by generate_measures.py from the variables evaluated by
+# rule_engine.py, not by the study definition (study_definition_bp002.py).
+# This module must not import cohortextractor.
+
+from config import lookback_years, demographic_breakdowns, demographic_cross_breakdowns
+
+
+def bp002_measures(lookbacks=None):
+    if lookbacks is None:
+        lookbacks = list(lookback_years)
+
+    measures = []
+
+    for lookback in lookbacks:
+        # Create blood pressure achievement measures
+        measures.extend(
+            [
+                dict(
+                    id=f"bp002_{lookback}_achievem_population_rate",
+                    numerator=f"bp002_{lookback}_numerator",
+                    denominator=f"bp002_{lookback}_denominator",
+                    group_by=["population"],
+                    small_number_suppression=True,
+                ),
+                dict(
+                    id=f"bp002_{lookback}_achievem_practice_breakdown_rate",
+                    numerator=f"bp002_{lookback}_numerator",
+                    denominator=f"bp002_{lookback}_denominator",
+                    group_by=["practice"],
+                    small_number_suppression=True,
+                ),
+            ]
+        )
+
+        # NOTE: the exclusion and flowchart counts are calculated by
+        # flowchart.py
+
+        # Create demographic breakdowns for blood pressure indicator BP002 measures
+        for breakdown in demographic_breakdowns:
+            m = dict(
+                id=f"bp002_{lookback}_achievem_{breakdown}_breakdown_rate",
+                numerator=f"bp002_{lookback}_numerator",
+                denominator=f"bp002_{lookback}_denominator",
+                group_by=[breakdown],
+                small_number_suppression=True,
+            )
+            measures.append(m)
+
+        # Create cross breakdowns, e.g., bp002_1y_achievem_age_band_sex_breakdown_rate
+        for breakdowns in demographic_cross_breakdowns:
+            m = dict(
+                id=f"bp002_{lookback}_achievem_{'_'.join(breakdowns)}_breakdown_rate",
+                numerator=f"bp002_{lookback}_numerator",
+                denominator=f"bp002_{lookback}_denominator",
+                group_by=list(breakdowns),
+                small_number_suppression=True,
+            )
+            measures.append(m)
+
+    return measures
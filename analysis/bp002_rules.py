@@ -0,0 +1,124 @@
+# Business rules for blood pressure indicator BP002
+# The rules are written as `patients.satisfying()` expressions and are shared
+# by the variable dictionaries (dict_bp_variables.py) and the python actions.
+# This module must not import cohortextractor.
+
+# Placeholders:
+# - {lookback}: lookback period, e.g. 1y or 5y (see config.lookback_years)
+# - {prefix}: name prefix of lookback specific rules, this is "bp002" if one
+#   lookback is extracted and "bp002_<lookback>" if several lookbacks are
+#   extracted side by side
+bp002_rule_expressions = dict(
+    # Denominator Rule Number 1
+    # Description: Reject patients from the specified population who are
+    # aged less than 45 years old.
+    denominator_r1="""
+        age >= 45
+        """,
+    # Denominator Rule Number 2
+    # NOTE: This is same as Numerator Rule Number 1
+    # Description: Select patients passed to this rule who had their blood
+    # pressure recorded in the lookback period leading up to and including
+    # the payment period end date.
+    denominator_r2="""
+        bp_rec_{lookback}
+        """,
+    # Denominator Rule Number 3
+    # Description: Reject patients passed to this rule chose not to have
+    # their blood pressure recorded in the lookback period leading up to and
+    # including the payment period end date.
+    denominator_r3="""
+        NOT bp_dec_{lookback}
+        """,
+    # Define exclusion variable for denominator rule 3
+    # to be used as numerator in measures
+    excl_denominator_r3="""
+        bp_dec_{lookback}
+        """,
+    # Denominator Rule Number 4
+    # Description: Reject patients passed to this rule who registered with
+    # the GP practice in the 3 month period leading up to and including
+    # the payment period end date.
+    # NOTE: reg_dat_3m selects patients that were registered with one
+    # practice in the last 3 months. Therefore, this variable specifies the
+    # patients that need to be selected for in the denominator.
+    denominator_r4="""
+        reg_dat_3m
+        """,
+    # Define exclusion variable for denominator rule 4
+    # to be used as numerator in measures
+    excl_denominator_r4="""
+        NOT reg_dat_3m
+        """,
+    # Add flowchart counts for each select / reject rule
+    # NOTE: Some of these variables are coded as "select" variables
+    # and not "reject" as specified in the business rules
+    denominator_r1_reject="""
+        bp002_denominator_r1
+        """,
+    denominator_r2_select="""
+        bp002_denominator_r1 AND
+        {prefix}_denominator_r2
+        """,
+    denominator_r3_reject="""
+        bp002_denominator_r1 AND
+        (NOT {prefix}_denominator_r2) AND
+        bp_dec_{lookback}
+        """,
+    denominator_r4_reject="""
+        bp002_denominator_r1 AND
+        (NOT {prefix}_denominator_r2) AND
+        {prefix}_denominator_r3 AND
+        (NOT reg_dat_3m)
+        """,
+    denominator="""
+        bp002_denominator_r1 AND
+            ({prefix}_denominator_r2 OR
+                ({prefix}_denominator_r3 AND
+                 bp002_denominator_r4)
+            )
+        """,
+    # Numerator Rule Number 1
+    # NOTE: This is same as Denominator Rule Number 2
+    # Description: Select patients from the denominator who had their
+    # blood pressure recorded in the lookback period leading up to and
+    # including the payment period end date. Reject the remaining patients.
+    numerator="""
+        {prefix}_denominator AND
+        {prefix}_denominator_r2
+        """,
+)
+
+# Rules that do not depend on the lookback period and are only extracted
+# once if several lookbacks are extracted side by side
+shared_rules = [
+    "denominator_r1",
+    "denominator_r4",
+    "excl_denominator_r4",
+    "denominator_r1_reject",
+]
+
+
+def bp002_rules(lookback, combined=False):
+    # Return {variable name: expression} for one lookback period.
+    # If combined is True, the lookback specific rules are prefixed with
+    # bp002_<lookback> and the shared rules are left out
+    # (see bp002_shared_rules).
+    prefix = f"bp002_{lookback}" if combined else "bp002"
+    rules = {}
+    for rule, expression in bp002_rule_expressions.items():
+        if rule in shared_rules:
+            if combined:
+                continue
+            name = f"bp002_{rule}"
+        else:
+            name = f"{prefix}_{rule}"
+        rules[name] = expression.format(lookback=lookback, prefix=prefix)
+    return rules
+
+
+def bp002_shared_rules():
+    return {
+        f"bp002_{rule}": bp002_rule_expressions[rule].format(prefix="bp002")
+        for rule in shared_rules
+    }
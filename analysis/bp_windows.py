@@ -0,0 +1,208 @@
+# This script derives the BP002 lookback variables (bp_rec_<lookback> and
+# bp_dec_<lookback>) for every index date from a single extraction of the
+# BP_COD and BPDEC_COD events (see study_definition_bp_events.py):
+# (1) load the latest event date per patient and calendar month (every month
+#     from the start of the longest lookback period of the first index date
+#     to the last index month) as a patient x month array. The months do not
+#     overlap, so every event is only read once by the extraction.
+# (2) carry the latest event date forward month by month, so that at every
+#     index month it is the date of the latest event up to the end of the
+#     month
+# (3) flag the lookback periods that contain this date: an event lies in
+#     "first_day_of_month(index_date) - <years> years" to
+#     "last_day_of_month(index_date)" (see dict_bp_variables.py) if the
+#     latest event up to the end of the month is on or after the start
+# (4) write one file per index date with the flags for all lookbacks, sorted
+#     by patient_id (see rule_engine.py --bp-windows-dir)
+
+import argparse
+import datetime
+import pathlib
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+from config import lookback_years
+from tracing import Trace
+from utils import add_months, month_starts, to_date
+
+EVENT_PREFIXES = ["bp_rec", "bp_dec"]
+
+DATE_COLUMN = re.compile(r"^(?P<prefix>\w+)_date_(?P<year>\d{4})_(?P<month>\d{2})$")
+
+
+def lookback_start(index_date, years):
+    # First day of a lookback period of the index date
+    return np.datetime64(add_months(to_date(index_date).replace(day=1), -12 * years), "D")
+
+
+def event_months(index_dates, lookbacks=None):
+    # Months with events in any lookback period of the index dates: from the
+    # start of the longest lookback period of the first index date to the
+    # last index month
+    if lookbacks is None:
+        lookbacks = lookback_years
+    years = max(lookbacks.values())
+    first = add_months(to_date(index_dates[0]).replace(day=1), -12 * years)
+    return month_starts(first, index_dates[-1])
+
+
+def window_index_dates(months, lookbacks=None):
+    # Index dates whose lookback periods lie within the (consecutive)
+    # months, e.g., the months of a refresh (see refresh.py)
+    if lookbacks is None:
+        lookbacks = lookback_years
+    years = max(lookbacks.values())
+    first = np.datetime64(to_date(months[0]), "D")
+    return [month for month in months if lookback_start(month, years) >= first]
+
+
+def extracted_months(columns, prefix=EVENT_PREFIXES[0]):
+    # Months of the <prefix>_date_<YYYY>_<MM> columns
+    months = []
+    for column in columns:
+        match = DATE_COLUMN.match(column)
+        if match and match["prefix"] == prefix:
+            months.append(datetime.date(int(match["year"]), int(match["month"]), 1))
+    return sorted(months)
+
+
+def read_latest_dates(df, prefix, months):
+    # Return the (patients x months) datetime64[D] array of the
+    # <prefix>_date_<YYYY>_<MM> columns extracted by
+    # study_definition_bp_events.py, NaT where there is no event
+    columns = [f"{prefix}_date_{month:%Y_%m}" for month in months]
+    missing = [column for column in columns if column not in df.columns]
+    if missing:
+        raise ValueError(f"Missing latest event dates: {', '.join(missing)}")
+    dates = np.empty((len(df), len(columns)), dtype="datetime64[D]")
+    for position, column in enumerate(columns):
+        dates[:, position] = pd.to_datetime(df[column]).to_numpy().astype("datetime64[D]")
+    return dates
+
+
+def latest_event_dates(patient_id, event_date, patients, months):
+    # Build the same array from event level data (one row per event). Rows
+    # are ordered as `patients`, which must be sorted by patient_id, and
+    # columns as the consecutive `months`; events of other patients or
+    # other months are ignored.
+    patients = np.asarray(patients)
+    patient_id = np.asarray(patient_id)
+    if (np.diff(patients) < 0).any():
+        raise ValueError("patients must be sorted by patient_id")
+    dates = np.full((len(patients), len(months)), np.datetime64("NaT"), dtype="datetime64[D]")
+    if len(patients) == 0 or len(patient_id) == 0:
+        return dates
+
+    days = pd.to_datetime(event_date).to_numpy().astype("datetime64[D]")
+    column = (days.astype("datetime64[M]") - np.datetime64(to_date(months[0]), "M")).astype(
+        np.int64
+    )
+    row = np.minimum(np.searchsorted(patients, patient_id), len(patients) - 1)
+    known = (patients[row] == patient_id) & (column >= 0) & (column < len(months))
+    # NaT is the smallest datetime64 value as an integer
+    np.maximum.at(
+        dates.view(np.int64), (row[known], column[known]), days[known].view(np.int64)
+    )
+    return dates
+
+
+def window_flags(patient_id, latest, months, index_dates=None, lookbacks=None, trace=None):
+    # Yield (index_date, DataFrame) with one column per event prefix and
+    # lookback, e.g. bp_rec_1y, bp_dec_1y, bp_rec_5y and bp_dec_5y, from the
+    # latest event date of every month ({prefix: array}, one column per
+    # month of `months`). index_dates defaults to all index dates whose
+    # lookback periods lie within the months. With a trace (see
+    # tracing.py), the column of every variable and index date is recorded.
+    if lookbacks is None:
+        lookbacks = lookback_years
+    months = [to_date(month) for month in months]
+    if index_dates is None:
+        index_dates = window_index_dates(months, lookbacks)
+    index_dates = {to_date(index_date) for index_date in index_dates}
+    uncovered = sorted(index_dates - set(window_index_dates(months, lookbacks)))
+    if uncovered:
+        raise ValueError(f"The months do not cover the lookback periods of {uncovered[0]}")
+
+    # Latest event up to the end of the current month
+    running = {
+        prefix: np.full(len(patient_id), np.datetime64("NaT"), dtype="datetime64[D]")
+        for prefix in latest
+    }
+    for position, month in enumerate(months):
+        for prefix, dates in latest.items():
+            # NaT is the smallest datetime64 value as an integer
+            month_dates = dates[:, position].astype("datetime64[D]").view(np.int64)
+            running[prefix] = np.maximum(running[prefix].view(np.int64), month_dates).view(
+                "datetime64[D]"
+            )
+        if month not in index_dates:
+            continue
+
+        df = pd.DataFrame({"patient_id": patient_id})
+        for prefix in latest:
+            for lookback, years in lookbacks.items():
+                name = f"{prefix}_{lookback}"
+                start_time = time.perf_counter()
+                # NaT (no event) compares as False
+                df[name] = (running[prefix] >= lookback_start(month, years)).astype(np.int8)
+                if trace is not None:
+                    trace.add(
+                        [str(month), name],
+                        time.perf_counter() - start_time,
+                        rows=len(df),
+                        values=df[name].to_numpy(),
+                    )
+        yield month, df
+
+
+def write_windows(input_path, output_dir, trace=None):
+    # Write input_bp_windows_<date>.feather for every index date whose
+    # lookback periods were extracted in input_path and return the paths
+    # written
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    # Sorted by patient_id, so that rule_engine.py can merge the files in
+    # batches
+    events = pd.read_feather(input_path).sort_values("patient_id", kind="stable")
+    months = extracted_months(events.columns)
+    index_dates = window_index_dates(months) if months else []
+    if not index_dates:
+        raise ValueError(f"No index dates with all latest event dates in {input_path}")
+    # Every month in between, missing columns are an error
+    months = month_starts(months[0], months[-1])
+    latest = {prefix: read_latest_dates(events, prefix, months) for prefix in EVENT_PREFIXES}
+
+    paths = []
+    patient_id = events["patient_id"].to_numpy()
+    for index_date, df in window_flags(patient_id, latest, months, index_dates, trace=trace):
+        # Only keep patients with at least one flag, everyone else is 0
+        flagged = df.drop(columns="patient_id").any(axis=1)
+        path = output_dir / f"input_bp_windows_{index_date}.feather"
+        df[flagged].reset_index(drop=True).to_feather(path)
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="output/input_bp_events.feather")
+    parser.add_argument("--output-dir", default="output/bp_windows")
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="Write the time, rows and cardinality of every variable to logs/ (see tracing.py)",
+    )
+    args = parser.parse_args()
+
+    trace = Trace("bp_windows") if args.trace else None
+    write_windows(args.input, args.output_dir, trace)
+    if trace is not None:
+        trace.write()
+        print(trace.format_summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+# Compiled index of the codelists used by the python actions
+#
+# The codelists defined in codelists_bp.py and codelists_demographic.py are
+# read from their definitions (without importing cohortextractor). Category
+# codelists that only the python actions use are derived from these
+# definitions with another category column (CATEGORY_CODELISTS, e.g.,
+# ethnicity16_codes from ethnicity_codes) and every CSV file is parsed once,
+# also if several codelists use it. Each codelist is compiled into a
+# sorted int64 array of SNOMED CT codes and, for codelists with a category
+# column, an aligned vector of category numbers. The compiled index is
+# cached on disk (output/cache/codelists/<key>/, memory-mapped when loaded)
+# and keyed by a hash of codelists/codelists.json, the definitions and the
+# CSV files, so it is rebuilt when a codelist is updated.
+#
+# Membership tests and category lookups are vectorised (np.searchsorted),
+# e.g., to filter event level data:
+#   codelists = load_codelists()
+#   events = events[codelists["bp_codes"].contains(events["code"])]
+
+import argparse
+import ast
+import json
+import os
+import pathlib
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from utils import content_hash
+
+ANALYSIS_DIR = pathlib.Path(__file__).parent
+ROOT_DIR = ANALYSIS_DIR.parent
+CODELISTS_JSON = ROOT_DIR / "codelists" / "codelists.json"
+CODELIST_DEFINITIONS = [
+    ANALYSIS_DIR / "codelists_bp.py",
+    ANALYSIS_DIR / "codelists_demographic.py",
+]
+
+# {name: (codelist, category column)}
+CATEGORY_CODELISTS = {
+    "ethnicity16_codes": ("ethnicity_codes", "Grouping_16"),
+    "ethnicity6_codes": ("ethnicity_codes", "Grouping_6"),
+}
+
+DEFAULT_CACHE_DIR = "output/cache/codelists"
+
+
+def read_codelist_definitions(paths=CODELIST_DEFINITIONS):
+    # {name: {"path", "column", "category_column"}} of all
+    # `name = codelist_from_csv(path, system=..., column=..., ...)`
+    definitions = {}
+    for path in paths:
+        for node in ast.parse(pathlib.Path(path).read_text()).body:
+            if not (
+                isinstance(node, ast.Assign)
+                and isinstance(node.value, ast.Call)
+                and getattr(node.value.func, "id", None) == "codelist_from_csv"
+            ):
+                continue
+            arguments = {keyword.arg: ast.literal_eval(keyword.value) for keyword in node.value.keywords}
+            if node.value.args:
+                arguments["path"] = ast.literal_eval(node.value.args[0])
+            for target in node.targets:
+                definitions[target.id] = {
+                    "path": arguments["path"],
+                    "column": arguments.get("column", "code"),
+                    "category_column": arguments.get("category_column"),
+                }
+    for name, (codelist, category_column) in CATEGORY_CODELISTS.items():
+        if codelist in definitions:
+            definitions[name] = dict(definitions[codelist], category_column=category_column)
+    return definitions
+
+
+def codelists_hash(definitions=CODELIST_DEFINITIONS, root=ROOT_DIR):
+    # Hash of codelists.json, the definitions and the CSV files they read
+    codelists = read_codelist_definitions(definitions)
+    csv_paths = sorted({codelist["path"] for codelist in codelists.values()})
+    return content_hash(
+        [CODELISTS_JSON] + list(definitions) + [pathlib.Path(root) / path for path in csv_paths],
+        extra=CATEGORY_CODELISTS,
+    )
+
+
+class Codelist:
+    def __init__(self, name, codes, category_numbers=None, categories=None):
+        self.name = name
+        self.codes = codes
+        self.category_numbers = category_numbers
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.codes)
+
+    def positions(self, values):
+        # Position of every value in the codelist, -1 if it is not a member
+        values = np.asarray(values, dtype=np.int64)
+        if len(self.codes) == 0:
+            return np.full(len(values), -1, dtype=np.int64)
+        position = np.minimum(np.searchsorted(self.codes, values), len(self.codes) - 1)
+        return np.where(self.codes[position] == values, position, -1)
+
+    def contains(self, values):
+        return self.positions(values) >= 0
+
+    def categorise(self, values):
+        # Category of every value (None if it is not a member)
+        if self.categories is None:
+            raise ValueError(f"{self.name} has no categories")
+        position = self.positions(values)
+        labels = np.array(list(self.categories) + [None], dtype=object)
+        numbers = np.where(position >= 0, self.category_numbers[np.maximum(position, 0)], -1)
+        return labels[numbers]
+
+
+def compile_codelists(definitions, root=ROOT_DIR):
+    # {name: Codelist}, every CSV file is read once
+    tables = {}
+    compiled = {}
+    for name, definition in definitions.items():
+        if definition["path"] not in tables:
+            tables[definition["path"]] = pd.read_csv(root / definition["path"], dtype=str)
+        df = tables[definition["path"]]
+        codes = df[definition["column"]].astype(np.int64).to_numpy()
+        order = np.argsort(codes, kind="stable")
+        codes = codes[order]
+        if len(codes) and (np.diff(codes) == 0).any():
+            raise ValueError(f"{name} contains duplicate codes")
+        category_numbers = categories = None
+        if definition["category_column"]:
+            numbers, categories = pd.factorize(df[definition["category_column"]], sort=True)
+            category_numbers = numbers[order].astype(np.int32)
+            categories = list(categories)
+        compiled[name] = Codelist(name, codes, category_numbers, categories)
+    return compiled
+
+
+def write_index(codelists, directory):
+    # Write the index to a temporary directory first, so that readers never
+    # see a partially written index
+    directory = pathlib.Path(directory)
+    tmp_dir = directory.with_name(f"{directory.name}.{os.getpid()}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    manifest = {}
+    for name, codelist in codelists.items():
+        np.save(tmp_dir / f"{name}.codes.npy", codelist.codes)
+        if codelist.categories is not None:
+            np.save(tmp_dir / f"{name}.categories.npy", codelist.category_numbers)
+        manifest[name] = {"length": len(codelist), "categories": codelist.categories}
+    with open(tmp_dir / "index.json", "w") as f:
+        json.dump(manifest, f, indent=2)
+    try:
+        os.rename(tmp_dir, directory)
+    except OSError:
+        # Written by another process in the meantime
+        shutil.rmtree(tmp_dir)
+
+
+def read_index(directory):
+    directory = pathlib.Path(directory)
+    with open(directory / "index.json") as f:
+        manifest = json.load(f)
+    codelists = {}
+    for name, entry in manifest.items():
+        codes = np.load(directory / f"{name}.codes.npy", mmap_mode="r")
+        category_numbers = None
+        if entry["categories"] is not None:
+            category_numbers = np.load(directory / f"{name}.categories.npy", mmap_mode="r")
+        codelists[name] = Codelist(name, codes, category_numbers, entry["categories"])
+    return codelists
+
+
+def load_codelists(cache_dir=DEFAULT_CACHE_DIR):
+    # {name: Codelist}, compiled once per version of the codelists
+    directory = pathlib.Path(cache_dir) / codelists_hash()[:16]
+    if not (directory / "index.json").exists():
+        write_index(compile_codelists(read_codelist_definitions()), directory)
+    return read_index(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    args = parser.parse_args()
+
+    for name, codelist in load_codelists(args.cache_dir).items():
+        categories = "" if codelist.categories is None else f", {len(codelist.categories)} categories"
+        print(f"{name}: {len(codelist)} codes{categories}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,11 @@
 from cohortextractor import codelist_from_csv
 
-ethnicity6_codes = codelist_from_csv(
+# All ethnicity codes. The groupings (Grouping_16, Grouping_6) are looked up
+# by code from the same file (see codelist_index.py and ethnicity.py).
+ethnicity_codes = codelist_from_csv(
     "codelists/opensafely-ethnicity-snomed-0removed.csv",
     system="snomed",
     column="snomedcode",
-    category_column="Grouping_6",
-)
-
-ethnicity16_codes = codelist_from_csv(
-    "codelists/opensafely-ethnicity-snomed-0removed.csv",
-    system="snomed",
-    column="snomedcode",
-    category_column="Grouping_16",
 )
 
 learning_disability_codes = codelist_from_csv(
@@ -8,6 +8,16 @@ start_date = "2019-03-01"
 # In QOF also: Payment Period End Date (PPED)
 end_date = "2023-03-31"
 
+# Lookback periods (in years) used to define BP recordings in indicator BP002
+lookback_years = {
+    "1y": 1,
+    "5y": 5,
+}
+
+# Earliest event date needed to evaluate the longest lookback period
+# at the study start date (start_date - 5 years)
+event_start_date = "2014-03-01"
+
 # demographic variables by which code use is broken down
 demographic_breakdowns = [
     "age_band",
@@ -20,6 +30,14 @@ demographic_breakdowns = [
     "ethnicity16",
 ]
 
+# Cross breakdowns (combinations of demographic variables); all breakdowns
+# are aggregated together (see analysis/cube.py)
+demographic_cross_breakdowns = [
+    ["age_band", "sex"],
+    ["age_band", "sex", "region"],
+    ["ethnicity6", "imd_q5"],
+]
+
 bp002_exclusions = [
     "bp002_excl_denominator_r3",
     "bp002_excl_denominator_r4",
@@ -0,0 +1,159 @@
+# Data cube aggregation: sums of several value columns over many groupings
+# (lists of breakdown columns, e.g., ["age_band"], ["age_band", "sex"],
+# ["age_band", "sex", "region"]) of the same rows, without a pass over the
+# rows for every grouping:
+# (1) every breakdown column is factorised once (sorted categories, missing
+#     values get their own code after the categories)
+# (2) the groupings are planned as a lattice: groupings that are contained
+#     in another grouping are derived from it, and the remaining groupings
+#     are merged into a few base groupings as long as the product of their
+#     cardinalities stays below max_cells
+# (3) every base grouping is aggregated from the rows in one pass (one
+#     np.bincount per value column over the cells, sorting the cell numbers
+#     first only if there are more than max_cells)
+# (4) every other grouping is rolled up from the smallest grouping already
+#     computed that contains it, i.e., from the (few) cells of a finer level
+#     instead of the rows
+#
+# Cells with a missing value in one of the grouping's columns are left out
+# of its result (like groupby(dropna=True)), but are kept while rolling up,
+# so coarser levels still count these rows.
+
+import numpy as np
+import pandas as pd
+
+# Largest number of cells (product of the cardinalities) of a merged base
+# grouping
+MAX_CELLS = 1_000_000
+
+
+class Cube:
+    # Sums of the values over the observed cells of one grouping. codes has
+    # one row per column of the grouping, sums one row per value.
+
+    def __init__(self, columns, codes, sums):
+        self.columns = tuple(columns)
+        self.codes = codes
+        self.sums = sums
+
+    def __len__(self):
+        return self.sums.shape[1]
+
+    @classmethod
+    def from_codes(cls, columns, codes, cardinalities, values, max_cells=MAX_CELLS):
+        # Aggregate rows (or the cells of a finer cube): codes and values
+        # have one row per column / value
+        dims = [cardinalities[column] for column in columns]
+        cell = combine(codes, dims)
+        n_cells = cells(columns, cardinalities)
+        if n_cells <= max_cells:
+            # Dense: bincount over all cells, keep the observed ones
+            observed = np.flatnonzero(np.bincount(cell, minlength=n_cells))
+            sums = np.stack(
+                [np.bincount(cell, weights=value, minlength=n_cells)[observed] for value in values]
+            )
+        else:
+            # Sparse: sort the cell numbers
+            observed, cell = np.unique(cell, return_inverse=True)
+            sums = np.stack(
+                [np.bincount(cell, weights=value, minlength=len(observed)) for value in values]
+            )
+        return cls(columns, split_cells(observed, dims), sums)
+
+    def rollup(self, columns, cardinalities, max_cells=MAX_CELLS):
+        # Cube of a grouping contained in this one, in the order of columns
+        positions = [self.columns.index(column) for column in columns]
+        return Cube.from_codes(
+            columns, self.codes[positions], cardinalities, self.sums, max_cells
+        )
+
+
+def combine(codes, cardinalities):
+    # One integer per cell (C order, so cells sort like their codes)
+    if not cardinalities:
+        return np.zeros(codes.shape[1] if codes.ndim == 2 else 0, dtype=np.int64)
+    return np.ravel_multi_index(tuple(codes), tuple(c + 1 for c in cardinalities))
+
+
+def split_cells(cell, cardinalities):
+    # Codes (one row per column) of cell numbers
+    if not cardinalities:
+        return np.zeros((0, len(cell)), dtype=np.int64)
+    return np.stack(np.unravel_index(cell, tuple(c + 1 for c in cardinalities)))
+
+
+def cells(columns, cardinalities):
+    # Upper bound of the number of cells of a grouping
+    return int(np.prod([cardinalities[column] + 1 for column in columns], dtype=np.float64))
+
+
+def plan(groupings, cardinalities, max_cells=MAX_CELLS):
+    # Base groupings aggregated from the rows: the groupings not contained
+    # in another grouping, merged while the merged grouping has at most
+    # max_cells cells
+    groupings = list(dict.fromkeys(tuple(grouping) for grouping in groupings))
+    maximal = [
+        grouping
+        for grouping in groupings
+        if not any(set(grouping) < set(other) for other in groupings)
+    ]
+    bases = []
+    for grouping in sorted(maximal, key=lambda g: cells(g, cardinalities), reverse=True):
+        for i, base in enumerate(bases):
+            merged = base + tuple(column for column in grouping if column not in base)
+            if cells(merged, cardinalities) <= max_cells:
+                bases[i] = merged
+                break
+        else:
+            bases.append(grouping)
+    return bases
+
+
+def aggregate_cube(df, groupings, values, max_cells=MAX_CELLS):
+    # Return {grouping: DataFrame} with the grouping's columns (the observed
+    # combinations without missing values, in sorted order) and the sums of
+    # the values as int64. The empty grouping () is the total.
+    groupings = list(dict.fromkeys(tuple(grouping) for grouping in groupings))
+    columns = sorted({column for grouping in groupings for column in grouping})
+    codes = {}
+    categories = {}
+    cardinalities = {}
+    for column in columns:
+        column_codes, uniques = pd.factorize(df[column], sort=True)
+        # Missing values after the categories
+        codes[column] = np.where(column_codes < 0, len(uniques), column_codes)
+        categories[column] = uniques
+        cardinalities[column] = len(uniques)
+    value_arrays = [df[value].to_numpy().astype(np.float64) for value in values]
+
+    computed = []
+    for base in plan(groupings, cardinalities, max_cells):
+        base_codes = np.array([codes[column] for column in base], dtype=np.int64).reshape(
+            len(base), len(df)
+        )
+        computed.append(Cube.from_codes(base, base_codes, cardinalities, value_arrays, max_cells))
+
+    results = {}
+    # Finer groupings first, so that coarser ones can be rolled up from them
+    for grouping in sorted(groupings, key=len, reverse=True):
+        parents = [cube for cube in computed if set(grouping) <= set(cube.columns)]
+        parent = min(parents, key=len)
+        if parent.columns == grouping:
+            cube = parent
+        else:
+            cube = parent.rollup(grouping, cardinalities, max_cells)
+            computed.append(cube)
+
+        observed = np.ones(len(cube), dtype=bool)
+        for position, column in enumerate(grouping):
+            observed &= cube.codes[position] < cardinalities[column]
+        result = pd.DataFrame(
+            {
+                column: categories[column].take(cube.codes[position][observed])
+                for position, column in enumerate(grouping)
+            }
+        )
+        for value, sums in zip(values, cube.sums):
+            result[value] = sums[observed].astype(np.int64)
+        results[grouping] = result
+    return results
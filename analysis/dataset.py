@@ -0,0 +1,172 @@
+# Read and write cohorts as one Parquet dataset instead of one feather file
+# per index date:
+#
+#   <dataset>/lookback=<lookback>/index_date=<date>/part-0.parquet
+#
+# Every monthly cohort is split by lookback period. Lookback specific
+# variables are renamed without the lookback (e.g., bp002_1y_numerator ->
+# bp002_numerator, bp_rec_1y -> bp_rec, see variable_lookback()), so all
+# partitions share one schema. Text variables (e.g., sex, region,
+# ethnicity) are stored dictionary-encoded and are read as categoricals.
+#
+# Readers select partitions (lookback, index_date) from the directory names
+# and other filters (e.g., on a breakdown) are pushed down to the Parquet
+# row group statistics, so only the data needed is read.
+#
+# A monthly cohort can be written batch by batch (CohortWriter, see
+# batches.py), one row group per batch. Every row group has its own
+# dictionaries, so readers sort the categories again.
+
+import os
+import pathlib
+import re
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from config import lookback_years
+
+PARTITIONING = ds.partitioning(
+    pa.schema([("lookback", pa.string()), ("index_date", pa.string())]), flavor="hive"
+)
+
+LOOKBACK_PATTERN = re.compile(r"^(bp002)_(\d+y)_(.+)$|^(bp_rec|bp_dec)_(\d+y)$")
+
+
+def variable_lookback(name):
+    # (lookback, name without lookback) of a lookback specific variable,
+    # (None, name) otherwise
+    match = LOOKBACK_PATTERN.match(name)
+    if match is None:
+        return None, name
+    if match.group(1):
+        return match.group(2), f"{match.group(1)}_{match.group(3)}"
+    return match.group(5), match.group(4)
+
+
+def split_lookbacks(table, lookbacks=None):
+    # Return {lookback: table} with the shared variables and the variables of
+    # that lookback (renamed without the lookback)
+    if lookbacks is None:
+        lookbacks = list(lookback_years)
+    split = {}
+    for lookback in lookbacks:
+        names = []
+        renamed = []
+        for name in table.column_names:
+            name_lookback, variable = variable_lookback(name)
+            if name_lookback is None or name_lookback == lookback:
+                names.append(name)
+                renamed.append(variable)
+        split[lookback] = table.select(names).rename_columns(renamed)
+    return split
+
+
+def encode_categoricals(table):
+    # Dictionary-encode all text columns. Dictionaries are sorted so that the
+    # categories read by pandas sort like the text values.
+    for i, field in enumerate(table.schema):
+        if pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+            column = table.column(i).combine_chunks()
+            values = pc.unique(column).drop_null()
+            dictionary = pc.take(values, pc.sort_indices(values))
+            indices = pc.index_in(column, value_set=dictionary).cast(pa.int32())
+            table = table.set_column(
+                i, field.name, pa.DictionaryArray.from_arrays(indices, dictionary)
+            )
+    return table
+
+
+def partition_path(dataset_dir, lookback, index_date):
+    return pathlib.Path(dataset_dir) / f"lookback={lookback}" / f"index_date={index_date}"
+
+
+class CohortWriter:
+    # Write (or replace) the partitions of one monthly cohort, from one or
+    # more batches of rows. Every index date is written to its own
+    # directories, so monthly cohorts can be written by parallel workers.
+
+    def __init__(self, dataset_dir, index_date, lookbacks=None):
+        self.dataset_dir = dataset_dir
+        self.index_date = index_date
+        self.lookbacks = lookbacks
+        self.writers = {}
+
+    def write(self, table):
+        if not isinstance(table, pa.Table):
+            table = pa.Table.from_pandas(table, preserve_index=False)
+        for lookback, part in split_lookbacks(table, self.lookbacks).items():
+            part = encode_categoricals(part)
+            if lookback not in self.writers:
+                directory = partition_path(self.dataset_dir, lookback, self.index_date)
+                directory.mkdir(parents=True, exist_ok=True)
+                # Hidden temporary file, ignored by dataset readers
+                tmp_path = directory / ".part-0.parquet.tmp"
+                self.writers[lookback] = (tmp_path, pq.ParquetWriter(tmp_path, part.schema))
+            tmp_path, writer = self.writers[lookback]
+            writer.write_table(part.cast(writer.schema))
+
+    def close(self):
+        paths = []
+        for tmp_path, writer in self.writers.values():
+            writer.close()
+            path = tmp_path.with_name("part-0.parquet")
+            os.replace(tmp_path, path)
+            paths.append(path)
+        return paths
+
+
+def sort_categories(df):
+    # Categories in sorted order (the dictionaries of the row groups of a
+    # cohort written in batches are merged in the order they were read)
+    for name in df.columns:
+        if isinstance(df[name].dtype, pd.CategoricalDtype):
+            categories = df[name].cat.categories
+            if not categories.is_monotonic_increasing:
+                df[name] = df[name].cat.reorder_categories(sorted(categories))
+    return df
+
+
+def partitions(dataset_dir, lookbacks=None, index_dates=None):
+    # Sorted (lookback, index_date, path) of all partitions
+    found = []
+    for path in pathlib.Path(dataset_dir).glob("lookback=*/index_date=*/part-0.parquet"):
+        lookback = path.parent.parent.name.split("=", 1)[1]
+        index_date = path.parent.name.split("=", 1)[1]
+        if lookbacks is not None and lookback not in lookbacks:
+            continue
+        if index_dates is not None and index_date not in index_dates:
+            continue
+        found.append((lookback, index_date, path))
+    return sorted(found)
+
+
+def dataset_filter(lookbacks=None, index_dates=None, filter=None):
+    expression = filter
+    for field, values in [("lookback", lookbacks), ("index_date", index_dates)]:
+        if values is None:
+            continue
+        condition = ds.field(field).isin(list(values))
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def read_dataset(dataset_dir, columns=None, lookbacks=None, index_dates=None, filter=None):
+    # Read the selected columns of the selected partitions as a pandas
+    # DataFrame. lookback and index_date are included as columns. filter is
+    # a pyarrow.dataset expression, e.g., ds.field("region") == "London".
+    dataset = ds.dataset(str(dataset_dir), format="parquet", partitioning=PARTITIONING)
+    if columns is not None:
+        columns = list(dict.fromkeys(["lookback", "index_date"] + list(columns)))
+    table = dataset.to_table(
+        columns=columns, filter=dataset_filter(lookbacks, index_dates, filter)
+    )
+    return sort_categories(table.to_pandas())
+
+
+def read_partition(path, columns=None):
+    # Read one partition file (without the partition columns)
+    return sort_categories(pq.read_table(path, columns=columns).to_pandas())
@@ -0,0 +1,97 @@
+# This script writes deciles tables and charts of practice level measures
+# from the quantile sketches written by generate_measures.py
+# (sketch_<measure id>.json, see quantile_sketch.py) instead of the
+# practice rows of every measure_*_practice_breakdown_rate.csv.
+#
+# Tables and charts have the same names and layout as the deciles-charts
+# reusable action: deciles_table_<measure id>.csv (date, percentile, value)
+# and deciles_chart_<measure id>.png. --start-date and --end-date select a
+# subset of months.
+
+import argparse
+import pathlib
+
+import numpy as np
+import pandas as pd
+
+from quantile_sketch import read_sketches
+from utils import expand_paths
+
+DECILES = list(range(10, 100, 10))
+OUTER_PERCENTILES = list(range(1, 10)) + list(range(91, 100))
+
+
+def measure_id_from_path(path):
+    return pathlib.Path(path).stem[len("sketch_"):]
+
+
+def deciles_table(digests, percentiles, start_date=None, end_date=None):
+    rows = []
+    for date in sorted(digests):
+        if (start_date and date < start_date) or (end_date and date > end_date):
+            continue
+        values = digests[date].quantile(np.array(percentiles) / 100)
+        rows.extend(zip([date] * len(percentiles), percentiles, values))
+    df = pd.DataFrame(rows, columns=["date", "percentile", "value"])
+    df["date"] = pd.to_datetime(df["date"])
+    return df
+
+
+def deciles_chart(df, path, show_outer_percentiles=False):
+    # matplotlib is only needed for the charts
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(15, 7))
+    for percentile, group in df.groupby("percentile"):
+        if percentile == 50:
+            style = dict(color="b", linestyle="-", linewidth=1.5, label="median")
+        elif percentile in DECILES:
+            style = dict(color="b", linestyle="--", linewidth=1)
+        else:
+            style = dict(color="b", linestyle=":", linewidth=0.5)
+        ax.plot(group["date"], group["value"], **style)
+    ax.set_ylabel("value")
+    ax.set_xlabel("date")
+    ax.set_ylim(bottom=0, top=1 if df["value"].max() <= 1 else None)
+    ax.legend()
+    fig.autofmt_xdate()
+    fig.savefig(path, bbox_inches="tight")
+    plt.close(fig)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--input-files",
+        nargs="+",
+        default=["output/joined/sketch_*_practice_breakdown_rate.json"],
+        help="Sketch files or glob patterns",
+    )
+    parser.add_argument("--output-dir", default="output/joined")
+    parser.add_argument("--start-date", default=None)
+    parser.add_argument("--end-date", default=None)
+    parser.add_argument("--show-outer-percentiles", action="store_true")
+    parser.add_argument("--no-charts", action="store_true")
+    args = parser.parse_args()
+
+    percentiles = DECILES
+    if args.show_outer_percentiles:
+        percentiles = sorted(DECILES + OUTER_PERCENTILES)
+
+    output_dir = pathlib.Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for path in expand_paths(args.input_files):
+        measure_id = measure_id_from_path(path)
+        df = deciles_table(read_sketches(path), percentiles, args.start_date, args.end_date)
+        df.to_csv(output_dir / f"deciles_table_{measure_id}.csv", index=False)
+        if not args.no_charts:
+            deciles_chart(
+                df, output_dir / f"deciles_chart_{measure_id}.png", args.show_outer_percentiles
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+# Disclosure control of the measures
+#
+# All statistical disclosure control is applied here, in one vectorised
+# pass over every measure, date and breakdown (a "table" is one group of
+# rows, e.g., one measure and date, or one lookback, date and group of the
+# long measures file):
+# (1) primary suppression: numerators and denominators of rows with a
+#     numerator or denominator of 1 to THRESHOLD are redacted
+# (2) secondary suppression: if the redacted numerators of a table add up
+#     to no more than THRESHOLD, the next smallest numerator is redacted as
+#     well, so that it cannot be back-calculated from the table total
+# (3) rounding: the remaining counts are rounded to the nearest
+#     ROUNDING_BASE (round half to even, like R's round(x, -1))
+# (4) value: numerator / denominator is recalculated from the rounded counts
+#
+# generate_measures.py uses (1), (2) and (4) for the measure files, like
+# `Measure(small_number_suppression=True)`. This script applies (1) to (4)
+# to the long measures file and writes the released measures file
+# (measures_bp002_achievem.csv) and an audit table with the number of
+# suppressed rows of every table and checks of the released counts. It
+# stops with an error if any check fails.
+#
+# It replaces join_measures.R, which rounded the long measures with the
+# helpers of lib/funs.R (the only script that sourced them).
+
+import argparse
+import pathlib
+
+import numpy as np
+import pandas as pd
+
+THRESHOLD = 5
+ROUNDING_BASE = 10
+
+LONG_TABLE = ["lookback", "date", "group"]
+LONG_COUNTS = ["numerator", "denominator", "population"]
+
+
+def table_codes(df, by):
+    # Integer code of the table of every row
+    if not by:
+        return np.zeros(len(df), dtype=np.int64)
+    return df.groupby(by, sort=False, dropna=False).ngroup().to_numpy()
+
+
+def suppress(df, numerator, denominator, by, threshold=THRESHOLD):
+    # Return (df with redacted numerators and denominators as Int64,
+    # primary, secondary) where primary and secondary flag the redacted rows
+    table = table_codes(df, by)
+    num = df[numerator].to_numpy(dtype=np.float64, na_value=np.nan)
+    den = df[denominator].to_numpy(dtype=np.float64, na_value=np.nan)
+    primary = ((num > 0) & (num <= threshold)) | ((den > 0) & (den <= threshold))
+
+    n_tables = table.max() + 1 if len(table) else 0
+    redacted = np.bincount(table, weights=np.where(primary, num, 0), minlength=n_tables)
+    needs_secondary = (redacted > 0) & (redacted <= threshold)
+    candidate = ~primary & (num > 0) & needs_secondary[table]
+    # Smallest candidate numerator of every table (the first row on ties)
+    rows = np.flatnonzero(candidate)
+    rows = rows[np.lexsort((rows, num[rows], table[rows]))]
+    _, first = np.unique(table[rows], return_index=True)
+    secondary = np.zeros(len(df), dtype=bool)
+    secondary[rows[first]] = True
+
+    redact = primary | secondary
+    df = df.copy()
+    df[numerator] = df[numerator].astype("Int64").mask(redact)
+    df[denominator] = df[denominator].astype("Int64").mask(redact)
+    return df, primary, secondary
+
+
+def round_counts(values, base=ROUNDING_BASE):
+    # Round to the nearest base, halves to even
+    values = pd.Series(values).astype("Float64")
+    return ((values / base).round() * base).astype("Int64")
+
+
+def calculate_value(df, numerator, denominator):
+    value = df[numerator].astype("Float64") / df[denominator].astype("Float64")
+    return value.mask(df[denominator] == 0)
+
+
+def disclosure_control(
+    df, numerator, denominator, by, counts=None, threshold=THRESHOLD, base=ROUNDING_BASE
+):
+    # Return (released df, audit df). counts are the columns to round
+    # (default: numerator and denominator).
+    if counts is None:
+        counts = [numerator, denominator]
+    num = df[numerator].to_numpy(dtype=np.float64, na_value=np.nan)
+    df, primary, secondary = suppress(df, numerator, denominator, by, threshold)
+    # Numerators and denominators of 1 to threshold left before rounding
+    small = np.zeros(len(df), dtype=bool)
+    for column in [numerator, denominator]:
+        values = df[column].to_numpy(dtype=np.float64, na_value=np.nan)
+        small |= (values > 0) & (values <= threshold)
+    unrounded = np.zeros(len(df), dtype=bool)
+    for column in counts:
+        df[column] = round_counts(df[column], base)
+        values = df[column].to_numpy(dtype=np.float64, na_value=np.nan)
+        unrounded |= ~np.isnan(values) & (values % base != 0)
+    df["value"] = calculate_value(df, numerator, denominator)
+
+    # Audit: rows and suppressed rows of every table, and checks
+    # - check_small: no numerator or denominator of 1 to threshold is
+    #   released (before rounding)
+    # - check_rounded: all released counts are multiples of base
+    # - check_secondary: the redacted numerators add up to 0 or more than
+    #   threshold (or no numerator is left to redact)
+    table = table_codes(df, by)
+    n_tables = table.max() + 1 if len(table) else 0
+    redacted = primary | secondary
+    redacted_total = np.bincount(table, weights=np.where(redacted, num, 0), minlength=n_tables)
+    left = np.bincount(table, weights=~redacted & (num > 0), minlength=n_tables)
+
+    def per_table(flags):
+        return np.bincount(table, weights=flags, minlength=n_tables).astype(np.int64)
+
+    audit = df.assign(_table=table).drop_duplicates("_table").sort_values("_table")
+    audit = audit[by].reset_index(drop=True)
+    audit["rows"] = per_table(np.ones(len(df)))
+    audit["primary_suppressed"] = per_table(primary)
+    audit["secondary_suppressed"] = per_table(secondary)
+    audit["check_small"] = per_table(small) == 0
+    audit["check_rounded"] = per_table(unrounded) == 0
+    audit["check_secondary"] = (redacted_total == 0) | (redacted_total > threshold) | (left == 0)
+    return df, audit
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="output/joined/measures_bp002_achievem_long.csv")
+    parser.add_argument("--output", default="output/joined/measures/measures_bp002_achievem.csv")
+    parser.add_argument(
+        "--audit-output", default="output/joined/measures/disclosure_audit_bp002_achievem.csv"
+    )
+    parser.add_argument("--prefix", default="bp002", help="Prefix of the released count columns")
+    parser.add_argument("--threshold", type=int, default=THRESHOLD)
+    parser.add_argument("--rounding-base", type=int, default=ROUNDING_BASE)
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.input, dtype={"lookback": str, "date": str, "group": str, "category": str})
+    released, audit = disclosure_control(
+        df,
+        "numerator",
+        "denominator",
+        LONG_TABLE,
+        LONG_COUNTS,
+        args.threshold,
+        args.rounding_base,
+    )
+    released = released.rename(
+        columns={
+            "numerator": f"{args.prefix}_numerator",
+            "denominator": f"{args.prefix}_denominator",
+        }
+    )[
+        [
+            f"{args.prefix}_numerator",
+            f"{args.prefix}_denominator",
+            "population",
+            "value",
+            "date",
+            "group",
+            "category",
+            "lookback",
+        ]
+    ]
+
+    for path, table in [(args.output, released), (args.audit_output, audit)]:
+        path = pathlib.Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        table.to_csv(path, index=False, na_rep="NA")
+
+    checks = [column for column in audit.columns if column.startswith("check_")]
+    failed = audit[~audit[checks].all(axis=1)]
+    if len(failed):
+        print(failed.to_string(index=False))
+        raise SystemExit(f"{len(failed)} tables fail the disclosure checks")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,489 @@
+# This script generates dummy data at any population size (e.g., tens of
+# millions of patients) to load test the python actions before a real run.
+# cohortextractor's dummy data is generated patient by patient and the
+# project only expects a population of 1000.
+#
+# The data follows the return_expectations of the study definitions and
+# variable dictionaries (read without importing cohortextractor) and is
+# generated with numpy, chunk by chunk (--chunk-size patients at a time):
+# (1) patients: sex, region, practice, imd, ethnicity, care home and learning
+#     disability flags follow the category ratios and incidences, age follows
+#     the "population_ages" distribution and deaths are dated between the
+#     study start and end date
+# (2) events: BP_COD and BPDEC_COD events (patient_id, code, date) with codes
+#     from the codelists. A share of patients equal to the incidence of
+#     bp_rec_<lookback> (bp_dec_<lookback>) has events, on average one every
+#     --event-interval-months months between event_start_date and end_date.
+#     The records behind the other clinical event variables are added to the
+#     same file (see generate_record_events), so that the study definitions
+#     can be run locally against it (see event_store.py and local_backend.py).
+# (3) the cohorts read by the python actions, in the same layout as the
+#     extractions: input_ethnicity.feather, input_bp_events.feather and
+#     input_bp002_<date>.feather. The latest event dates are derived from
+#     the events (see bp_windows.py) and the categorical and shared BP002
+#     rule variables are evaluated with rule_engine.py, so the cohorts are
+#     consistent.
+#
+# Registration (gms_reg_status, reg_dat_3m) has no date model in the study
+# definitions and is drawn per index date from its incidence. Registration
+# spells (input_registration_spells.feather, see registration.py) are
+# written separately: every patient has a current spell at their practice,
+# some after a previous spell at another practice, ending when they die or
+# deregister.
+
+import argparse
+import ast
+import pathlib
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc as ipc
+
+from bp_windows import event_months, latest_event_dates, window_flags
+from codelist_index import load_codelists
+from config import end_date, event_start_date, lookback_years, start_date
+from rule_engine import bp002_engine_rules, compile_rules, read_variable_expressions
+from utils import add_months, month_starts, to_date
+
+ANALYSIS_DIR = pathlib.Path(__file__).parent
+
+# Share of the population per 10 year age band (0-9, ..., 100-109), used for
+# {"int": {"distribution": "population_ages"}}
+POPULATION_AGES = [0.12, 0.115, 0.13, 0.135, 0.125, 0.135, 0.11, 0.085, 0.04, 0.0095, 0.0005]
+
+# Codelists of the event prefixes (see codelist_index.py)
+EVENT_CODELISTS = {
+    "bp_rec": "bp_codes",
+    "bp_dec": "bp_dec_codes",
+}
+
+# Codelists of the patient level flags, and the earliest date of their
+# records (see generate_record_events)
+RECORD_CODELISTS = {
+    "learning_disability": "learning_disability_codes",
+    "care_home": "nhse_care_homes_codes",
+}
+RECORD_START_DATE = "1990-01-01"
+
+# Name prefixes of the lookback specific rules, e.g., bp002_1y_numerator
+LOOKBACK_PREFIXES = tuple(f"bp002_{lookback}_" for lookback in lookback_years)
+
+
+def literal(node):
+    # Evaluate a literal that may refer to the dates in config.py (e.g.,
+    # {"date": {"earliest": start_date, "latest": end_date}})
+    names = {"start_date": start_date, "end_date": end_date, "event_start_date": event_start_date}
+    return ast.literal_eval(ReplaceNames(names).visit(node))
+
+
+class ReplaceNames(ast.NodeTransformer):
+    def __init__(self, names):
+        self.names = names
+
+    def visit_Name(self, node):
+        if node.id in self.names:
+            return ast.copy_location(ast.Constant(self.names[node.id]), node)
+        return node
+
+
+def read_expectations(path):
+    # Return ({variable name: return_expectations}, default_expectations) of
+    # a study definition or variable dictionary
+    tree = ast.parse(pathlib.Path(path).read_text())
+    expectations = {}
+    defaults = {}
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        for keyword in node.keywords:
+            if keyword.arg == "default_expectations":
+                defaults = literal(keyword.value)
+            if not isinstance(keyword.value, ast.Call):
+                continue
+            for argument in keyword.value.keywords:
+                if argument.arg == "return_expectations":
+                    expectations[keyword.arg] = literal(argument.value)
+    return expectations, defaults
+
+
+def study_expectations():
+    # Expectations of all variables used by the BP002 cohorts
+    expectations, defaults = read_expectations(ANALYSIS_DIR / "study_definition_bp002.py")
+    for name in ["dict_demographic_variables.py", "dict_bp_variables.py", "study_definition_ethnicity.py"]:
+        expectations.update(read_expectations(ANALYSIS_DIR / name)[0])
+    # bp_rec_<lookback> is defined with a computed name in dict_bp_variables.py
+    # ({"incidence": 0.5}), bp_dec_<lookback> uses the default expectations
+    expectations.setdefault("bp_rec", {"incidence": 0.5})
+    expectations.setdefault("bp_dec", {"incidence": defaults.get("incidence", 0.5)})
+    return expectations, defaults
+
+
+def incidence(expectations, name, defaults=None):
+    value = expectations.get(name, {}).get("incidence")
+    if value is None:
+        value = (defaults or {}).get("incidence", 1.0)
+    return value
+
+
+def categories(rng, size, expectation):
+    ratios = expectation["category"]["ratios"]
+    p = np.array(list(ratios.values()), dtype=np.float64)
+    # Categorical, so that the values are not copied for every index date
+    return pd.Categorical.from_codes(rng.choice(len(ratios), size, p=p / p.sum()), list(ratios))
+
+
+def flags(rng, size, rate):
+    return (rng.random(size) < rate).astype(np.int64)
+
+
+def dates_between(rng, size, earliest, latest):
+    earliest = np.datetime64(to_date(earliest), "D")
+    latest = np.datetime64(to_date(latest), "D")
+    days = rng.integers(0, (latest - earliest).astype(np.int64) + 1, size)
+    return earliest + days.astype("timedelta64[D]")
+
+
+def generate_patients(rng, patient_id, expectations, practices=None):
+    size = len(patient_id)
+    df = pd.DataFrame({"patient_id": patient_id})
+
+    # Date of birth from the "population_ages" distribution at the study end
+    band = rng.choice(len(POPULATION_AGES), size, p=np.array(POPULATION_AGES) / sum(POPULATION_AGES))
+    age_days = (band * 10 + rng.random(size) * 10) * 365.25
+    df["date_of_birth"] = np.datetime64(to_date(end_date), "D") - age_days.astype("timedelta64[D]")
+
+    df["sex"] = categories(rng, size, expectations["sex"])
+    df["region"] = categories(rng, size, expectations["region"])
+
+    practice = expectations["practice"]
+    if practices:
+        df["practice"] = rng.integers(1, practices + 1, size)
+    else:
+        values = rng.normal(practice["int"]["mean"], practice["int"]["stddev"], size)
+        df["practice"] = np.maximum(np.round(values), 1).astype(np.int64)
+    df.loc[rng.random(size) >= practice.get("incidence", 1), "practice"] = 0
+
+    # IMD rank rounded to 100 (0 to 32844), missing for the share given by
+    # the "Unknown" ratio of imd_q5
+    imd = np.round(rng.integers(0, 32845, size) / 100) * 100
+    unknown = expectations["imd_q5"]["category"]["ratios"].get("Unknown", 0)
+    df["imd"] = np.where(rng.random(size) < unknown, np.nan, imd)
+
+    for name in ["learning_disability", "care_home"]:
+        df[name] = flags(rng, size, incidence(expectations, name))
+
+    # Death dates between the study start and end date
+    died = rng.random(size) < incidence(expectations, "died")
+    df["died_on"] = pd.NaT
+    df.loc[died, "died_on"] = dates_between(rng, died.sum(), start_date, end_date)
+
+    # Latest ethnicity code (missing for patients without a code), recorded
+    # between event_start_date and end_date
+    code = categories(rng, size, expectations["ethnicity_code"])
+    has_code = rng.random(size) < incidence(expectations, "ethnicity_code")
+    df["ethnicity_code"] = pd.Series(code).where(has_code).to_numpy()
+    df["ethnicity_code_date"] = pd.Series(
+        dates_between(rng, size, event_start_date, end_date)
+    ).where(has_code)
+    return df
+
+
+def generate_events(rng, patient_id, expectations, codelists, interval_months):
+    # Event level BP_COD and BPDEC_COD data (patient_id, code, date)
+    start = to_date(event_start_date)
+    months = len(month_starts(start, end_date))
+    events = []
+    for prefix, codelist in EVENT_CODELISTS.items():
+        codes = codelists[codelist].codes
+        with_events = patient_id[rng.random(len(patient_id)) < incidence(expectations, prefix)]
+        counts = rng.poisson(months / interval_months, len(with_events))
+        # At least one event for every patient with events
+        counts = np.maximum(counts, 1)
+        n = counts.sum()
+        events.append(
+            pd.DataFrame(
+                {
+                    "patient_id": np.repeat(with_events, counts),
+                    "code": codes[rng.integers(0, len(codes), n)],
+                    "date": dates_between(rng, n, start, end_date),
+                    "prefix": prefix,
+                }
+            )
+        )
+    return pd.concat(events, ignore_index=True)
+
+
+def generate_record_events(rng, patients, codelists):
+    # Events behind the patient level flags and codes: the ethnicity code on
+    # its date, and a learning disability (care home) code before the study
+    # start date for every patient with the flag, so that the flag holds at
+    # every index date
+    events = []
+    has_code = patients["ethnicity_code"].notna().to_numpy()
+    events.append(
+        pd.DataFrame(
+            {
+                "patient_id": patients["patient_id"].to_numpy()[has_code],
+                "code": patients["ethnicity_code"][has_code].astype(np.int64).to_numpy(),
+                "date": patients["ethnicity_code_date"][has_code].to_numpy().astype("datetime64[D]"),
+            }
+        )
+    )
+    last_day = np.datetime64(to_date(start_date), "D") - np.timedelta64(1, "D")
+    for name, codelist in RECORD_CODELISTS.items():
+        flagged = (patients[name] == 1).to_numpy()
+        codes = codelists[codelist].codes
+        n = flagged.sum()
+        date = dates_between(rng, n, RECORD_START_DATE, last_day)
+        # Not before the date of birth
+        date_of_birth = patients["date_of_birth"].to_numpy()[flagged].astype("datetime64[D]")
+        events.append(
+            pd.DataFrame(
+                {
+                    "patient_id": patients["patient_id"].to_numpy()[flagged],
+                    "code": codes[rng.integers(0, len(codes), n)],
+                    "date": np.maximum(date, date_of_birth),
+                }
+            )
+        )
+    return pd.concat(events, ignore_index=True)
+
+
+def generate_registrations(rng, patients, expectations):
+    # Registration spells (patient_id, start_date, end_date, practice, region)
+    size = len(patients)
+    start = dates_between(rng, size, add_months(event_start_date, -60), end_date)
+    # Spells end on the date of death or deregistration, whichever is first
+    end = patients["died_on"].to_numpy().astype("datetime64[D]")
+    deregistered = rng.random(size) >= incidence(expectations, "gms_reg_status")
+    deregistration = dates_between(rng, size, start_date, end_date)
+    end = np.where(deregistered & (np.isnat(end) | (deregistration < end)), deregistration, end)
+    end = np.where(end < start, start, end)
+    current = pd.DataFrame(
+        {
+            "patient_id": patients["patient_id"].to_numpy(),
+            "start_date": start,
+            "end_date": end,
+            "practice": patients["practice"].to_numpy(),
+            "region": patients["region"].to_numpy(),
+        }
+    )
+    # Previous spells at another practice, up to the day before the current one
+    moved = rng.random(size) < 0.1
+    previous = current[moved].copy()
+    previous["end_date"] = start[moved] - np.timedelta64(1, "D")
+    previous["start_date"] = previous["end_date"].to_numpy() - rng.integers(
+        30, 3650, moved.sum()
+    ).astype("timedelta64[D]")
+    previous["practice"] = previous["practice"] + 1
+    return pd.concat([previous, current], ignore_index=True).sort_values(
+        ["patient_id", "start_date"], kind="stable", ignore_index=True
+    )
+
+
+def birth_dates(date_of_birth):
+    # (year, month * 100 + day) of every date of birth
+    dob = pd.DatetimeIndex(date_of_birth)
+    return dob.year.to_numpy(), dob.month.to_numpy() * 100 + dob.day.to_numpy()
+
+
+def age_at(birth, date):
+    # Age in whole years on date (as patients.age_as_of)
+    date = pd.Timestamp(date)
+    year, month_day = birth
+    return (date.year - year - (month_day > date.month * 100 + date.day)).astype(np.int64)
+
+
+def bp_events_cohort(patient_id, events, latest, months):
+    # Latest event dates per month of patients with any event
+    # (study_definition_bp_events.py)
+    any_event = np.isin(patient_id, events["patient_id"].to_numpy())
+    columns = {"patient_id": patient_id[any_event]}
+    for prefix, dates in latest.items():
+        for position, month in enumerate(months):
+            columns[f"{prefix}_date_{month:%Y_%m}"] = dates[any_event, position]
+    return pd.DataFrame(columns)
+
+
+def bp002_cohort(rng, patients, birth, windows, index_date, expectations, plan):
+    index_date = to_date(index_date)
+    size = len(patients)
+    month_end = pd.Timestamp(index_date) + pd.offsets.MonthEnd(0)
+    df = pd.DataFrame({"patient_id": patients["patient_id"]})
+    df["gms_reg_status"] = flags(rng, size, incidence(expectations, "gms_reg_status"))
+    df["died"] = (patients["died_on"] <= month_end).astype(np.int64).to_numpy()
+    df["age"] = age_at(birth, month_end + pd.Timedelta(days=1))
+    for name in ["sex", "imd", "region", "practice", "learning_disability", "care_home"]:
+        df[name] = patients[name].to_numpy()
+    df["reg_dat_3m"] = flags(rng, size, incidence(expectations, "reg_dat_3m"))
+    for name in windows.columns:
+        if name != "patient_id":
+            df[name] = windows[name].to_numpy().astype(np.int64)
+
+    evaluated = plan.run(df)
+    for name in evaluated.columns:
+        df[name] = evaluated[name]
+
+    population = (
+        (df["died"] == 0)
+        & df["sex"].isin(["F", "M"])
+        & (df["age_band"] != "missing")
+        & (df["gms_reg_status"] == 1)
+        & (df["age"] >= 45)
+    )
+    # The lookback flags and lookback specific rules are not extracted (see
+    # study_definition_bp002.py), rule_engine.py evaluates them
+    lookback_columns = [name for name in windows.columns if name != "patient_id"]
+    lookback_columns += [
+        name for name in evaluated.columns if name.startswith(LOOKBACK_PREFIXES)
+    ]
+    return df[population.to_numpy()].drop(columns=lookback_columns).reset_index(drop=True)
+
+
+class ChunkWriter:
+    # Append DataFrames (one per chunk) to an Arrow IPC (feather) file
+
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+        self.schema = None
+
+    def write(self, df):
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            self.schema = table.schema
+            self.writer = ipc.new_file(str(self.path), self.schema)
+        self.writer.write_table(table.cast(self.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def generate(
+    output_dir,
+    population_size,
+    chunk_size=1_000_000,
+    seed=0,
+    practices=None,
+    interval_months=6,
+    index_dates=None,
+):
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if index_dates is None:
+        index_dates = month_starts(start_date, end_date)
+    expectations, _ = study_expectations()
+    codelists = load_codelists()
+    # Months of the latest event dates of all index dates of the study
+    study_index_dates = month_starts(start_date, end_date)
+    months = event_months(study_index_dates)
+
+    rules = bp002_engine_rules()
+    demographic_path = ANALYSIS_DIR / "dict_demographic_variables.py"
+    rules.update(
+        {
+            name: expression
+            for name, expression in read_variable_expressions(demographic_path).items()
+            if isinstance(expression, dict)
+        }
+    )
+    bp002_plan = compile_rules(rules)
+
+    writers = {
+        "patients": ChunkWriter(output_dir / "dummy_patients.feather"),
+        "events": ChunkWriter(output_dir / "dummy_events.feather"),
+        "ethnicity": ChunkWriter(output_dir / "input_ethnicity.feather"),
+        "bp_events": ChunkWriter(output_dir / "input_bp_events.feather"),
+        "registrations": ChunkWriter(output_dir / "input_registration_spells.feather"),
+    }
+    for index_date in index_dates:
+        writers[index_date] = ChunkWriter(output_dir / f"input_bp002_{index_date}.feather")
+
+    try:
+        for chunk, first in enumerate(range(0, population_size, chunk_size)):
+            rng = np.random.default_rng([seed, chunk])
+            patient_id = np.arange(first + 1, min(first + chunk_size, population_size) + 1)
+            patients = generate_patients(rng, patient_id, expectations, practices)
+            events = generate_events(rng, patient_id, expectations, codelists, interval_months)
+            # The record events and registrations have their own random
+            # streams, so that the other outputs do not change
+
+            writers["patients"].write(patients)
+            record_events = generate_record_events(
+                np.random.default_rng([seed, chunk, 2]), patients, codelists
+            )
+            writers["events"].write(
+                pd.concat([events.drop(columns="prefix"), record_events], ignore_index=True)
+            )
+            writers["ethnicity"].write(patients[["patient_id", "ethnicity_code", "ethnicity_code_date"]])
+            writers["registrations"].write(
+                generate_registrations(
+                    np.random.default_rng([seed, chunk, 1]), patients, expectations
+                )
+            )
+
+            latest = {}
+            for prefix in EVENT_CODELISTS:
+                selected = events[events["prefix"] == prefix]
+                latest[prefix] = latest_event_dates(
+                    selected["patient_id"].to_numpy(), selected["date"], patient_id, months
+                )
+            writers["bp_events"].write(bp_events_cohort(patient_id, events, latest, months))
+
+            birth = birth_dates(patients["date_of_birth"])
+            # The latest event dates cover all index dates of the study
+            windows = window_flags(patient_id, latest, months, study_index_dates, lookback_years)
+            for index_date, flags_df in windows:
+                if index_date not in writers:
+                    continue
+                writers[index_date].write(
+                    bp002_cohort(
+                        rng, patients, birth, flags_df, index_date, expectations, bp002_plan
+                    )
+                )
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--population-size", type=int, default=1000)
+    parser.add_argument("--chunk-size", type=int, default=1_000_000)
+    parser.add_argument("--output-dir", default="output/dummy")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--practices",
+        type=int,
+        default=None,
+        help="Number of practices (default: the practice return_expectations)",
+    )
+    parser.add_argument(
+        "--event-interval-months",
+        type=float,
+        default=6,
+        help="Average time between events of patients with events",
+    )
+    parser.add_argument(
+        "--months",
+        type=int,
+        default=None,
+        help="Only write the cohorts of the first N index dates (default: all)",
+    )
+    args = parser.parse_args()
+
+    generate(
+        args.output_dir,
+        args.population_size,
+        args.chunk_size,
+        args.seed,
+        args.practices,
+        args.event_interval_months,
+        month_starts(start_date, end_date)[: args.months],
+    )
+
+
+if __name__ == "__main__":
+    main()
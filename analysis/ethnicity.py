@@ -0,0 +1,77 @@
+# Ethnicity groupings and labels
+#
+# study_definition_ethnicity.py extracts the latest ethnicity code of every
+# patient (ethnicity_code) once. Both groupings of the ethnicity codelist
+# (eth16: Grouping_16, eth6: Grouping_6) are looked up for all patients at
+# once in the compiled codelist index (see codelist_index.py) and mapped to
+# their labels (ethnicity16, ethnicity6). Patients without an ethnicity code
+# are "Unknown".
+
+import numpy as np
+import pandas as pd
+
+from codelist_index import load_codelists
+
+ETHNICITY16_LABELS = {
+    "1": "White - British",
+    "2": "White - Irish",
+    "3": "White - Any other White background",
+    "4": "Mixed - White and Black Caribbean",
+    "5": "Mixed - White and Black African",
+    "6": "Mixed - White and Asian",
+    "7": "Mixed - Any other mixed background",
+    "8": "Asian or Asian British - Indian",
+    "9": "Asian or Asian British - Pakistani",
+    "10": "Asian or Asian British - Bangladeshi",
+    "11": "Asian or Asian British - Any other Asian background",
+    "12": "Black or Black British - Caribbean",
+    "13": "Black or Black British - African",
+    "14": "Black or Black British - Any other Black background",
+    "15": "Other Ethnic Groups - Chinese",
+    "16": "Other Ethnic Groups - Any other ethnic group",
+}
+
+ETHNICITY6_LABELS = {
+    "1": "White",
+    "2": "Mixed",
+    "3": "Asian or Asian British",
+    "4": "Black or Black British",
+    "5": "Chinese or Other Ethnic Groups",
+}
+
+UNKNOWN = "Unknown"
+
+# Derived columns: (grouping, label, codelist, labels)
+ETHNICITY_GROUPINGS = [
+    ("eth16", "ethnicity16", "ethnicity16_codes", ETHNICITY16_LABELS),
+    ("eth6", "ethnicity6", "ethnicity6_codes", ETHNICITY6_LABELS),
+]
+
+
+def ethnicity_codes(values):
+    # Extracted codes as int64 (missing or empty codes are -1)
+    codes = pd.to_numeric(pd.Series(values), errors="coerce")
+    return codes.fillna(-1).to_numpy().astype(np.int64)
+
+
+def ethnicity_groupings(values, codelists=None):
+    # DataFrame with eth16, ethnicity16, eth6 and ethnicity6 of every code
+    if codelists is None:
+        codelists = load_codelists()
+    codes = ethnicity_codes(values)
+    df = pd.DataFrame(index=range(len(codes)))
+    for grouping, label, codelist, labels in ETHNICITY_GROUPINGS:
+        groups = codelists[codelist].categorise(codes)
+        df[grouping] = groups
+        df[label] = pd.Series(groups).map(labels).fillna(UNKNOWN).to_numpy()
+    return df
+
+
+def add_ethnicity_groupings(df, code_column="ethnicity_code", codelists=None):
+    # Add (or replace) the groupings and labels of an extracted ethnicity
+    # cohort
+    groupings = ethnicity_groupings(df[code_column].to_numpy(), codelists)
+    df = df.drop(columns=[c for c in groupings.columns if c in df.columns])
+    for name in groupings.columns:
+        df[name] = groupings[name].to_numpy()
+    return df
@@ -0,0 +1,203 @@
+# Incremental ethnicity state
+#
+# The latest ethnicity code of every patient changes only for patients with
+# a new ethnicity record, so instead of extracting the latest code over all
+# history on every run, the latest code and its date are kept per patient
+# in a persisted state (output/cache/ethnicity/state.feather) together with
+# a high-water mark (state.json: the date up to which events have been
+# folded in, config.end_date by default). A rerun then only needs the
+# events since the watermark:
+#
+#   since=$(python analysis/ethnicity_state.py since)
+#   cohortextractor generate_cohort --study-definition study_definition_ethnicity \
+#     --param since=$since --param until=$until \
+#     --output-dir output/ethnicity_update --output-format feather
+#   python analysis/ethnicity_state.py update --extracted-until $until \
+#     --input output/ethnicity_update/input_ethnicity.feather
+#   python analysis/ethnicity_state.py export --output output/input_ethnicity.feather
+#
+# The extraction is bounded by the new watermark (--param until, which
+# defaults to config.end_date like --extracted-until), so every folded event
+# is dated on or before the watermark; update fails for later events.
+# The extraction since the watermark returns the latest code (and its date)
+# of every patient with an ethnicity record in that period. Those codes are
+# later than any code in the state, so they replace it; patients without a
+# new record keep their code.
+#
+# The state is only valid for the ethnicity codelist (and study definition)
+# it was built with. `since` prints "full" if there is no state or the hash
+# of the codelist has changed; the full history then has to be extracted
+# (without --param since) and folded in with `update --full`, which
+# rebuilds the state.
+#
+# Note that events are folded in by event date: an event entered after a
+# run but dated before its watermark is only picked up by a full rebuild.
+
+import argparse
+import json
+import os
+import pathlib
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from codelist_index import ANALYSIS_DIR, ROOT_DIR, read_codelist_definitions
+from config import end_date
+from utils import content_hash, to_date
+
+DEFAULT_STATE_DIR = "output/cache/ethnicity"
+CODE_COLUMN = "ethnicity_code"
+DATE_COLUMN = "ethnicity_code_date"
+CODELIST = "ethnicity_codes"
+
+
+def state_hash():
+    # Hash of the ethnicity codelist and the study definition that extracts
+    # the latest code
+    definition = read_codelist_definitions()[CODELIST]
+    return content_hash(
+        [ROOT_DIR / definition["path"], ANALYSIS_DIR / "study_definition_ethnicity.py"],
+        extra=json.dumps(definition, sort_keys=True),
+    )
+
+
+def read_extraction(path):
+    # patient_id, ethnicity_code (string, missing if none) and
+    # ethnicity_code_date of an ethnicity extraction
+    df = feather.read_feather(path, columns=["patient_id", CODE_COLUMN, DATE_COLUMN])
+    code = df[CODE_COLUMN].astype("string").str.strip()
+    df[CODE_COLUMN] = code.where(code != "").astype(object)
+    df[DATE_COLUMN] = pd.to_datetime(df[DATE_COLUMN], errors="coerce")
+    # A date without a code (or the reverse) is no record
+    missing = df[CODE_COLUMN].isna() | df[DATE_COLUMN].isna()
+    df.loc[missing, CODE_COLUMN] = None
+    df.loc[missing, DATE_COLUMN] = pd.NaT
+    return df
+
+
+def fold(state, update):
+    # Latest code of every patient in the state or the update. Patients
+    # keep a row without code if they have no record in either.
+    # On equal dates the update wins.
+    df = pd.concat(
+        [state.assign(_order=0), update.assign(_order=1)], ignore_index=True
+    )
+    df["_has_code"] = df[CODE_COLUMN].notna()
+    df = df.sort_values(
+        ["patient_id", "_has_code", DATE_COLUMN, "_order"], kind="stable", na_position="first"
+    )
+    df = df.drop_duplicates("patient_id", keep="last")
+    return df.drop(columns=["_order", "_has_code"]).reset_index(drop=True)
+
+
+class EthnicityState:
+    def __init__(self, directory=DEFAULT_STATE_DIR):
+        self.directory = pathlib.Path(directory)
+        self.data_path = self.directory / "state.feather"
+        self.meta_path = self.directory / "state.json"
+
+    def metadata(self):
+        if not (self.meta_path.exists() and self.data_path.exists()):
+            return None
+        with open(self.meta_path) as f:
+            return json.load(f)
+
+    def since(self):
+        # Watermark of a valid state, None if a full rebuild is needed
+        metadata = self.metadata()
+        if metadata is None or metadata["hash"] != state_hash():
+            return None
+        return metadata["watermark"]
+
+    def read(self):
+        return feather.read_feather(self.data_path)
+
+    def update(self, path, extracted_until, full=False):
+        # Fold an extraction of the events up to extracted_until into the
+        # state and move the watermark. Returns the number of patients with a
+        # record in the extraction.
+        extracted_until = to_date(extracted_until).isoformat()
+        update = read_extraction(path)
+        latest = update[DATE_COLUMN].max()
+        if pd.notna(latest) and latest.date().isoformat() > extracted_until:
+            raise ValueError(
+                f"Extraction has records after {extracted_until} (latest {latest.date()}): "
+                "extract with --param until=<extracted until>"
+            )
+        since = self.since()
+        if full or since is None:
+            if not full:
+                raise ValueError(
+                    "The ethnicity state is missing or was built with another codelist: "
+                    "extract the full history and run update with --full"
+                )
+            state = update.iloc[:0]
+        else:
+            if extracted_until < since:
+                raise ValueError(f"Extraction until {extracted_until} is before the watermark {since}")
+            state = self.read()
+        self.write(fold(state, update), extracted_until)
+        return int(update[CODE_COLUMN].notna().sum())
+
+    def write(self, df, watermark):
+        # State first, then the metadata that makes it valid (both atomic)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.data_path.with_name(f".{self.data_path.name}.tmp")
+        feather.write_feather(
+            pa.Table.from_pandas(df, preserve_index=False), tmp_path, compression="uncompressed"
+        )
+        os.replace(tmp_path, self.data_path)
+        metadata = {"hash": state_hash(), "watermark": watermark, "patients": len(df)}
+        tmp_path = self.meta_path.with_name(f".{self.meta_path.name}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(metadata, f, indent=2)
+        os.replace(tmp_path, self.meta_path)
+
+    def export(self, path):
+        # The state in the layout of the ethnicity extraction, as read by
+        # join_ethnicity.py
+        if self.since() is None:
+            raise ValueError("The ethnicity state is missing or out of date")
+        df = self.read()[["patient_id", CODE_COLUMN, DATE_COLUMN]]
+        path = pathlib.Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        feather.write_feather(df, tmp_path)
+        os.replace(tmp_path, path)
+        return len(df)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--state-dir", default=DEFAULT_STATE_DIR)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("since", help='Print the watermark, or "full" if a full rebuild is needed')
+    update_parser = subparsers.add_parser("update", help="Fold an ethnicity extraction into the state")
+    update_parser.add_argument("--input", required=True)
+    update_parser.add_argument(
+        "--extracted-until",
+        default=end_date,
+        help="Date up to which events were extracted (default: config.end_date)",
+    )
+    update_parser.add_argument("--full", action="store_true", help="Rebuild from a full extraction")
+    export_parser = subparsers.add_parser("export", help="Write the state as an ethnicity cohort")
+    export_parser.add_argument("--output", default="output/input_ethnicity.feather")
+    args = parser.parse_args()
+
+    state = EthnicityState(args.state_dir)
+    if args.command == "since":
+        print(state.since() or "full")
+    elif args.command == "update":
+        records = state.update(args.input, args.extracted_until, args.full)
+        metadata = state.metadata()
+        print(
+            f"{records} new records, {metadata['patients']} patients, "
+            f"watermark {metadata['watermark']}"
+        )
+    else:
+        print(f"{state.export(args.output)} patients written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
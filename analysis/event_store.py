@@ -0,0 +1,220 @@
+# Local event store: patients, clinical events and registration spells in
+# one SQLite database (output/event_store.sqlite), used by local_backend.py
+# to run the study definitions offline.
+#
+# Tables (dates are stored as days since 1970-01-01):
+#   patients          patient_id, date_of_birth, sex, imd, died_on
+#   clinical_events   patient_id, code (SNOMED CT), date
+#   registrations     patient_id, start_date, end_date (missing if current),
+#                     practice, region
+#
+# clinical_events is indexed on (patient_id, code, date), and on (code,
+# date, patient_id) for the scans by codelist (covering, so a scan does not
+# read the table).
+# All codelists of a query are looked up in one scan (tagged_events): the
+# codes of every codelist are loaded into a temporary table with one bit
+# per codelist, and every event in the date range with a code in any
+# codelist is returned once, tagged with the bits of the codelists it
+# matches.
+#
+# The store is built from the dummy data (see dummy_data.py):
+#   python analysis/event_store.py --patients output/dummy_patients.feather \
+#     --events output/dummy_events.feather \
+#     --registrations output/input_registration_spells.feather
+
+import argparse
+import os
+import pathlib
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+
+DEFAULT_STORE = "output/event_store.sqlite"
+
+# Rows inserted per batch while building the store
+BATCH_ROWS = 500_000
+
+# Codelists per scan: one bit of a (signed 64 bit) SQLite integer each
+MAX_CODELISTS = 63
+
+TABLES = {
+    "patients": {
+        "patient_id": "INTEGER PRIMARY KEY",
+        "date_of_birth": "INTEGER",
+        "sex": "TEXT",
+        "imd": "REAL",
+        "died_on": "INTEGER",
+    },
+    "clinical_events": {
+        "patient_id": "INTEGER NOT NULL",
+        "code": "INTEGER NOT NULL",
+        "date": "INTEGER NOT NULL",
+    },
+    "registrations": {
+        "patient_id": "INTEGER NOT NULL",
+        "start_date": "INTEGER NOT NULL",
+        "end_date": "INTEGER",
+        "practice": "INTEGER",
+        "region": "TEXT",
+    },
+}
+DATE_COLUMNS = {"date_of_birth", "died_on", "date", "start_date", "end_date"}
+
+INDEXES = [
+    "CREATE INDEX clinical_events_patient ON clinical_events (patient_id, code, date)",
+    "CREATE INDEX clinical_events_code ON clinical_events (code, date, patient_id)",
+    "CREATE INDEX registrations_patient ON registrations (patient_id, start_date)",
+]
+
+
+def day_numbers(values):
+    # Days since 1970-01-01 as floats (missing dates are NaN)
+    days = pd.to_datetime(pd.Series(values)).to_numpy().astype("datetime64[D]")
+    numbers = days.astype(np.int64).astype(np.float64)
+    numbers[np.isnat(days)] = np.nan
+    return numbers
+
+
+def to_dates(numbers):
+    # Inverse of day_numbers (NaT for missing)
+    numbers = pd.Series(numbers, dtype="Float64")
+    dates = np.full(len(numbers), np.datetime64("NaT"), dtype="datetime64[D]")
+    present = numbers.notna().to_numpy()
+    dates[present] = numbers[present].to_numpy(dtype=np.int64).astype("datetime64[D]")
+    return pd.Series(dates).astype("datetime64[s]")
+
+
+def rows(batch, columns):
+    # Rows of a record batch as tuples, with dates as day numbers and
+    # missing values as None
+    df = batch.to_pandas()
+    values = []
+    for column in columns:
+        if column in DATE_COLUMNS:
+            series = pd.Series(day_numbers(df[column])).astype("Int64")
+        elif column == "code":
+            series = pd.to_numeric(df[column].astype("string"), errors="coerce").astype("Int64")
+        else:
+            series = df[column]
+        values.append(series.astype(object).where(series.notna(), None).tolist())
+    return zip(*values)
+
+
+def insert(connection, table, path):
+    columns = list(TABLES[table])
+    statement = (
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    )
+    count = 0
+    for batch in ds.dataset(str(path), format="feather").to_batches(
+        columns=columns, batch_size=BATCH_ROWS
+    ):
+        connection.executemany(statement, rows(batch, columns))
+        count += batch.num_rows
+    return count
+
+
+def build(path, patients, events, registrations):
+    # Build the store from feather files (events may be several files) into
+    # a temporary file first, so readers never see a partial store. Returns
+    # {table: rows}.
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    if tmp_path.exists():
+        tmp_path.unlink()
+    connection = sqlite3.connect(tmp_path)
+    try:
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        for table, columns in TABLES.items():
+            definition = ", ".join(f"{name} {kind}" for name, kind in columns.items())
+            connection.execute(f"CREATE TABLE {table} ({definition})")
+        counts = {
+            "patients": insert(connection, "patients", patients),
+            "clinical_events": sum(insert(connection, "clinical_events", e) for e in events),
+            "registrations": insert(connection, "registrations", registrations),
+        }
+        # Indexes are built after loading, in one pass each
+        for statement in INDEXES:
+            connection.execute(statement)
+        connection.execute("ANALYZE")
+        connection.commit()
+    finally:
+        connection.close()
+    os.replace(tmp_path, path)
+    return counts
+
+
+class EventStore:
+    def __init__(self, path=DEFAULT_STORE):
+        path = pathlib.Path(path)
+        if not path.exists():
+            raise FileNotFoundError(f"No event store at {path} (see event_store.py)")
+        self.connection = sqlite3.connect(f"file:{path.resolve()}?mode=ro", uri=True)
+        self.queries = 0
+
+    def query(self, sql, parameters=()):
+        self.queries += 1
+        return pd.read_sql_query(sql, self.connection, params=parameters)
+
+    def patients(self):
+        # All patients, sorted by patient_id, with dates as datetimes
+        df = self.query("SELECT * FROM patients ORDER BY patient_id")
+        for column in ["date_of_birth", "died_on"]:
+            df[column] = to_dates(df[column])
+        return df
+
+    def registrations(self):
+        # Registration spells in the layout read by registration.py
+        df = self.query("SELECT * FROM registrations ORDER BY patient_id, start_date")
+        for column in ["start_date", "end_date"]:
+            df[column] = to_dates(df[column])
+        return df
+
+    def tagged_events(self, codelists, start=None, end=None):
+        # Events with a code in any of the codelists (sorted code arrays)
+        # between the day numbers start and end (inclusive, None for open),
+        # in one scan. Returns patient_id, code, date (day number) and tags,
+        # where bit i of tags is set if the code is in codelists[i].
+        if len(codelists) > MAX_CODELISTS:
+            raise ValueError(f"At most {MAX_CODELISTS} codelists per scan")
+        tags = {}
+        for bit, codes in enumerate(codelists):
+            for code in np.asarray(codes, dtype=np.int64).tolist():
+                tags[code] = tags.get(code, 0) | (1 << bit)
+        self.connection.execute("DROP TABLE IF EXISTS temp.codelist_tags")
+        self.connection.execute(
+            "CREATE TEMP TABLE codelist_tags (code INTEGER PRIMARY KEY, tags INTEGER)"
+        )
+        self.connection.executemany("INSERT INTO temp.codelist_tags VALUES (?, ?)", tags.items())
+        lower = -(2**62) if start is None else int(start)
+        upper = 2**62 if end is None else int(end)
+        self.queries += 1
+        cursor = self.connection.execute(
+            "SELECT e.patient_id, e.code, e.date, t.tags "
+            "FROM temp.codelist_tags t "
+            "JOIN clinical_events e ON e.code = t.code AND e.date BETWEEN ? AND ?",
+            (lower, upper),
+        )
+        # All columns are integers, read straight into one int64 array
+        events = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 4)
+        return pd.DataFrame(events, columns=["patient_id", "code", "date", "tags"])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", default=DEFAULT_STORE)
+    parser.add_argument("--patients", default="output/dummy_patients.feather")
+    parser.add_argument("--events", nargs="+", default=["output/dummy_events.feather"])
+    parser.add_argument("--registrations", default="output/input_registration_spells.feather")
+    args = parser.parse_args()
+
+    counts = build(args.store, args.patients, args.events, args.registrations)
+    print(", ".join(f"{rows} {table}" for table, rows in counts.items()))
+
+
+if __name__ == "__main__":
+    main()
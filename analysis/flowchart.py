@@ -0,0 +1,341 @@
+# This script counts the BP002 select / reject cascade (the flowchart of the
+# business rules, see bp002_rules.py) for every lookback, index date and
+# breakdown from the joined cohorts:
+# (1) pack each denominator rule (bp002_denominator_r1 to _r4) of a monthly
+#     cohort into a bitset (np.packbits, one bit per patient, viewed as 64
+#     bit words) and every category of every breakdown into another
+# (2) derive all steps of the cascade with bitwise AND / AND NOT of the rule
+#     bitsets:
+#     - denominator_r1_reject: r1
+#     - denominator_r2_select: r1 AND r2
+#     - denominator_r3_reject: r1 AND NOT r2 AND NOT r3
+#     - denominator_r4_reject: r1 AND NOT r2 AND r3 AND NOT r4
+#     - denominator and numerator
+#     - excl_denominator_r3 and excl_denominator_r4 (the exclusions)
+#     (the steps of config.bp002_flowchart and config.bp002_exclusions)
+# (3) count each step in each category with a popcount of (step AND
+#     category)
+# (4) apply disclosure control (see disclosure.py) to the counts, with the
+#     population of the category as denominator, per lookback, date,
+#     breakdown and step
+#
+# Only the four rule columns and the breakdowns are read, and no grouping
+# or sorting of the rows is needed, so the flowchart costs little on top of
+# the achievement measures. The counts replace the flowchart and exclusion
+# measures of bp002_measures.py.
+#
+# Cohorts that do not fit into --memory-limit (one per worker) are counted
+# in batches of rows (see batches.py) and the counts of the batches are
+# added up.
+
+import argparse
+import functools
+import pathlib
+
+import numpy as np
+import pandas as pd
+
+from batches import batch_plan, read_batches
+from bp002_rules import shared_rules
+from config import bp002_exclusions, bp002_flowchart, demographic_breakdowns, lookback_years
+from dataset import partitions, sort_categories
+from disclosure import ROUNDING_BASE, THRESHOLD, disclosure_control
+from parallel import add_arguments as add_parallel_arguments
+from parallel import parallel_map
+from utils import expand_paths, index_date_from_path
+
+RULES = ["denominator_r1", "denominator_r2", "denominator_r3", "denominator_r4"]
+
+STEPS = (
+    bp002_flowchart
+    + ["denominator", "numerator"]
+    + [exclusion[len("bp002_") :] for exclusion in bp002_exclusions]
+)
+
+FLOWCHART_COLUMNS = ["lookback", "date", "group", "category", "step", "count", "population"]
+COUNT_KEYS = ["lookback", "date", "group", "category", "step"]
+FLOWCHART_TABLE = ["lookback", "date", "group", "step"]
+
+
+def group_codes(df, group_by):
+    # Integer code per row (-1 if any group_by value is missing) and a
+    # DataFrame with the group_by values of each code, in sorted order
+    if group_by == ["population"]:
+        return np.zeros(len(df), dtype=np.int64), pd.DataFrame({"population": [1]})
+    if len(group_by) == 1:
+        codes, uniques = pd.factorize(df[group_by[0]], sort=True)
+        return codes, pd.DataFrame({group_by[0]: uniques})
+    codes = df.groupby(group_by, sort=True, dropna=True).ngroup()
+    codes = codes.fillna(-1).to_numpy().astype(np.int64)
+    groups = (
+        df.loc[codes >= 0, group_by]
+        .assign(code=codes[codes >= 0])
+        .drop_duplicates("code")
+        .sort_values("code")
+        .drop(columns="code")
+        .reset_index(drop=True)
+    )
+    return codes, groups
+
+
+def rule_columns(lookback=None):
+    # {rule: column} of one lookback in the joined monthly cohorts, or in
+    # the partitions of the dataset (lookback None, see dataset.py)
+    prefix = f"bp002_{lookback}" if lookback else "bp002"
+    return {
+        rule: f"bp002_{rule}" if rule in shared_rules else f"{prefix}_{rule}" for rule in RULES
+    }
+
+
+def pack(flags):
+    # Bitset of a boolean array (or of the rows of a 2d array) as 64 bit
+    # words, padded with zeros
+    packed = np.packbits(flags, axis=-1)
+    padding = -packed.shape[-1] % 8
+    if padding:
+        widths = [(0, 0)] * (packed.ndim - 1) + [(0, padding)]
+        packed = np.pad(packed, widths)
+    return packed.view(np.uint64)
+
+
+# Bits set in every byte value, if np.bitwise_count (numpy >= 2) is missing
+BYTE_POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+def popcount(words):
+    # Number of bits set along the last axis
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    return BYTE_POPCOUNT[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+def rule_bitset(df, column):
+    return pack(df[column].fillna(0).to_numpy() > 0)
+
+
+def cascade(r1, r2, r3, r4, rows):
+    # {step: bitset}; rows has the bits of all patients set, so that NOT
+    # does not set the padding
+    def no(bits):
+        return rows & ~bits
+
+    denominator = r1 & (r2 | (r3 & r4))
+    steps = {
+        "denominator_r1_reject": r1,
+        "denominator_r2_select": r1 & r2,
+        "denominator_r3_reject": r1 & no(r2) & no(r3),
+        "denominator_r4_reject": r1 & no(r2) & r3 & no(r4),
+        "denominator": denominator,
+        "numerator": denominator & r2,
+        "excl_denominator_r3": no(r3),
+        "excl_denominator_r4": no(r4),
+    }
+    return np.stack([steps[step] for step in STEPS])
+
+
+def category_bitsets(df, breakdowns):
+    # [(group, categories, bitsets)] with one bitset per category; patients
+    # with a missing value are in no category
+    rows = pack(np.ones(len(df), dtype=bool))
+    groups = [("population", ["population"], rows[np.newaxis])]
+    for breakdown in breakdowns:
+        codes, values = group_codes(df, [breakdown])
+        flags = codes[np.newaxis] == np.arange(len(values))[:, np.newaxis]
+        groups.append((breakdown, values[breakdown].tolist(), pack(flags)))
+    return rows, groups
+
+
+def count_steps(steps, groups, lookback, date):
+    # Counts in FLOWCHART_COLUMNS and the value of every category (to sort
+    # the categories when the counts of batches are merged)
+    frames = []
+    for group, categories, bitsets in groups:
+        # categories x steps
+        counts = np.stack([popcount(steps & bitset) for bitset in bitsets])
+        values = np.empty(len(categories), dtype=object)
+        values[:] = categories
+        frames.append(
+            pd.DataFrame(
+                {
+                    "lookback": lookback,
+                    "date": date,
+                    "group": group,
+                    "category": np.repeat(values, len(STEPS)).astype(str),
+                    "step": np.tile(STEPS, len(categories)),
+                    "count": counts.ravel(),
+                    "population": np.repeat(popcount(bitsets), len(STEPS)),
+                    "value": np.repeat(values, len(STEPS)),
+                }
+            )
+        )
+    return pd.concat(frames, ignore_index=True)[FLOWCHART_COLUMNS + ["value"]]
+
+
+def cohort_flowchart(df, lookbacks, date, breakdowns):
+    # Flowchart counts of one monthly cohort. lookbacks is {lookback: {rule:
+    # column}}; rules shared by the lookbacks are packed once.
+    rows, groups = category_bitsets(df, breakdowns)
+    packed = {}
+    frames = []
+    for lookback, columns in lookbacks.items():
+        for column in columns.values():
+            if column not in packed:
+                packed[column] = rule_bitset(df, column)
+        steps = cascade(*(packed[columns[rule]] for rule in RULES), rows)
+        frames.append(count_steps(steps, groups, lookback, date))
+    return pd.concat(frames, ignore_index=True)
+
+
+def merge_counts(parts):
+    # Add up the counts of the batches of one cohort, in the order of the
+    # counts of the whole cohort: lookbacks and groups as read, the
+    # categories of every group sorted by their values and the steps in
+    # STEPS order
+    df = pd.concat(parts, ignore_index=True)
+    if len(parts) > 1:
+        df = (
+            df.groupby(COUNT_KEYS, sort=False)
+            .agg(count=("count", "sum"), population=("population", "sum"), value=("value", "first"))
+            .reset_index()
+        )
+        category = np.zeros(len(df), dtype=np.int64)
+        for rows in df.groupby("group", sort=False).indices.values():
+            category[rows] = pd.factorize(df["value"].iloc[rows], sort=True)[0]
+        order = np.lexsort(
+            (
+                df["step"].map({step: i for i, step in enumerate(STEPS)}).to_numpy(),
+                category,
+                pd.factorize(df["group"])[0],
+                pd.factorize(df["lookback"])[0],
+            )
+        )
+        df = df.iloc[order]
+    return df[FLOWCHART_COLUMNS].reset_index(drop=True)
+
+
+def flowchart_batches(path, lookbacks, date, breakdowns, batch_rows=None):
+    # Flowchart counts of one monthly cohort, read in batches of rows
+    names = sorted({column for rules in lookbacks.values() for column in rules.values()})
+    parts = [
+        cohort_flowchart(sort_categories(table.to_pandas()), lookbacks, date, breakdowns)
+        for table in read_batches(path, names + list(breakdowns), batch_rows)
+    ]
+    return merge_counts(parts)
+
+
+def flowchart_file(path, lookbacks, breakdowns, batch_rows=None):
+    columns = {lookback: rule_columns(lookback) for lookback in lookbacks}
+    return flowchart_batches(path, columns, index_date_from_path(path), breakdowns, batch_rows)
+
+
+def flowchart_partition(partition, breakdowns, batch_rows=None):
+    lookback, index_date, path = partition
+    return flowchart_batches(path, {lookback: rule_columns()}, index_date, breakdowns, batch_rows)
+
+
+def flowchart(
+    input_files,
+    input_dataset=None,
+    lookbacks=None,
+    breakdowns=None,
+    index_dates=None,
+    workers=None,
+    memory_limit=None,
+):
+    # Long DataFrame of the flowchart counts (FLOWCHART_COLUMNS) of all
+    # monthly cohorts, before disclosure control
+    if lookbacks is None:
+        lookbacks = list(lookback_years)
+    if breakdowns is None:
+        breakdowns = demographic_breakdowns
+    if input_dataset is not None:
+        items = partitions(input_dataset, lookbacks=lookbacks, index_dates=index_dates)
+        function = functools.partial(flowchart_partition, breakdowns=breakdowns)
+        paths = [path for _, _, path in items]
+    else:
+        items = paths = [
+            path
+            for path in input_files
+            if index_dates is None or index_date_from_path(path) in index_dates
+        ]
+        function = functools.partial(flowchart_file, lookbacks=lookbacks, breakdowns=breakdowns)
+    workers, batch_rows = batch_plan(paths, workers, memory_limit)
+    results = parallel_map(
+        functools.partial(function, batch_rows=batch_rows), items, workers=workers
+    )
+    if not results:
+        return pd.DataFrame(columns=FLOWCHART_COLUMNS)
+    df = pd.concat(results, ignore_index=True)
+    return df.sort_values(["lookback", "date"], kind="stable").reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--input-files",
+        nargs="+",
+        default=["output/joined/input_bp002_*.feather"],
+        help="Joined monthly cohorts or glob patterns",
+    )
+    parser.add_argument(
+        "--input-dataset",
+        default=None,
+        help="Parquet dataset of joined cohorts (instead of --input-files)",
+    )
+    parser.add_argument("--output", default="output/joined/measures/flowchart_bp002.csv")
+    parser.add_argument(
+        "--audit-output", default="output/joined/measures/disclosure_audit_flowchart_bp002.csv"
+    )
+    parser.add_argument(
+        "--long-output",
+        default=None,
+        help="CSV file for the counts before disclosure control (not for release)",
+    )
+    parser.add_argument("--lookbacks", nargs="+", default=None, help="Default: all lookbacks")
+    parser.add_argument(
+        "--breakdowns",
+        nargs="+",
+        default=None,
+        help="Default: config.demographic_breakdowns",
+    )
+    parser.add_argument("--index-dates", nargs="+", default=None, help="Default: all months")
+    parser.add_argument("--threshold", type=int, default=THRESHOLD)
+    parser.add_argument("--rounding-base", type=int, default=ROUNDING_BASE)
+    add_parallel_arguments(parser)
+    args = parser.parse_args()
+
+    df = flowchart(
+        [] if args.input_dataset else expand_paths(args.input_files),
+        args.input_dataset,
+        args.lookbacks,
+        args.breakdowns,
+        args.index_dates,
+        args.workers,
+        args.memory_limit,
+    )
+    released, audit = disclosure_control(
+        df,
+        "count",
+        "population",
+        FLOWCHART_TABLE,
+        threshold=args.threshold,
+        base=args.rounding_base,
+    )
+
+    outputs = [(args.output, released), (args.audit_output, audit)]
+    if args.long_output is not None:
+        outputs.append((args.long_output, df))
+    for path, table in outputs:
+        path = pathlib.Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        table.to_csv(path, index=False, na_rep="NA")
+
+    checks = [column for column in audit.columns if column.startswith("check_")]
+    failed = audit[~audit[checks].all(axis=1)]
+    if len(failed):
+        print(failed.to_string(index=False))
+        raise SystemExit(f"{len(failed)} tables fail the disclosure checks")
+
+
+if __name__ == "__main__":
+    main()
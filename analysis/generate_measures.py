@@ -0,0 +1,366 @@
+# This script calculates all BP002 measures (see bp002_measures.py) from the
+# joined monthly cohorts (output/joined/input_bp002_<date>.feather):
+# (1) read each monthly cohort once, only loading the columns the measures
+#     use (monthly cohorts are processed in parallel, see parallel.py)
+# (2) sum the numerators and denominators of all measures over all their
+#     group_by lists in one cube aggregation (see cube.py): coarser
+#     breakdowns are rolled up from finer ones, so cross breakdowns (e.g.,
+#     age_band x sex, see config.demographic_cross_breakdowns) cost about
+#     as much as one breakdown
+# (3) apply small number suppression per measure and date, like
+#     `Measure(small_number_suppression=True)` (see disclosure.py)
+# (4) write one measure_<id>.csv per measure with all dates, in the same
+#     layout as cohortextractor generate_measures
+# (5) append the population and breakdown measures of all lookbacks to one
+#     long file (lookback, date, group, category, numerator, denominator,
+#     population, value) before suppression; disclosure.py suppresses and
+#     rounds it for release
+# (6) write a quantile sketch of the practice rates per date next to every
+#     practice measure (sketch_<id>.json, see quantile_sketch.py). The
+#     sketches are fed with the practice rates after small number
+#     suppression, i.e., the values of measure_<id>.csv from which the
+#     deciles were calculated before (suppressed practices are left out).
+#
+# With --input-dataset the cohorts are read from the Parquet dataset written
+# by join_ethnicity.py --output-format parquet (see dataset.py). Only the
+# partitions of each measure's lookback and only the columns the measures
+# use are read.
+#
+# Cohorts that do not fit into --memory-limit (one per worker) are read in
+# batches of rows (see batches.py). Every batch is aggregated on its own
+# and the sums of the batches are added up per group (merge_aggregates), so
+# the memory per worker does not grow with the population.
+#
+# With --index-dates only the given months are calculated. Together with
+# --append the measure files, the long file and the sketches are updated in
+# place: rows of the other months are kept (see refresh.py).
+
+import argparse
+import functools
+import io
+import pathlib
+
+import numpy as np
+import pandas as pd
+
+from bp002_measures import bp002_measures
+from config import lookback_years
+from batches import batch_plan, read_batches
+from cube import aggregate_cube
+from dataset import partitions, sort_categories, variable_lookback
+from disclosure import calculate_value, suppress
+from parallel import add_arguments as add_parallel_arguments
+from parallel import parallel_map
+from quantile_sketch import rate_digest, sketch_path, write_sketches
+from utils import expand_paths, index_date_from_path
+
+LONG_COLUMNS = [
+    "lookback",
+    "date",
+    "group",
+    "category",
+    "numerator",
+    "denominator",
+    "population",
+    "value",
+]
+
+
+def measure_columns(measures):
+    # All columns read from the monthly cohorts
+    columns = set()
+    for measure in measures:
+        columns.update([measure["numerator"], measure["denominator"]])
+        columns.update(column for column in measure["group_by"] if column != "population")
+    return sorted(columns)
+
+
+def aggregate(df, measures, date):
+    # Return {measure id: DataFrame} for one monthly cohort. The numerators
+    # and denominators of all measures are summed over all group_by lists
+    # at once (see cube.py): every breakdown column is factorised once and
+    # coarser breakdowns are rolled up from finer ones (e.g., age_band from
+    # age_band x sex) instead of from the rows.
+    variables = sorted({m["numerator"] for m in measures} | {m["denominator"] for m in measures})
+    groupings = [
+        () if measure["group_by"] == ["population"] else tuple(measure["group_by"])
+        for measure in measures
+    ]
+    tables = aggregate_cube(df, groupings, variables)
+
+    results = {}
+    for measure, grouping in zip(measures, groupings):
+        columns = [measure["numerator"], measure["denominator"]]
+        if grouping:
+            result = tables[grouping][list(grouping) + columns].copy()
+        else:
+            result = tables[grouping][columns].assign(population=1)
+            result = result[["population"] + columns]
+        result["date"] = date
+        results[measure["id"]] = result
+    return results
+
+
+def finalise(df, measure):
+    numerator = measure["numerator"]
+    denominator = measure["denominator"]
+    if measure.get("small_number_suppression"):
+        df, _, _ = suppress(df, numerator, denominator, by=["date"])
+    df["value"] = calculate_value(df, numerator, denominator)
+    columns = measure["group_by"] + [numerator, denominator, "value", "date"]
+    return df[columns].sort_values(["date"] + measure["group_by"], kind="stable")
+
+
+def measure_results(results, measure):
+    # Aggregates of one measure over all cohorts, an empty frame with the
+    # measure columns if no cohort was aggregated (e.g., no matching files)
+    frames = [result[measure["id"]] for result in results if measure["id"] in result]
+    if not frames:
+        columns = measure["group_by"] + [measure["numerator"], measure["denominator"], "date"]
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True)
+
+
+def long_format(df, measure):
+    # Finalised measure in the long layout, with the group_by variable in
+    # group and its values in category. Only measures with one group_by
+    # variable can be written in this layout.
+    (group,) = measure["group_by"]
+    long = pd.DataFrame(
+        {
+            "lookback": variable_lookback(measure["numerator"])[0],
+            "date": df["date"],
+            "group": group,
+            "category": df[group].astype(str),
+            "numerator": df[measure["numerator"]],
+            "denominator": df[measure["denominator"]],
+            "population": df["population"] if group == "population" else pd.NA,
+            "value": df["value"],
+        }
+    )
+    if group == "population":
+        long["category"] = "population"
+    return long[LONG_COLUMNS]
+
+
+def long_measure(measure):
+    # Measures in the long file: population and demographic breakdowns
+    # (practice level measures are only used for the deciles charts)
+    return len(measure["group_by"]) == 1 and measure["group_by"] != ["practice"]
+
+
+def write_long_measures(frames, path, append=False):
+    # Write the long measures to path. With append, existing rows are kept
+    # unless their lookback and date are written again, so the file can grow
+    # by the newly calculated months.
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    frames = list(frames)
+    keys = set()
+    for frame in frames:
+        keys.update(zip(frame["lookback"].astype(str), frame["date"].astype(str)))
+
+    tmp_path = path.with_suffix(".tmp")
+    header = True
+    with open(tmp_path, "w", newline="") as f:
+        if append and path.exists():
+            # Kept rows are copied as text, unchanged
+            for chunk in pd.read_csv(path, chunksize=100_000, dtype=str, keep_default_na=False):
+                rewritten = [key in keys for key in zip(chunk["lookback"], chunk["date"])]
+                chunk[~np.array(rewritten, dtype=bool)].to_csv(f, index=False, header=header)
+                header = False
+        for frame in frames:
+            frame.to_csv(f, index=False, header=header)
+            header = False
+        if header:
+            pd.DataFrame(columns=LONG_COLUMNS).to_csv(f, index=False)
+    tmp_path.replace(path)
+
+
+def write_measure(df, path, append=False):
+    # Write a finalised measure. With append, existing rows are kept unless
+    # their date is written again (kept rows are copied as text, unchanged).
+    path = pathlib.Path(path)
+    if append and path.exists():
+        new = pd.read_csv(io.StringIO(df.to_csv(index=False)), dtype=str, keep_default_na=False)
+        kept = pd.read_csv(path, dtype=str, keep_default_na=False)
+        kept = kept[~kept["date"].isin(set(new["date"]))]
+        df = pd.concat([kept, new], ignore_index=True).sort_values("date", kind="stable")
+    tmp_path = path.with_suffix(".tmp")
+    df.to_csv(tmp_path, index=False)
+    tmp_path.replace(path)
+
+
+def merge_aggregates(parts, measures):
+    # Merge the {measure id: DataFrame} of the batches of one cohort: the
+    # numerators and denominators are added up per group
+    if len(parts) == 1:
+        return parts[0]
+    merged = {}
+    for measure in measures:
+        if measure["id"] not in parts[0]:
+            continue
+        df = pd.concat([part[measure["id"]] for part in parts], ignore_index=True)
+        sums = [measure["numerator"], measure["denominator"]]
+        keys = [column for column in df.columns if column not in sums]
+        df = df.groupby(keys, sort=True, observed=True)[sums].sum().reset_index()
+        merged[measure["id"]] = df[list(parts[0][measure["id"]].columns)]
+    return merged
+
+
+def practice_digests(df, measure):
+    # {date: TDigest} of the practice rates of a finalised practice measure,
+    # i.e., after small number suppression
+    return {
+        str(date): rate_digest(rows, measure["numerator"], measure["denominator"])
+        for date, rows in df.groupby("date", sort=True)
+    }
+
+
+def aggregate_batches(path, measures, index_date, batch_rows=None):
+    # Return {measure id: DataFrame} of one cohort
+    columns = measure_columns(measures)
+    parts = [
+        aggregate(sort_categories(table.to_pandas()), measures, index_date)
+        for table in read_batches(path, columns, batch_rows)
+    ]
+    return merge_aggregates(parts, measures)
+
+
+def aggregate_file(path, measures, batch_rows=None):
+    return aggregate_batches(path, measures, index_date_from_path(path), batch_rows)
+
+
+def partition_measures(measures, lookback):
+    # Measures of one lookback with the variable names used in the dataset
+    # (without the lookback). Measures of shared variables only are
+    # calculated from the partitions of the first lookback.
+    renamed = []
+    for measure in measures:
+        numerator_lookback, numerator = variable_lookback(measure["numerator"])
+        denominator_lookback, denominator = variable_lookback(measure["denominator"])
+        measure_lookback = numerator_lookback or denominator_lookback or list(lookback_years)[0]
+        if measure_lookback == lookback:
+            renamed.append(dict(measure, numerator=numerator, denominator=denominator))
+    return renamed
+
+
+def aggregate_partition(partition, measures, batch_rows=None):
+    lookback, index_date, path = partition
+    renamed = partition_measures(measures, lookback)
+    if not renamed:
+        return {}
+    results = aggregate_batches(path, renamed, index_date, batch_rows)
+    # Restore the lookback specific variable names
+    originals = {measure["id"]: measure for measure in measures}
+    for measure in renamed:
+        original = originals[measure["id"]]
+        results[measure["id"]] = results[measure["id"]].rename(
+            columns={
+                measure["numerator"]: original["numerator"],
+                measure["denominator"]: original["denominator"],
+            }
+        )
+    return results
+
+
+def generate_measures(
+    input_files,
+    output_dir,
+    measures=None,
+    workers=None,
+    memory_limit=None,
+    input_dataset=None,
+    long_output=None,
+    append=False,
+    index_dates=None,
+):
+    if measures is None:
+        measures = bp002_measures()
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # Monthly cohorts are aggregated in parallel, only the (small) grouped
+    # results are returned to the main process
+    if input_dataset is not None:
+        items = partitions(input_dataset, index_dates=index_dates)
+        paths = [path for _, _, path in items]
+        function = aggregate_partition
+    else:
+        items = paths = [
+            path
+            for path in input_files
+            if index_dates is None or index_date_from_path(path) in index_dates
+        ]
+        function = aggregate_file
+    workers, batch_rows = batch_plan(paths, workers, memory_limit)
+    results = parallel_map(
+        functools.partial(function, measures=measures, batch_rows=batch_rows),
+        items,
+        workers=workers,
+    )
+
+    long_frames = []
+    for measure in measures:
+        df = measure_results(results, measure)
+        if long_output is not None and long_measure(measure):
+            # Disclosure control of the long file is applied by disclosure.py
+            unsuppressed = dict(measure, small_number_suppression=False)
+            long_frames.append(long_format(finalise(df.copy(), unsuppressed), measure))
+        df = finalise(df, measure)
+        write_measure(df, output_dir / f"measure_{measure['id']}.csv", append)
+        if measure["group_by"] == ["practice"]:
+            digests = practice_digests(df, measure)
+            write_sketches(sketch_path(output_dir, measure["id"]), measure["id"], digests, append)
+
+    if long_output is not None:
+        write_long_measures(long_frames, long_output, append)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--input-files",
+        nargs="+",
+        default=["output/joined/input_bp002_*.feather"],
+        help="Joined monthly cohorts or glob patterns",
+    )
+    parser.add_argument(
+        "--input-dataset",
+        default=None,
+        help="Parquet dataset of joined cohorts (instead of --input-files)",
+    )
+    parser.add_argument("--output-dir", default="output/joined")
+    parser.add_argument(
+        "--long-output",
+        default=None,
+        help="CSV file for all population and breakdown measures in long format",
+    )
+    parser.add_argument(
+        "--append",
+        action="store_true",
+        help="Keep the rows of the measure files, --long-output and the sketches of dates not recalculated",
+    )
+    parser.add_argument(
+        "--index-dates",
+        nargs="+",
+        default=None,
+        help="Only calculate these months (default: all)",
+    )
+    add_parallel_arguments(parser)
+    args = parser.parse_args()
+
+    generate_measures(
+        [] if args.input_dataset else expand_paths(args.input_files),
+        args.output_dir,
+        workers=args.workers,
+        memory_limit=args.memory_limit,
+        input_dataset=args.input_dataset,
+        long_output=args.long_output,
+        append=args.append,
+        index_dates=args.index_dates,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+# This script joins the ethnicity cohort (output/input_ethnicity.feather)
+# to every monthly cohort (output/input_bp002_*.feather):
+# (1) load the ethnicity cohort once, derive both ethnicity groupings and
+#     their labels from the extracted ethnicity code (see ethnicity.py),
+#     sort it by patient_id and write it as an uncompressed Arrow file that
+#     every worker memory-maps, so the ethnicity data is read and indexed
+#     once instead of once per file
+# (2) look up each monthly cohort's patients with a binary search on the
+#     sorted patient_id column and take the ethnicity columns (left join,
+#     patients without an ethnicity record get missing values)
+# (3) write the joined cohorts to the output directory using the same file
+#     names, as cohort-joiner did, or with --output-format parquet as one
+#     dataset partitioned by lookback and index date (see dataset.py)
+#
+# Monthly files are joined in parallel (see --workers and --memory-limit).
+# If the whole files of all workers do not fit into --memory-limit, every
+# file is joined and written in batches of rows (see batches.py), so the
+# memory per worker stays the same as the population grows.
+
+import argparse
+import functools
+import pathlib
+import tempfile
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.ipc as ipc
+
+from batches import BatchWriter, batch_plan, read_batches
+from dataset import CohortWriter
+from ethnicity import add_ethnicity_groupings
+from parallel import add_arguments as add_parallel_arguments
+from parallel import parallel_map
+from utils import expand_paths, index_date_from_path
+
+
+def write_lookup(rhs_path, lookup_path):
+    # Write the ethnicity cohort sorted by patient_id as an uncompressed
+    # Arrow IPC file that can be memory-mapped without copying
+    table = feather.read_table(rhs_path)
+    if "ethnicity_code_date" in table.column_names:
+        # Only kept for the ethnicity state (see ethnicity_state.py)
+        table = table.select([c for c in table.column_names if c != "ethnicity_code_date"])
+    if "ethnicity_code" in table.column_names:
+        table = pa.Table.from_pandas(
+            add_ethnicity_groupings(table.to_pandas()), preserve_index=False
+        )
+    table = table.sort_by("patient_id").combine_chunks()
+    patient_id = table.column("patient_id").to_numpy()
+    if len(patient_id) and (np.diff(patient_id) == 0).any():
+        raise ValueError(f"{rhs_path} contains duplicate patient_ids")
+    with pa.OSFile(str(lookup_path), "wb") as sink:
+        with ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+class PatientLookup:
+    # Memory-mapped table sorted by patient_id
+
+    def __init__(self, path):
+        self.table = ipc.open_file(pa.memory_map(str(path))).read_all()
+        self.patient_id = self.table.column("patient_id").to_numpy()
+        self.columns = [name for name in self.table.column_names if name != "patient_id"]
+
+    def positions(self, patient_id):
+        # Row of each patient_id in the lookup table, null if missing
+        patient_id = np.asarray(patient_id)
+        if len(self.patient_id) == 0:
+            return pa.nulls(len(patient_id), pa.int64())
+        position = np.minimum(
+            np.searchsorted(self.patient_id, patient_id), len(self.patient_id) - 1
+        )
+        found = self.patient_id[position] == patient_id
+        return pa.array(position, type=pa.int64(), mask=~found)
+
+    def join(self, table):
+        # Left join the lookup columns onto table (by patient_id). Columns
+        # of table with the same names are replaced.
+        table = table.select(
+            [name for name in table.column_names if name not in self.columns]
+        )
+        positions = self.positions(table.column("patient_id").to_numpy())
+        joined = self.table.select(self.columns).take(positions)
+        for name in self.columns:
+            table = table.append_column(joined.schema.field(name), joined.column(name))
+        return table
+
+
+_lookup = None
+
+
+def _init_worker(lookup_path):
+    global _lookup
+    _lookup = PatientLookup(lookup_path)
+
+
+def _join_file(lhs_path, output_dir, output_format="feather", batch_rows=None):
+    if output_format == "parquet":
+        writer = CohortWriter(output_dir, index_date_from_path(lhs_path))
+    else:
+        writer = BatchWriter(pathlib.Path(output_dir) / pathlib.Path(lhs_path).name)
+    for table in read_batches(lhs_path, batch_rows=batch_rows):
+        writer.write(_lookup.join(table))
+    return writer.close()
+
+
+def join_files(
+    lhs_paths, rhs_path, output_dir, workers=None, memory_limit=None, output_format="feather"
+):
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        lookup_path = pathlib.Path(tmp_dir) / "lookup.arrow"
+        write_lookup(rhs_path, lookup_path)
+
+        # The memory-mapped lookup is shared by all workers through the page
+        # cache and is not part of the memory needed per worker
+        workers, batch_rows = batch_plan(lhs_paths, workers, memory_limit)
+        return parallel_map(
+            functools.partial(
+                _join_file,
+                output_dir=output_dir,
+                output_format=output_format,
+                batch_rows=batch_rows,
+            ),
+            lhs_paths,
+            workers=workers,
+            initializer=_init_worker,
+            initargs=(lookup_path,),
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lhs", nargs="+", required=True, help="Cohort files or glob patterns")
+    parser.add_argument("--rhs", required=True, help="Cohort file joined to every lhs file")
+    parser.add_argument("--output-dir", default="output/joined")
+    parser.add_argument(
+        "--output-format",
+        choices=["feather", "parquet"],
+        default="feather",
+        help="One feather file per lhs file, or one Parquet dataset in --output-dir",
+    )
+    add_parallel_arguments(parser)
+    args = parser.parse_args()
+
+    join_files(
+        expand_paths(args.lhs),
+        args.rhs,
+        args.output_dir,
+        args.workers,
+        args.memory_limit,
+        args.output_format,
+    )
+
+
+if __name__ == "__main__":
+    main()
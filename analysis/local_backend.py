@@ -0,0 +1,469 @@
+# Local backend: runs the study definitions unchanged against the local
+# event store (see event_store.py) instead of cohortextractor, e.g., to run
+# the whole pipeline offline on dummy data:
+#   python analysis/local_backend.py generate_cohort \
+#     --study-definition study_definition_bp002 \
+#     --index-date-range "2019-03-01 to 2019-12-31 by month" \
+#     --output-dir=output --output-format=feather
+# The arguments are those of `cohortextractor generate_cohort` (and
+# run_project.py --local-backend runs the extraction actions of project.yaml
+# with this script).
+#
+# (1) the study definition is imported with a stand-in cohortextractor
+#     module that records every `patients.<method>(...)` call as a
+#     variable; nested variables (e.g., imd of imd_q5, bp_any of the
+#     population) are evaluated but not written
+# (2) per index date, the clinical events of all with_these_clinical_events
+#     variables are read in one scan of the store: the distinct codelists
+#     are tagged with one bit each and every event in the union of the
+#     periods is returned once with the bits of its codelists (see
+#     EventStore.tagged_events); each variable then selects its codelist
+#     bit and period from the scanned events with numpy
+# (3) patient level variables (sex, age, death, IMD) come from the patients
+#     table and registration variables from the registration spells (see
+#     registration.py)
+# (4) satisfying() and categorised_as() variables and the population are
+#     evaluated with the rule engine (see rule_engine.py), as one plan
+#
+# The store has no address history, so address_as_of returns the current
+# IMD of every patient. return_expectations are ignored. Unsupported methods
+# or arguments raise a ValueError naming the variable.
+
+import argparse
+import datetime
+import importlib.util
+import pathlib
+import re
+import sys
+import time
+import types
+
+import numpy as np
+import pandas as pd
+
+from codelist_index import ROOT_DIR, Codelist, compile_codelists
+from event_store import DEFAULT_STORE, MAX_CODELISTS, EventStore, day_numbers, to_dates
+from registration import RegistrationIndex
+from rule_engine import compile_rules
+from tracing import Trace
+from utils import add_months, last_day_of_month, month_starts, to_date
+
+ANALYSIS_DIR = pathlib.Path(__file__).parent
+
+RULE_METHODS = {"satisfying", "categorised_as"}
+
+DATE_OFFSET = re.compile(
+    r"^(?P<base>.+?)\s*(?P<sign>[+-])\s*(?P<number>\d+)\s*(?P<unit>day|month|year)s?$"
+)
+DATE_FUNCTION = re.compile(r"^(?P<function>first_day_of_month|last_day_of_month)\((?P<argument>.*)\)$")
+INDEX_DATE_RANGE = re.compile(r"^(?P<start>\S+)\s+to\s+(?P<end>\S+)\s+by\s+(?P<period>\w+)$")
+
+
+class Variable:
+    # A recorded `patients.<method>(*args, **kwargs)` call
+
+    def __init__(self, method, args, kwargs):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+
+    def argument(self, position, name, default=None):
+        if len(self.args) > position:
+            return self.args[position]
+        return self.kwargs.get(name, default)
+
+    def nested(self):
+        return {name: value for name, value in self.kwargs.items() if isinstance(value, Variable)}
+
+
+class Patients:
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+        return lambda *args, **kwargs: Variable(method, args, kwargs)
+
+
+class StudyDefinition:
+    def __init__(self, population, index_date=None, default_expectations=None, **variables):
+        self.population = population
+        self.index_date = index_date
+        self.variables = variables
+
+
+class Measure:
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+
+def codelist_from_csv(path, system, column="code", category_column=None):
+    definition = {"path": path, "column": column, "category_column": category_column}
+    return compile_codelists({path: definition}, root=ROOT_DIR)[path]
+
+
+def codelist(codes, system):
+    return Codelist("codelist", np.unique(np.asarray(codes, dtype=np.int64)))
+
+
+def load_study(study_definition, params=None):
+    # Import analysis/<study_definition>.py with the stand-in cohortextractor
+    module = types.ModuleType("cohortextractor")
+    module.StudyDefinition = StudyDefinition
+    module.Measure = Measure
+    module.patients = Patients()
+    module.codelist_from_csv = codelist_from_csv
+    module.codelist = codelist
+    module.params = dict(params or {})
+    sys.modules["cohortextractor"] = module
+    if str(ANALYSIS_DIR) not in sys.path:
+        sys.path.insert(0, str(ANALYSIS_DIR))
+    path = ANALYSIS_DIR / f"{study_definition}.py"
+    spec = importlib.util.spec_from_file_location(study_definition, path)
+    study_module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(study_module)
+    return study_module.study
+
+
+def flatten(study):
+    # [(name, variable, output)] with nested variables before their parents;
+    # only the variables of the study definition itself are written
+    variables = []
+
+    def visit(name, variable, output):
+        for nested_name, nested in variable.nested().items():
+            visit(nested_name, nested, False)
+        variables.append((name, variable, output))
+
+    visit("population", study.population, False)
+    for name, variable in study.variables.items():
+        visit(name, variable, True)
+    return variables
+
+
+def resolve_date(expression, index_date):
+    # Date of an expression such as "last_day_of_month(index_date) + 1 day",
+    # "first_day_of_month(index_date) - 5 years" or "2019-03-01"
+    if expression is None:
+        return None
+    expression = str(expression).strip()
+    match = DATE_OFFSET.match(expression)
+    if match:
+        date = resolve_date(match["base"], index_date)
+        number = int(match["number"]) * (-1 if match["sign"] == "-" else 1)
+        if match["unit"] == "day":
+            return date + datetime.timedelta(days=number)
+        return add_months(date, number * (12 if match["unit"] == "year" else 1))
+    match = DATE_FUNCTION.match(expression)
+    if match:
+        date = resolve_date(match["argument"], index_date)
+        if match["function"] == "first_day_of_month":
+            return date.replace(day=1)
+        return last_day_of_month(date)
+    if expression == "index_date":
+        if index_date is None:
+            raise ValueError("The study definition has no index date")
+        return to_date(index_date)
+    if expression == "today":
+        return datetime.date.today()
+    return to_date(expression)
+
+
+def day_number(date):
+    return None if date is None else int(day_numbers([date])[0])
+
+
+def period(variable, index_date):
+    # (start, end) day numbers of between / on_or_after / on_or_before,
+    # None where the period is open
+    start, end = variable.kwargs.get("between") or (None, None)
+    start = variable.kwargs.get("on_or_after", start)
+    end = variable.kwargs.get("on_or_before", end)
+    return day_number(resolve_date(start, index_date)), day_number(resolve_date(end, index_date))
+
+
+def index_dates(index_date_range, default=None):
+    # Index dates of --index-date-range ("<start> to <end> by month"), or
+    # [default] if there is no range
+    if index_date_range is None:
+        return [default]
+    match = INDEX_DATE_RANGE.match(index_date_range.strip())
+    if match is None:
+        return [to_date(index_date_range)]
+    if match["period"] != "month":
+        raise ValueError(f"Unsupported index date range period {match['period']!r}")
+    return month_starts(match["start"], match["end"])
+
+
+class LocalBackend:
+    def __init__(self, store):
+        self.store = store
+        self.patients = store.patients()
+        self.patient_id = self.patients["patient_id"].to_numpy()
+        self.registrations = RegistrationIndex(store.registrations())
+        # Row of every patient with a registration spell
+        self.registration_rows = np.searchsorted(self.patient_id, self.registrations.patient_id)
+        date_of_birth = pd.DatetimeIndex(self.patients["date_of_birth"])
+        self.birth_year = date_of_birth.year.to_numpy()
+        self.birth_month_day = date_of_birth.month.to_numpy() * 100 + date_of_birth.day.to_numpy()
+
+    def __len__(self):
+        return len(self.patient_id)
+
+    def rows(self, patient_id):
+        # Row of every patient id (-1 if it is not in the patients table)
+        row = np.minimum(np.searchsorted(self.patient_id, patient_id), len(self) - 1)
+        return np.where(self.patient_id[row] == patient_id, row, -1)
+
+    def scan(self, variables, index_date):
+        # Scan the clinical events of all with_these_clinical_events
+        # variables at once. Returns {name: (events, bit, start, end)} with
+        # the scanned events of the variable's codelist group.
+        codelists = {}
+        periods = {}
+        for name, variable in variables:
+            codes = np.asarray(variable.argument(0, "codelist").codes, dtype=np.int64)
+            codelists.setdefault(codes.tobytes(), (len(codelists), codes))
+            periods[name] = period(variable, index_date)
+        starts = [start for start, _ in periods.values()]
+        ends = [end for _, end in periods.values()]
+        start = None if None in starts else min(starts)
+        end = None if None in ends else max(ends)
+
+        # One scan per MAX_CODELISTS distinct codelists
+        ordered = [codes for _, codes in sorted(codelists.values(), key=lambda item: item[0])]
+        scans = []
+        for first in range(0, len(ordered), MAX_CODELISTS):
+            events = self.store.tagged_events(ordered[first : first + MAX_CODELISTS], start, end)
+            events["row"] = self.rows(events["patient_id"].to_numpy())
+            scans.append(events[events["row"] >= 0])
+
+        scanned = {}
+        for name, variable in variables:
+            codes = np.asarray(variable.argument(0, "codelist").codes, dtype=np.int64)
+            number = codelists[codes.tobytes()][0]
+            group, bit = divmod(number, MAX_CODELISTS)
+            scanned[name] = (scans[group], bit) + periods[name]
+        return scanned
+
+    def clinical_events(self, name, variable, events, bit, start, end):
+        # {column: values} of a with_these_clinical_events variable
+        date = events["date"].to_numpy()
+        selected = (events["tags"].to_numpy() >> bit) & 1 == 1
+        if start is not None:
+            selected &= date >= start
+        if end is not None:
+            selected &= date <= end
+        events = events[selected]
+        rows = events["row"].to_numpy()
+        returning = variable.kwargs.get("returning", "binary_flag")
+        if returning == "binary_flag":
+            flag = np.zeros(len(self), dtype=np.int64)
+            flag[rows] = 1
+            columns = {name: flag}
+        elif returning == "number_of_matches_in_period":
+            columns = {name: np.bincount(rows, minlength=len(self)).astype(np.int64)}
+        elif returning in ("code", "date", "category"):
+            # One event per patient: the last match unless
+            # find_first_match_in_period is set (as in cohortextractor)
+            events = events.sort_values(["row", "date", "code"], kind="stable")
+            keep = "first" if variable.kwargs.get("find_first_match_in_period") else "last"
+            events = events.drop_duplicates("row", keep=keep)
+            rows = events["row"].to_numpy()
+            codes = np.full(len(self), None, dtype=object)
+            codes[rows] = events["code"].astype(str).to_numpy()
+            days = np.full(len(self), np.nan)
+            days[rows] = events["date"].to_numpy()
+            if returning == "code":
+                columns = {name: codes}
+            elif returning == "date":
+                columns = {name: to_dates(days).to_numpy()}
+            else:
+                categories = np.full(len(self), None, dtype=object)
+                categories[rows] = variable.argument(0, "codelist").categorise(
+                    events["code"].to_numpy()
+                )
+                columns = {name: categories}
+            if variable.kwargs.get("include_date_of_match") and returning != "date":
+                columns[f"{name}_date"] = to_dates(days).to_numpy()
+        else:
+            raise ValueError(f"{name}: unsupported returning={returning!r}")
+        return columns
+
+    def registration(self, grid):
+        # Spell of every patient (-1 if none) from a registration grid with
+        # one query
+        spell = np.full(len(self), -1, dtype=np.int64)
+        spell[self.registration_rows] = grid[:, 0]
+        return spell
+
+    def patient_variable(self, name, variable, index_date):
+        # Values of a variable that does not use clinical events
+        method = variable.method
+        if method == "all":
+            return np.ones(len(self), dtype=np.int64)
+        if method == "sex":
+            return self.patients["sex"].astype(object).to_numpy()
+        if method == "age_as_of":
+            date = resolve_date(variable.argument(0, "reference_date"), index_date)
+            later_birthday = self.birth_month_day > date.month * 100 + date.day
+            return (date.year - self.birth_year - later_birthday).astype(np.int64)
+        if method == "died_from_any_cause":
+            start, end = period(variable, index_date)
+            died_on = day_numbers(self.patients["died_on"])
+            died = ~np.isnan(died_on)
+            if start is not None:
+                died &= died_on >= start
+            if end is not None:
+                died &= died_on <= end
+            if variable.kwargs.get("returning", "binary_flag") == "binary_flag":
+                return died.astype(np.int64)
+            return self.patients["died_on"].where(died).to_numpy()
+        if method == "address_as_of":
+            if variable.kwargs.get("returning") != "index_of_multiple_deprivation":
+                raise ValueError(f"{name}: unsupported returning={variable.kwargs.get('returning')!r}")
+            imd = self.patients["imd"].to_numpy(dtype=np.float64)
+            nearest = variable.kwargs.get("round_to_nearest")
+            return np.round(imd / nearest) * nearest if nearest else imd
+        if method == "registered_as_of":
+            date = resolve_date(variable.argument(0, "reference_date"), index_date)
+            return (self.registration(self.registrations.containing([date])) >= 0).astype(np.int64)
+        if method == "registered_with_one_practice_between":
+            start = resolve_date(variable.argument(0, "start_date"), index_date)
+            end = resolve_date(variable.argument(1, "end_date"), index_date)
+            spell = self.registration(self.registrations.covering([start], [end]))
+            return (spell >= 0).astype(np.int64)
+        if method == "registered_practice_as_of":
+            date = resolve_date(variable.argument(0, "date"), index_date)
+            spell = self.registration(self.registrations.containing([date]))
+            returning = variable.kwargs.get("returning")
+            # Position -1 (no spell) selects the last element, as in
+            # registration.py
+            if returning == "nuts1_region_name":
+                return np.append(self.registrations.region, "")[spell]
+            if returning == "pseudo_id":
+                return np.append(self.registrations.practice, 0)[spell].astype(np.int64)
+            raise ValueError(f"{name}: unsupported returning={returning!r}")
+        raise ValueError(f"{name}: unsupported method patients.{method}()")
+
+    def cohort(self, study, index_date, plan=None, trace=None):
+        # DataFrame of the population at one index date
+        variables = flatten(study)
+        if plan is None:
+            plan = study_plan(variables)
+        path = [str(index_date)]
+        values = {"patient_id": self.patient_id}
+
+        events = [(name, v) for name, v, _ in variables if v.method == "with_these_clinical_events"]
+        start_time = time.perf_counter()
+        scanned = self.scan(events, index_date) if events else {}
+        if trace is not None:
+            trace.add(path + ["clinical_events_scan"], time.perf_counter() - start_time, rows=len(self))
+
+        for name, variable, _ in variables:
+            if variable.method in RULE_METHODS:
+                continue
+            start_time = time.perf_counter()
+            if name in scanned:
+                values.update(self.clinical_events(name, variable, *scanned[name]))
+            else:
+                values[name] = self.patient_variable(name, variable, index_date)
+            if trace is not None:
+                seconds = time.perf_counter() - start_time
+                trace.add(path + [name], seconds, rows=len(self), values=values[name])
+
+        # Columns are collected first, so that the DataFrame is built once
+        df = pd.DataFrame(values)
+        df = pd.concat([df, plan.run(df, trace=trace, path=path)], axis=1)
+
+        columns = ["patient_id"]
+        for name, variable, output in variables:
+            if output:
+                columns.append(name)
+                if f"{name}_date" in df and variable.kwargs.get("include_date_of_match"):
+                    columns.append(f"{name}_date")
+        population = df["population"].to_numpy() == 1
+        return df.loc[population, columns].reset_index(drop=True)
+
+
+def study_plan(variables):
+    # One rule engine plan of the population and all satisfying() and
+    # categorised_as() variables
+    return compile_rules(
+        {name: variable.args[0] for name, variable, _ in variables if variable.method in RULE_METHODS}
+    )
+
+
+def generate_cohort(
+    study_definition,
+    index_date_range=None,
+    output_dir="output",
+    output_format="feather",
+    params=None,
+    store=DEFAULT_STORE,
+    trace=None,
+):
+    # Write one cohort per index date, named like the cohortextractor
+    # outputs (input_<name>.<format> or input_<name>_<date>.<format>).
+    # Returns the paths written.
+    study = load_study(study_definition, params)
+    backend = LocalBackend(EventStore(store))
+    plan = study_plan(flatten(study))
+
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    name = study_definition[len("study_definition_") :]
+    paths = []
+    for index_date in index_dates(index_date_range, study.index_date):
+        df = backend.cohort(study, index_date, plan, trace)
+        suffix = f"_{index_date}" if index_date_range else ""
+        path = output_dir / f"input_{name}{suffix}.{output_format}"
+        if output_format == "feather":
+            df.to_feather(path)
+        elif output_format in ("csv", "csv.gz"):
+            df.to_csv(path, index=False)
+        else:
+            raise ValueError(f"Unsupported output format {output_format!r}")
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["generate_cohort"])
+    parser.add_argument("--study-definition", required=True)
+    parser.add_argument("--index-date-range", default=None)
+    parser.add_argument("--output-dir", default="output")
+    parser.add_argument("--output-format", default="feather", choices=["feather", "csv", "csv.gz"])
+    parser.add_argument(
+        "--param",
+        action="append",
+        default=[],
+        help="key=value, available to the study definition as params[key]",
+    )
+    parser.add_argument("--store", default=DEFAULT_STORE)
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="Write the time, rows and cardinality of every variable to logs/ (see tracing.py)",
+    )
+    args = parser.parse_args()
+
+    params = dict(param.split("=", 1) for param in args.param)
+    trace = Trace("local_backend") if args.trace else None
+    paths = generate_cohort(
+        args.study_definition,
+        args.index_date_range,
+        args.output_dir,
+        args.output_format,
+        params,
+        args.store,
+        trace,
+    )
+    for path in paths:
+        print(path)
+    if trace is not None:
+        trace.write()
+        print(trace.format_summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# Run the per index date steps of the scripted actions (joining, rule
+# evaluation, measures) in a pool of worker processes.
+#
+# Index dates are independent, so every monthly file is processed by one
+# worker. The number of workers is limited by --workers (default: number of
+# CPUs) and by the memory budget: each worker is assumed to need
+# MEMORY_PER_INPUT_BYTE times the size of the largest input file, and only as
+# many workers are started as fit into --memory-limit (default: the
+# available memory). Results are returned in input order and output file
+# names do not depend on the number of workers.
+
+import concurrent.futures
+import os
+import pathlib
+import re
+
+# Uncompressed in-memory size relative to the compressed feather file,
+# including intermediate copies
+MEMORY_PER_INPUT_BYTE = 8
+
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def parse_size(value):
+    # Parse sizes such as 512M, 16G or 1000000 (bytes)
+    if value is None:
+        return None
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*", str(value).upper())
+    if match is None:
+        raise ValueError(f"Invalid size: {value}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def available_memory():
+    # MemAvailable on Linux, else the physical memory
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def worker_count(tasks, workers=None, memory_limit=None, memory_per_worker=None):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, tasks))
+    if memory_per_worker:
+        if memory_limit is None:
+            memory_limit = available_memory()
+        if memory_limit is not None:
+            workers = max(1, min(workers, memory_limit // memory_per_worker))
+    return workers
+
+
+def memory_per_file(paths):
+    sizes = [pathlib.Path(path).stat().st_size for path in paths]
+    return MEMORY_PER_INPUT_BYTE * max(sizes, default=0)
+
+
+def parallel_map(
+    function,
+    items,
+    workers=None,
+    memory_limit=None,
+    memory_per_worker=None,
+    initializer=None,
+    initargs=(),
+):
+    # Like map(function, items) but in worker processes. function and items
+    # must be picklable (function must be defined at module level).
+    items = list(items)
+    workers = worker_count(len(items), workers, memory_limit, memory_per_worker)
+
+    if workers == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        return [function(item) for item in items]
+
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, initializer=initializer, initargs=initargs
+    ) as executor:
+        return list(executor.map(function, items))
+
+
+def add_arguments(parser):
+    # Add --workers and --memory-limit to an argparse parser
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--memory-limit",
+        type=parse_size,
+        default=None,
+        help="Memory budget for all workers, e.g. 16G (default: available memory)",
+    )
@@ -0,0 +1,131 @@
+# Mergeable quantile sketches (t-digest) of practice level measures
+#
+# generate_measures.py feeds the practice rates of every date into one
+# sketch per date and measure (i.e., per month and lookback) and writes them
+# next to the measures as sketch_<measure id>.json. The rates are those of
+# the measure file after small number suppression (suppressed practices
+# are left out), as in the deciles calculated from the measure file.
+# Deciles of any subset of months are calculated from the sketches (see deciles_charts.py) without
+# reading the practice rows again, and sketches of several months can be
+# merged, e.g., to calculate deciles over a year.
+#
+# The sketch is a merging t-digest: a sorted list of centroids (mean,
+# weight) that is compressed so that the centroids are small near the
+# tails. With fewer values than the compression, every value is kept and
+# quantiles are exact (linear interpolation, like pandas.Series.quantile).
+
+import json
+import math
+import pathlib
+
+import numpy as np
+
+DEFAULT_COMPRESSION = 200
+
+
+class TDigest:
+    def __init__(self, compression=DEFAULT_COMPRESSION, means=(), weights=()):
+        self.compression = compression
+        self.means = np.asarray(means, dtype=np.float64)
+        self.weights = np.asarray(weights, dtype=np.float64)
+
+    @property
+    def count(self):
+        return float(self.weights.sum())
+
+    def update(self, values, weights=None):
+        # Add values (missing values are ignored)
+        values = np.asarray(values, dtype=np.float64)
+        if weights is None:
+            weights = np.ones(len(values))
+        weights = np.asarray(weights, dtype=np.float64)
+        keep = ~np.isnan(values)
+        self.means = np.concatenate([self.means, values[keep]])
+        self.weights = np.concatenate([self.weights, weights[keep]])
+        self.compress()
+        return self
+
+    def merge(self, other):
+        self.update(other.means, other.weights)
+        return self
+
+    def compress(self):
+        order = np.argsort(self.means, kind="stable")
+        means = self.means[order]
+        weights = self.weights[order]
+        total = weights.sum()
+        if len(means) <= self.compression:
+            self.means, self.weights = means, weights
+            return
+        # Scale function k1: centroid q-ranges shrink towards the tails.
+        # Centroids whose midpoints fall into the same unit of k are merged.
+        midpoint = (np.cumsum(weights) - weights / 2) / total
+        k = self.compression / (2 * math.pi) * np.arcsin(2 * midpoint - 1)
+        cluster = np.floor(k).astype(np.int64)
+        _, cluster = np.unique(cluster, return_inverse=True)
+        cluster_weights = np.bincount(cluster, weights=weights)
+        self.means = np.bincount(cluster, weights=means * weights) / cluster_weights
+        self.weights = cluster_weights
+
+    def quantile(self, q):
+        # Quantile(s) q in [0, 1]. Centroids are placed at the centre of
+        # the ranks they cover and interpolated linearly.
+        q = np.asarray(q, dtype=np.float64)
+        if len(self.means) == 0:
+            return np.full(q.shape, np.nan)
+        rank = np.cumsum(self.weights) - self.weights + (self.weights - 1) / 2
+        return np.interp(q * (self.count - 1), rank, self.means)
+
+    def to_dict(self):
+        return {
+            "compression": self.compression,
+            "means": self.means.tolist(),
+            "weights": self.weights.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["compression"], data["means"], data["weights"])
+
+
+def merge_digests(digests, compression=DEFAULT_COMPRESSION):
+    merged = TDigest(compression)
+    for digest in digests:
+        merged.merge(digest)
+    return merged
+
+
+def rate_digest(df, numerator, denominator, compression=DEFAULT_COMPRESSION):
+    # TDigest of numerator / denominator of every row (rows with a
+    # denominator of 0 are ignored)
+    num = df[numerator].to_numpy(dtype=np.float64, na_value=np.nan)
+    den = df[denominator].to_numpy(dtype=np.float64, na_value=np.nan)
+    keep = den != 0
+    return TDigest(compression).update(num[keep] / den[keep])
+
+
+def sketch_path(output_dir, measure_id):
+    return pathlib.Path(output_dir) / f"sketch_{measure_id}.json"
+
+
+def read_sketches(path):
+    # {date: TDigest} of one measure
+    with open(path) as f:
+        data = json.load(f)
+    return {date: TDigest.from_dict(digest) for date, digest in data["dates"].items()}
+
+
+def write_sketches(path, measure_id, digests, append=False):
+    # Write the sketches of one measure. With append, sketches of dates that
+    # are not in digests are kept.
+    path = pathlib.Path(path)
+    if append and path.exists():
+        digests = dict(read_sketches(path), **digests)
+    data = {
+        "measure_id": measure_id,
+        "dates": {date: digests[date].to_dict() for date in sorted(digests)},
+    }
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    tmp_path.replace(path)
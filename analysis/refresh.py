@@ -0,0 +1,378 @@
+# This script refreshes the BP002 outputs month by month. Every index date
+# between config.start_date and config.end_date is recorded in a manifest
+# (output/refresh/manifest_bp002.json) with the outputs computed for it and the
+# hash of everything that defines a month's cohort: the study definition,
+# the variable dictionaries and rules, the codelists and the config (other
+# than the study period). A rerun only
+# (1) extracts the months that are missing or whose hash has changed (one
+#     cohortextractor call per run of consecutive months, and one for the
+#     latest BP events of these months, see study_definition_bp_events.py)
+#     into a directory of its own (output/refresh/extracts/<start>_<end>),
+#     derives their lookback flags (bp_windows.py) and evaluates their
+#     lookback specific rules (rule_engine.py, output/refresh/rules),
+# (2) joins ethnicity to these months, replacing their partitions of the
+#     joined dataset (output/refresh/joined/bp002, see join_ethnicity.py), and
+# (3) calculates their measures and updates the measure files, the long
+#     measures file and the sketches in place (generate_measures.py
+#     --index-dates --append).
+# When config.end_date moves forward by a month, a refresh costs one month
+# of work. Measures of all months are recalculated from the joined dataset
+# (without extracting) if the measure definitions change or months drop
+# out of the study period. --rejoin joins (and measures) all months again,
+# e.g., after the ethnicity cohort was updated (see ethnicity_state.py).
+#
+# The deciles tables (deciles_charts.py) and the released measures
+# (disclosure.py) are derived from the updated outputs and are cheap to
+# rerun.
+#
+# All outputs are written below output/refresh. The refresh never writes
+# into the directories of the declared outputs of the project.yaml actions
+# (e.g., output/input_bp_events.feather of
+# generate_study_population_bp_events): an extraction of a few months there
+# would replace the full extraction that later actions read.
+#
+# Usage:
+#   python analysis/refresh.py            # refresh
+#   python analysis/refresh.py --dry-run  # list the months that would be computed
+
+import argparse
+import fnmatch
+import json
+import os
+import pathlib
+import shlex
+import shutil
+import subprocess
+
+import config
+from generate_measures import generate_measures
+from bp_windows import write_windows
+from join_ethnicity import join_files
+from parallel import add_arguments as add_parallel_arguments
+from rule_engine import evaluate_files
+from run_project import DEFAULT_PROJECT, load_actions
+from utils import add_months, content_hash, month_starts, to_date
+
+ANALYSIS_DIR = pathlib.Path(__file__).parent
+ROOT_DIR = ANALYSIS_DIR.parent
+
+# Files that define the monthly cohorts
+COHORT_DEFINITIONS = [
+    ANALYSIS_DIR / "study_definition_bp002.py",
+    ANALYSIS_DIR / "study_definition_bp_events.py",
+    ANALYSIS_DIR / "bp_windows.py",
+    ANALYSIS_DIR / "rule_engine.py",
+    ANALYSIS_DIR / "dict_bp_variables.py",
+    ANALYSIS_DIR / "dict_demographic_variables.py",
+    ANALYSIS_DIR / "bp002_rules.py",
+    ANALYSIS_DIR / "codelists_bp.py",
+    ANALYSIS_DIR / "codelists_demographic.py",
+    ROOT_DIR / "codelists" / "codelists.json",
+]
+# Files that define the measures
+MEASURE_DEFINITIONS = [
+    ANALYSIS_DIR / "bp002_measures.py",
+    ANALYSIS_DIR / "generate_measures.py",
+    ANALYSIS_DIR / "disclosure.py",
+]
+# The study period selects the months, it does not change them
+PERIOD_SETTINGS = ["start_date", "end_date"]
+
+DEFAULT_DIR = "output/refresh"
+DEFAULT_MANIFEST = f"{DEFAULT_DIR}/manifest_bp002.json"
+DEFAULT_EXTRACT_COMMAND = (
+    "cohortextractor generate_cohort --study-definition study_definition_bp002 "
+    '--index-date-range "{start} to {end} by month" '
+    "--output-dir={output_dir} --output-format=feather"
+)
+DEFAULT_EVENTS_COMMAND = (
+    "cohortextractor generate_cohort --study-definition study_definition_bp_events "
+    "--param start_date={start} --param end_date={end} "
+    "--output-dir={output_dir} --output-format=feather"
+)
+
+
+def config_settings():
+    # Settings of config.py (other than the study period) as JSON
+    settings = {
+        name: value
+        for name, value in vars(config).items()
+        if not name.startswith("_")
+        and name not in PERIOD_SETTINGS
+        and isinstance(value, (str, int, float, list, dict))
+    }
+    return json.dumps(settings, sort_keys=True)
+
+
+def cohort_hash():
+    codelist_files = sorted((ROOT_DIR / "codelists").glob("*.csv"))
+    return content_hash(COHORT_DEFINITIONS + codelist_files, extra=config_settings())
+
+
+def measures_hash():
+    return content_hash(MEASURE_DEFINITIONS, extra=config_settings())
+
+
+def month_runs(index_dates):
+    # Runs of consecutive months as (first, last) index dates
+    runs = []
+    for index_date in sorted(index_dates):
+        if runs and add_months(runs[-1][1], 1).isoformat() == index_date:
+            runs[-1][1] = index_date
+        else:
+            runs.append([index_date, index_date])
+    return [tuple(run) for run in runs]
+
+
+class Manifest:
+    def __init__(self, path=DEFAULT_MANIFEST):
+        self.path = pathlib.Path(path)
+        self.months = {}
+        if self.path.exists():
+            with open(self.path) as f:
+                self.months = json.load(f)["months"]
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"months": dict(sorted(self.months.items()))}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def entry(self, index_date):
+        return self.months.setdefault(index_date, {})
+
+    def extracted(self, index_date, key):
+        entry = self.months.get(index_date, {})
+        return entry.get("key") == key and os.path.exists(entry.get("cohort", ""))
+
+    def joined(self, index_date):
+        entry = self.months.get(index_date, {})
+        paths = entry.get("joined")
+        return bool(paths) and all(os.path.exists(path) for path in paths)
+
+    def measured(self, index_date, key):
+        return self.months.get(index_date, {}).get("measures_key") == key
+
+
+class Plan:
+    # Months to extract, join and measure
+
+    def __init__(self, manifest, index_dates, cohort_key, measure_key, rejoin=False):
+        self.index_dates = index_dates
+        self.removed = sorted(set(manifest.months) - set(index_dates))
+        self.extract = [d for d in index_dates if not manifest.extracted(d, cohort_key)]
+        self.join = [
+            d for d in index_dates if rejoin or d in self.extract or not manifest.joined(d)
+        ]
+        measures_changed = any(
+            manifest.months.get(d, {}).get("measures_key") not in (None, measure_key)
+            for d in index_dates
+        )
+        if self.removed or measures_changed:
+            # Measure definitions changed or months were removed: rewrite
+            # the measure outputs from all months
+            self.measure = list(index_dates)
+            self.append = False
+        else:
+            self.measure = [
+                d for d in index_dates if d in self.join or not manifest.measured(d, measure_key)
+            ]
+            self.append = True
+
+    def describe(self):
+        lines = []
+        for name in ["removed", "extract", "join", "measure"]:
+            months = getattr(self, name)
+            runs = ", ".join(f"{a} to {b}" if a != b else a for a, b in month_runs(months))
+            lines.append(f"{name}: {len(months)} months{' (' + runs + ')' if runs else ''}")
+        return "\n".join(lines)
+
+
+def check_output_dirs(directories, project=DEFAULT_PROJECT):
+    # Raise a ValueError if declared outputs of project.yaml actions lie in
+    # any of the directories (or below them)
+    project_dir = pathlib.Path(project).resolve().parent
+    declared = [
+        (action.name, pathlib.PurePosixPath(pattern).parent.parts)
+        for action in load_actions(project).values()
+        for pattern in action.outputs
+    ]
+    for directory in directories:
+        relative = os.path.relpath(pathlib.Path(directory).resolve(), project_dir)
+        parts = pathlib.PurePosixPath(pathlib.Path(relative).as_posix()).parts
+        for name, pattern_parts in declared:
+            if len(pattern_parts) >= len(parts) and all(
+                fnmatch.fnmatchcase(part, pattern) for part, pattern in zip(parts, pattern_parts)
+            ):
+                raise ValueError(
+                    f"{directory} contains outputs of the action {name}, "
+                    "write the refresh outputs to another directory"
+                )
+
+
+def extract(command, start, end, output_dir):
+    arguments = [
+        argument.format(start=start, end=end, output_dir=output_dir)
+        for argument in shlex.split(command)
+    ]
+    print(" ".join(shlex.quote(argument) for argument in arguments), flush=True)
+    subprocess.run(arguments, check=True)
+
+
+def refresh(
+    manifest_path=DEFAULT_MANIFEST,
+    start_date=config.start_date,
+    end_date=config.end_date,
+    cohort_dir=f"{DEFAULT_DIR}/extracts",
+    ethnicity="output/input_ethnicity.feather",
+    dataset_dir=f"{DEFAULT_DIR}/joined/bp002",
+    measures_dir=f"{DEFAULT_DIR}/joined",
+    long_output=f"{DEFAULT_DIR}/joined/measures_bp002_achievem_long.csv",
+    extract_command=DEFAULT_EXTRACT_COMMAND,
+    rejoin=False,
+    dry_run=False,
+    workers=None,
+    memory_limit=None,
+    events_command=DEFAULT_EVENTS_COMMAND,
+    bp_windows_dir=f"{DEFAULT_DIR}/bp_windows",
+    rules_dir=f"{DEFAULT_DIR}/rules",
+):
+    check_output_dirs(
+        [
+            pathlib.Path(manifest_path).parent,
+            cohort_dir,
+            dataset_dir,
+            measures_dir,
+            pathlib.Path(long_output).parent,
+            bp_windows_dir,
+            rules_dir,
+        ]
+    )
+    manifest = Manifest(manifest_path)
+    index_dates = [date.isoformat() for date in month_starts(start_date, end_date)]
+    cohort_key = cohort_hash()
+    measure_key = measures_hash()
+    plan = Plan(manifest, index_dates, cohort_key, measure_key, rejoin)
+    print(plan.describe())
+    if dry_run:
+        return plan
+
+    # Months no longer in the study period
+    for index_date in plan.removed:
+        for path in manifest.months.pop(index_date).get("joined", []):
+            shutil.rmtree(pathlib.Path(path).parent, ignore_errors=True)
+    manifest.save()
+
+    # (1) extract, derive the lookback flags and evaluate the rules
+    for start, end in month_runs(plan.extract):
+        # Every run of months is extracted into a directory of its own
+        run_dir = pathlib.Path(cohort_dir) / f"{start}_{end}"
+        shutil.rmtree(run_dir, ignore_errors=True)
+        run_dir.mkdir(parents=True)
+        extract(extract_command, start, end, run_dir)
+        extract(events_command, start, end, run_dir)
+        write_windows(run_dir / "input_bp_events.feather", bp_windows_dir)
+        months = [index_date.isoformat() for index_date in month_starts(start, end)]
+        cohorts = [run_dir / f"input_bp002_{index_date}.feather" for index_date in months]
+        evaluate_files(
+            cohorts,
+            rules_dir,
+            bp_windows_dir=bp_windows_dir,
+            workers=workers,
+            memory_limit=memory_limit,
+        )
+        for index_date in months:
+            entry = manifest.entry(index_date)
+            entry.clear()
+            entry["key"] = cohort_key
+            entry["cohort"] = str(pathlib.Path(rules_dir) / f"input_bp002_{index_date}.feather")
+        manifest.save()
+
+    # (2) join ethnicity
+    if plan.join:
+        cohorts = [manifest.months[d]["cohort"] for d in plan.join]
+        joined = join_files(
+            cohorts, ethnicity, dataset_dir, workers, memory_limit, output_format="parquet"
+        )
+        for index_date, paths in zip(plan.join, joined):
+            entry = manifest.entry(index_date)
+            entry["joined"] = [str(path) for path in paths]
+            entry.pop("measures_key", None)
+        manifest.save()
+
+    # (3) measures
+    if plan.measure:
+        generate_measures(
+            [],
+            measures_dir,
+            workers=workers,
+            memory_limit=memory_limit,
+            input_dataset=dataset_dir,
+            long_output=long_output,
+            append=plan.append,
+            index_dates=plan.measure,
+        )
+        for index_date in plan.measure:
+            manifest.entry(index_date)["measures_key"] = measure_key
+        manifest.save()
+    return plan
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--manifest", default=DEFAULT_MANIFEST)
+    parser.add_argument("--start-date", default=config.start_date)
+    parser.add_argument("--end-date", default=config.end_date)
+    parser.add_argument(
+        "--cohort-dir",
+        default=f"{DEFAULT_DIR}/extracts",
+        help="Directory of the extracted cohorts (one subdirectory per run of months)",
+    )
+    parser.add_argument("--ethnicity", default="output/input_ethnicity.feather")
+    parser.add_argument("--dataset-dir", default=f"{DEFAULT_DIR}/joined/bp002")
+    parser.add_argument("--measures-dir", default=f"{DEFAULT_DIR}/joined")
+    parser.add_argument(
+        "--long-output", default=f"{DEFAULT_DIR}/joined/measures_bp002_achievem_long.csv"
+    )
+    parser.add_argument(
+        "--extract-command",
+        default=DEFAULT_EXTRACT_COMMAND,
+        help="Command that extracts the months {start} to {end} into {output_dir}",
+    )
+    parser.add_argument(
+        "--events-command",
+        default=DEFAULT_EVENTS_COMMAND,
+        help="Command that extracts the latest BP events of the months {start} to {end}",
+    )
+    parser.add_argument("--bp-windows-dir", default=f"{DEFAULT_DIR}/bp_windows")
+    parser.add_argument(
+        "--rules-dir", default=f"{DEFAULT_DIR}/rules", help="Directory of the evaluated cohorts"
+    )
+    parser.add_argument("--rejoin", action="store_true", help="Join and measure all months again")
+    parser.add_argument("--dry-run", action="store_true")
+    add_parallel_arguments(parser)
+    args = parser.parse_args()
+
+    refresh(
+        args.manifest,
+        to_date(args.start_date),
+        to_date(args.end_date),
+        args.cohort_dir,
+        args.ethnicity,
+        args.dataset_dir,
+        args.measures_dir,
+        args.long_output,
+        args.extract_command,
+        args.rejoin,
+        args.dry_run,
+        args.workers,
+        args.memory_limit,
+        args.events_command,
+        args.bp_windows_dir,
+        args.rules_dir,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+# This script derives the registration variables of every index date from
+# the registration spells of all patients (one row per spell: patient_id,
+# start_date, end_date, practice, region; end_date is missing for current
+# registrations), instead of querying the registrations again for every
+# index date:
+# (1) load all spells once into an interval index (spells sorted by patient
+#     and start date, dates as day numbers)
+# (2) answer each query for all index dates at once: every spell is mapped
+#     to the range of index dates it answers (np.searchsorted on the sorted
+#     query dates) and the ranges are expanded into a patients x index dates
+#     grid
+#     - gms_reg_status: a spell contains last_day_of_month(index_date)
+#       (patients.registered_as_of)
+#     - reg_dat_3m: one spell covers index_date - 3 months to index_date
+#       (patients.registered_with_one_practice_between)
+#     - practice and region: the spell containing last_day_of_month(index_date),
+#       the latest starting one if there are several
+#       (patients.registered_practice_as_of)
+# (3) write one file per index date (input_registration_<date>.feather) that
+#     rule_engine.py --registration-dir merges into the monthly cohorts
+#
+# Unregistered patients have practice 0 and an empty region, as in the
+# extractions.
+#
+# The spells are written by dummy_data.py and read by local_backend.py. No
+# action of project.yaml extracts them, so the actions still query
+# gms_reg_status and reg_dat_3m in the study definitions for every index
+# date.
+
+import argparse
+import pathlib
+import time
+
+import numpy as np
+import pandas as pd
+
+from config import end_date, start_date
+from tracing import Trace
+from utils import add_months, last_day_of_month, month_starts
+
+REGISTRATION_VARIABLES = ["gms_reg_status", "reg_dat_3m", "practice", "region"]
+
+# Index dates per query grid (patients x index dates)
+BLOCK_SIZE = 12
+
+# Open spells end after any query date
+OPEN_END = np.iinfo(np.int64).max
+
+
+def day_numbers(dates):
+    # Days since 1970-01-01, missing dates are OPEN_END
+    days = pd.to_datetime(pd.Series(dates)).to_numpy().astype("datetime64[D]")
+    missing = np.isnat(days)
+    days = days.astype(np.int64)
+    days[missing] = OPEN_END
+    return days
+
+
+class RegistrationIndex:
+    def __init__(self, spells):
+        spells = spells.sort_values(["patient_id", "start_date"], kind="stable")
+        self.patient_id, self.row = np.unique(spells["patient_id"].to_numpy(), return_inverse=True)
+        self.start = day_numbers(spells["start_date"])
+        self.end = day_numbers(spells["end_date"])
+        self.practice = spells["practice"].to_numpy()
+        self.region = spells["region"].astype(object).to_numpy()
+
+    def __len__(self):
+        return len(self.start)
+
+    def expand(self, first, last):
+        # (spell, query) pairs for the query ranges first to last (inclusive)
+        # of every spell
+        lengths = np.maximum(last - first + 1, 0)
+        spell = np.repeat(np.arange(len(lengths)), lengths)
+        offsets = np.cumsum(lengths) - lengths
+        query = first[spell] + np.arange(len(spell)) - offsets[spell]
+        return spell, query
+
+    def grid(self, spell, query, n_queries):
+        # Latest starting spell of every patient and query (-1 if none);
+        # spells are sorted by start date within a patient
+        grid = np.full(len(self.patient_id) * n_queries, -1, dtype=np.int32)
+        np.maximum.at(grid, self.row[spell] * n_queries + query, spell.astype(np.int32))
+        return grid.reshape(len(self.patient_id), n_queries)
+
+    def containing(self, dates):
+        # Spell containing each of the (sorted) dates
+        days = day_numbers(dates)
+        first = np.searchsorted(days, self.start, side="left")
+        last = np.searchsorted(days, self.end, side="right") - 1
+        return self.grid(*self.expand(first, last), len(days))
+
+    def covering(self, starts, ends):
+        # Spell covering each of the (sorted) periods starts to ends
+        starts = day_numbers(starts)
+        ends = day_numbers(ends)
+        first = np.searchsorted(starts, self.start, side="left")
+        last = np.searchsorted(ends, self.end, side="right") - 1
+        return self.grid(*self.expand(first, last), len(starts))
+
+
+def registration_variables(spells, index_dates=None, block_size=BLOCK_SIZE, trace=None):
+    # Yield (index_date, DataFrame) with the registration variables of all
+    # patients with a spell. Index dates are queried in blocks of
+    # block_size to bound the size of the grids. With a trace (see
+    # tracing.py), one span per index date and variable is recorded; the
+    # time of a query is shared by the index dates of its block.
+    if index_dates is None:
+        index_dates = month_starts(start_date, end_date)
+    index = RegistrationIndex(spells)
+    # Position -1 (no spell) selects the last element
+    practice = np.append(index.practice, 0)
+    region = np.append(index.region, "")
+
+    for first in range(0, len(index_dates), block_size):
+        block = index_dates[first : first + block_size]
+        start_time = time.perf_counter()
+        as_of = index.containing([last_day_of_month(date) for date in block])
+        as_of_seconds = (time.perf_counter() - start_time) / len(block)
+        start_time = time.perf_counter()
+        one_practice = index.covering([add_months(date, -3) for date in block], block)
+        one_practice_seconds = (time.perf_counter() - start_time) / len(block)
+        for position, index_date in enumerate(block):
+            spell = as_of[:, position]
+            df = pd.DataFrame({"patient_id": index.patient_id})
+            seconds = {"gms_reg_status": as_of_seconds, "reg_dat_3m": one_practice_seconds}
+            for name, values in [
+                ("gms_reg_status", lambda: (spell >= 0).astype(np.int64)),
+                ("reg_dat_3m", lambda: (one_practice[:, position] >= 0).astype(np.int64)),
+                ("practice", lambda: practice[spell]),
+                ("region", lambda: region[spell]),
+            ]:
+                start_time = time.perf_counter()
+                df[name] = values()
+                if trace is not None:
+                    trace.add(
+                        [str(index_date), name],
+                        seconds.get(name, 0) + time.perf_counter() - start_time,
+                        rows=len(index),
+                        values=df[name].to_numpy(),
+                    )
+            yield index_date, df
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="output/input_registration_spells.feather")
+    parser.add_argument("--output-dir", default="output/registration")
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="Write the time, rows and cardinality of every variable to logs/ (see tracing.py)",
+    )
+    args = parser.parse_args()
+
+    output_dir = pathlib.Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    trace = Trace("registration") if args.trace else None
+    spells = pd.read_feather(args.input)
+    for index_date, df in registration_variables(spells, trace=trace):
+        df.to_feather(output_dir / f"input_registration_{index_date}.feather")
+    if trace is not None:
+        trace.write()
+        print(trace.format_summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,777 @@
+# This script evaluates the BP002 business rules (see bp002_rules.py) locally
+# with numpy instead of re-extracting them with cohortextractor:
+# (1) parse the `patients.satisfying()` expressions and compile them into one
+#     plan in which identical subterms are shared (see Plan)
+# (2) evaluate each subterm once as a vectorised boolean mask over the
+#     columns of an extracted cohort (e.g., output/input_bp002_2019-03-01.feather)
+# (3) write the cohort with the rule variables recomputed, with the bp_rec_*
+#     and bp_dec_* flags from analysis/bp_windows.py (the extractions do not
+#     include them, see study_definition_bp002.py)
+#
+# The rule variables are returned as 0/1 integers, like cohortextractor.
+# Use --check to compare the recomputed rules with the extracted ones and
+# --show-plan to inspect the compiled plan.
+#
+# Cohorts that do not fit into --memory-limit (one per worker) are evaluated
+# in batches of rows (see batches.py); the bp_windows and registration files
+# are then merged batch by batch and must be sorted by patient_id, like the
+# extractions and the files written by bp_windows.py and registration.py.
+
+import argparse
+import ast
+import functools
+import pathlib
+import re
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from config import lookback_years
+from batches import BatchWriter, SortedReader, batch_plan, read_batches
+from bp002_rules import bp002_rules, bp002_shared_rules
+from parallel import add_arguments as add_parallel_arguments
+from parallel import parallel_map
+from tracing import Trace
+from utils import expand_paths, index_date_from_path
+
+TOKEN_PATTERN = re.compile(
+    r"""
+    \s*(?:
+        (?P<number>\d+(?:\.\d*)?)
+        |(?P<string>'[^']*'|"[^"]*")
+        |(?P<name>[A-Za-z_][A-Za-z0-9_]*)
+        |(?P<operator><=|>=|!=|=|<|>|\*|/|\+|-|\(|\))
+    )""",
+    re.VERBOSE,
+)
+
+KEYWORDS = {"AND", "OR", "NOT"}
+
+
+class ExpressionError(Exception):
+    pass
+
+
+def tokenize(expression):
+    # Comments start with # and run to the end of the line
+    expression = "\n".join(line.split("#")[0] for line in expression.splitlines())
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = TOKEN_PATTERN.match(expression, position)
+        if match is None or match.end() == position:
+            raise ExpressionError(
+                f"Unexpected character {expression[position:].strip()[:1]!r} "
+                f"in expression: {expression.strip()}"
+            )
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "number":
+            tokens.append(("const", float(value) if "." in value else int(value)))
+        elif kind == "string":
+            tokens.append(("const", value[1:-1]))
+        elif kind == "name" and value.upper() in KEYWORDS:
+            tokens.append(("keyword", value.upper()))
+        else:
+            tokens.append((kind, value))
+    return tokens
+
+
+class Parser:
+    # Recursive descent parser, from lowest to highest precedence:
+    # OR, AND, NOT, comparisons, + and -, * and /
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = tokenize(expression)
+        self.position = 0
+
+    def parse(self):
+        if not self.tokens:
+            raise ExpressionError("Empty expression")
+        node = self.parse_or()
+        if self.position != len(self.tokens):
+            self.error(f"unexpected {self.tokens[self.position][1]!r}")
+        return node
+
+    def error(self, message):
+        raise ExpressionError(f"Invalid expression ({message}): {self.expression.strip()}")
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def take(self, kind, value=None):
+        token = self.peek()
+        if token[0] == kind and (value is None or token[1] == value):
+            self.position += 1
+            return token
+        return None
+
+    def parse_or(self):
+        node = self.parse_and()
+        while self.take("keyword", "OR"):
+            node = ("or", node, self.parse_and())
+        return node
+
+    def parse_and(self):
+        node = self.parse_not()
+        while self.take("keyword", "AND"):
+            node = ("and", node, self.parse_not())
+        return node
+
+    def parse_not(self):
+        if self.take("keyword", "NOT"):
+            return ("not", self.parse_not())
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        node = self.parse_sum()
+        token = self.peek()
+        if token[0] == "operator" and token[1] in ("=", "!=", "<", "<=", ">", ">="):
+            self.position += 1
+            node = ("compare", token[1], node, self.parse_sum())
+        return node
+
+    def parse_sum(self):
+        node = self.parse_product()
+        while True:
+            token = self.take("operator", "+") or self.take("operator", "-")
+            if token is None:
+                return node
+            node = ("arithmetic", token[1], node, self.parse_product())
+
+    def parse_product(self):
+        node = self.parse_atom()
+        while True:
+            token = self.take("operator", "*") or self.take("operator", "/")
+            if token is None:
+                return node
+            node = ("arithmetic", token[1], node, self.parse_atom())
+
+    def parse_atom(self):
+        if self.take("operator", "("):
+            node = self.parse_or()
+            if not self.take("operator", ")"):
+                self.error("missing closing parenthesis")
+            return node
+        if self.take("operator", "-"):
+            return ("arithmetic", "-", ("const", 0), self.parse_atom())
+        token = self.take("const") or self.take("name")
+        if token is None:
+            self.error("expected a variable or a value")
+        return token
+
+
+def parse(expression):
+    return Parser(expression).parse()
+
+
+def truthy(values):
+    # A variable used as a condition is true if it is set and not 0
+    values = np.asarray(values)
+    if values.dtype == bool:
+        return values
+    if values.dtype.kind in "iu":
+        return values != 0
+    if values.dtype.kind == "f":
+        return ~np.isnan(values) & (values != 0)
+    return pd.notna(values) & (values != "") & (values != 0)
+
+
+COMPARISONS = {
+    "=": np.equal,
+    "!=": np.not_equal,
+    "<": np.less,
+    "<=": np.less_equal,
+    ">": np.greater,
+    ">=": np.greater_equal,
+}
+
+
+def divide(left, right):
+    # Division of integers truncates, as in the SQL generated by
+    # cohortextractor (e.g., 32844*1/5 is 6568)
+    if np.asarray(left).dtype.kind in "iu" and np.asarray(right).dtype.kind in "iu":
+        return np.trunc(np.true_divide(left, right)).astype(np.int64)
+    return np.true_divide(left, right)
+
+
+ARITHMETIC = {
+    "+": np.add,
+    "-": np.subtract,
+    "*": np.multiply,
+    "/": divide,
+}
+
+
+def compare(operator, left, right):
+    left = np.asarray(left)
+    right = np.asarray(right)
+    # Comparisons with missing values are false (as in SQL)
+    missing = pd.isna(left) | pd.isna(right)
+    if left.dtype == object or right.dtype == object:
+        left = left.astype(object)
+        right = right.astype(object)
+    with np.errstate(invalid="ignore"):
+        result = COMPARISONS[operator](left, right)
+    return np.asarray(result, dtype=bool) & ~missing
+
+
+BOOLEAN_NODES = {"truth", "not", "and", "or", "compare"}
+COMMUTATIVE_NODES = {"and", "or"}
+
+
+class Plan:
+    # Shared DAG of the compiled expressions. Every node is a tuple of
+    # (kind, value, children) and identical nodes are only stored once, so
+    # a subterm used by several variables (e.g., age >= 45 or
+    # bp002_denominator_r1) is evaluated once and its mask is reused.
+    # Children are always stored before their parents.
+
+    def __init__(self):
+        self.nodes = []
+        self.index = {}
+        self.outputs = {}
+
+    def add(self, kind, value=None, children=()):
+        if kind in COMMUTATIVE_NODES:
+            children = sorted(children)
+        key = (kind, value, tuple(children))
+        if key not in self.index:
+            self.index[key] = len(self.nodes)
+            self.nodes.append(key)
+        return self.index[key]
+
+    def references(self):
+        # Number of parents (and output variables) using each node
+        counts = [0] * len(self.nodes)
+        for _, _, children in self.nodes:
+            for child in children:
+                counts[child] += 1
+        for node in self.outputs.values():
+            counts[node] += 1
+        return counts
+
+    def stats(self):
+        # expanded_terms is the number of terms that are evaluated if every
+        # variable is evaluated on its own, with references to other
+        # variables expanded; unique_nodes is what the plan evaluates
+        sizes = []
+        for _, _, children in self.nodes:
+            sizes.append(1 + sum(sizes[child] for child in children))
+        expanded_terms = sum(sizes[node] for node in self.outputs.values())
+        return {
+            "variables": len(self.outputs),
+            "expanded_terms": expanded_terms,
+            "unique_nodes": len(self.nodes),
+            "shared_nodes": sum(count > 1 for count in self.references()),
+            "evaluations_saved": expanded_terms - len(self.nodes),
+        }
+
+    def render(self, node):
+        kind, value, children = self.nodes[node]
+        if kind == "column":
+            return value
+        if kind == "const":
+            return repr(value)
+        if kind == "truth":
+            return f"bool({self.label(children[0])})"
+        if kind == "not":
+            return f"NOT {self.label(children[0])}"
+        if kind in ("and", "or"):
+            return f" {kind.upper()} ".join(self.label(child) for child in children)
+        if kind in ("compare", "arithmetic"):
+            return f"{self.label(children[0])} {value} {self.label(children[1])}"
+        if kind == "categorise":
+            categories, default = value
+            cases = ", ".join(
+                f"{category!r}: {self.label(child)}"
+                for category, child in zip(categories, children)
+            )
+            return f"categorise({cases}, default={default!r})"
+        raise ExpressionError(f"Unknown node {kind!r}")
+
+    def label(self, node):
+        kind, value, _ = self.nodes[node]
+        if kind in ("column", "const"):
+            return self.render(node)
+        return f"n{node}"
+
+    def describe(self):
+        stats = self.stats()
+        references = self.references()
+        names = {}
+        for name, node in self.outputs.items():
+            names.setdefault(node, []).append(name)
+        lines = [
+            f"{stats['variables']} variables, {stats['expanded_terms']} expression terms "
+            f"compiled to {stats['unique_nodes']} unique nodes "
+            f"({stats['evaluations_saved']} evaluations saved, "
+            f"{stats['shared_nodes']} nodes shared)"
+        ]
+        for node in range(len(self.nodes)):
+            line = f"n{node:<4} uses={references[node]:<3} {self.render(node)}"
+            if node in names:
+                line += f"  -> {', '.join(names[node])}"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def owners(self):
+        # Output variable of every node: the first variable (in output order)
+        # that uses it, shared nodes are only counted once
+        owners = [None] * len(self.nodes)
+        for name, root in self.outputs.items():
+            stack = [root]
+            while stack:
+                node = stack.pop()
+                if owners[node] is None:
+                    owners[node] = name
+                    stack.extend(self.nodes[node][2])
+        return owners
+
+    def run(self, df, trace=None, path=()):
+        # Evaluate every node once, in order, and drop cached masks after
+        # their last use. Returns a DataFrame with one column per variable.
+        # With a trace (see tracing.py), the time of every node is added to
+        # the variable that owns it and one span per variable is recorded.
+        seconds = [0.0] * len(self.nodes)
+        last_use = {}
+        for node, (_, _, children) in enumerate(self.nodes):
+            for child in children:
+                last_use[child] = node
+        keep = set(self.outputs.values())
+
+        values = {}
+        for node, (kind, value, children) in enumerate(self.nodes):
+            start = time.perf_counter()
+            args = [values[child] for child in children]
+            if kind == "column":
+                if value not in df.columns:
+                    raise ExpressionError(f"Unknown variable {value!r}")
+                result = df[value].to_numpy()
+            elif kind == "const":
+                result = value
+            elif kind == "truth":
+                result = truthy(args[0])
+            elif kind == "not":
+                result = ~args[0]
+            elif kind == "and":
+                result = args[0] & args[1]
+            elif kind == "or":
+                result = args[0] | args[1]
+            elif kind == "compare":
+                result = compare(value, args[0], args[1])
+            elif kind == "arithmetic":
+                result = ARITHMETIC[value](args[0], args[1])
+            elif kind == "categorise":
+                categories, default = value
+                result = np.select(
+                    args, np.asarray(categories, dtype=object), default=default
+                )
+                result = result.astype(object)
+            else:
+                raise ExpressionError(f"Unknown node {kind!r}")
+            values[node] = result
+            seconds[node] = time.perf_counter() - start
+
+            for child in children:
+                if last_use[child] == node and child not in keep:
+                    del values[child]
+
+        columns = {}
+        for name, node in self.outputs.items():
+            result = values[node]
+            if self.nodes[node][0] == "categorise":
+                columns[name] = result
+            else:
+                columns[name] = np.broadcast_to(result, len(df)).astype(np.int64)
+
+        if trace is not None:
+            totals = dict.fromkeys(self.outputs, 0.0)
+            for node, owner in enumerate(self.owners()):
+                if owner is not None:
+                    totals[owner] += seconds[node]
+            for name in self.outputs:
+                trace.add(list(path) + [name], totals[name], rows=len(df), values=columns[name])
+        return pd.DataFrame(columns, index=df.index)
+
+
+def constant_value(tree):
+    # Return the value of an expression that only uses constants, else None
+    if tree[0] == "const":
+        return tree[1]
+    if tree[0] != "arithmetic":
+        return None
+    left = constant_value(tree[2])
+    right = constant_value(tree[3])
+    if left is None or right is None:
+        return None
+    return ARITHMETIC[tree[1]](left, right).item()
+
+
+def compile_rules(rules):
+    # Compile {variable name: expression} into a Plan. Categorical variables
+    # (`patients.categorised_as()`) are given as {category: expression}
+    # with one "DEFAULT" category. Rules may refer to input columns and to
+    # other rules (in any order); references to rules are expanded so that
+    # identical subterms are shared across variables.
+    plan = Plan()
+    compiled = {}
+    in_progress = set()
+
+    def compile_variable(name):
+        if name in compiled:
+            return compiled[name]
+        if name not in rules:
+            return plan.add("column", name)
+        if name in in_progress:
+            raise ExpressionError(f"Circular reference to {name!r}")
+        in_progress.add(name)
+        definition = rules[name]
+        if isinstance(definition, dict):
+            categories = []
+            children = []
+            default = None
+            for category, expression in definition.items():
+                if expression.strip() == "DEFAULT":
+                    default = category
+                    continue
+                categories.append(category)
+                children.append(condition(parse(expression)))
+            node = plan.add("categorise", (tuple(categories), default), children)
+        else:
+            node = condition(parse(definition))
+        in_progress.discard(name)
+        compiled[name] = node
+        return node
+
+    def condition(tree):
+        node = compile_node(tree)
+        if plan.nodes[node][0] in BOOLEAN_NODES:
+            return node
+        return plan.add("truth", children=[node])
+
+    def compile_node(tree):
+        kind = tree[0]
+        if kind == "const":
+            return plan.add("const", tree[1])
+        if kind == "name":
+            return compile_variable(tree[1])
+        if kind == "not":
+            child = condition(tree[1])
+            child_kind, _, grandchildren = plan.nodes[child]
+            if child_kind == "not":
+                return grandchildren[0]
+            return plan.add("not", children=[child])
+        if kind in ("and", "or"):
+            return plan.add(kind, children=[condition(tree[1]), condition(tree[2])])
+        if kind == "compare":
+            return plan.add(
+                "compare", tree[1], [compile_node(tree[2]), compile_node(tree[3])]
+            )
+        if kind == "arithmetic":
+            value = constant_value(tree)
+            if value is not None:
+                # Fold constants, e.g., 32844*1/5
+                return plan.add("const", value)
+            return plan.add(
+                "arithmetic", tree[1], [compile_node(tree[2]), compile_node(tree[3])]
+            )
+        raise ExpressionError(f"Unknown node {kind!r}")
+
+    for name in rules:
+        plan.outputs[name] = compile_variable(name)
+    return plan
+
+
+def evaluate_rules(df, rules):
+    # Evaluate {variable name: expression} over the columns of df.
+    # Returns a DataFrame with one 0/1 column per rule (or one category
+    # column per categorical variable).
+    return compile_rules(rules).run(df)
+
+
+def read_variable_expressions(path):
+    # Read the `patients.satisfying()` and `patients.categorised_as()`
+    # expressions of a variable dictionary or study definition without
+    # importing cohortextractor, e.g., age_band and imd_q5 from
+    # dict_demographic_variables.py
+    tree = ast.parse(pathlib.Path(path).read_text())
+    expressions = {}
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        for keyword in node.keywords:
+            value = keyword.value
+            if not (
+                isinstance(value, ast.Call)
+                and isinstance(value.func, ast.Attribute)
+                and value.args
+            ):
+                continue
+            if value.func.attr == "satisfying":
+                expressions[keyword.arg] = ast.literal_eval(value.args[0])
+            elif value.func.attr == "categorised_as":
+                expressions[keyword.arg] = ast.literal_eval(value.args[0])
+    return expressions
+
+
+def bp002_engine_rules(lookbacks=None, combined=True):
+    # BP002 rules of all lookbacks, the shared rules as extracted by
+    # study_definition_bp002.py
+    if lookbacks is None:
+        lookbacks = list(lookback_years)
+    if not combined:
+        (lookback,) = lookbacks
+        return bp002_rules(lookback)
+    rules = bp002_shared_rules()
+    for lookback in lookbacks:
+        rules.update(bp002_rules(lookback, combined=True))
+    return rules
+
+
+def demographic_rules():
+    # Categorical demographic variables (age_band and imd_q5) as defined in
+    # dict_demographic_variables.py
+    path = pathlib.Path(__file__).parent / "dict_demographic_variables.py"
+    return {
+        name: expression
+        for name, expression in read_variable_expressions(path).items()
+        if isinstance(expression, dict)
+    }
+
+
+def apply_rules(df, evaluated):
+    # Replace (or add) the evaluated columns of df, keeping the column order
+    df = df.copy()
+    for name in evaluated.columns:
+        df[name] = evaluated[name]
+    return df
+
+
+def compare_rules(df, evaluated):
+    # Return {variable name: number of patients that differ}. Variables that
+    # are not extracted (e.g., the lookback specific rules, see
+    # study_definition_bp002.py) are not compared.
+    differences = {}
+    for name in evaluated.columns:
+        if name not in df.columns:
+            continue
+        result = evaluated[name].to_numpy()
+        if result.dtype == object:
+            extracted = df[name].astype(str).to_numpy()
+            result = result.astype(str)
+        else:
+            extracted = truthy(df[name].to_numpy())
+            result = result.astype(bool)
+        differences[name] = int((extracted != result).sum())
+    return differences
+
+
+def merge_bp_windows(df, windows):
+    # Replace bp_rec_* and bp_dec_* with the lookback flags (rows of
+    # input_bp_windows_<date>.feather); patients missing from the window
+    # file have no events in any lookback period
+    flags = [column for column in windows.columns if column != "patient_id"]
+    df = df.drop(columns=[column for column in flags if column in df.columns])
+    df = df.merge(windows, on="patient_id", how="left")
+    df[flags] = df[flags].fillna(0).astype(np.int64)
+    return df
+
+
+def merge_registration(df, registration):
+    # Replace gms_reg_status, reg_dat_3m, practice and region with the
+    # variables derived from the registration spells (rows of
+    # input_registration_<date>.feather, see registration.py); patients
+    # without a spell are not registered
+    variables = [column for column in registration.columns if column != "patient_id"]
+    df = df.drop(columns=[column for column in variables if column in df.columns])
+    df = df.merge(registration, on="patient_id", how="left")
+    for name in variables:
+        if name == "region":
+            df[name] = df[name].fillna("")
+        else:
+            df[name] = df[name].fillna(0).astype(np.int64)
+    return df
+
+
+def evaluate_file(
+    path,
+    plan,
+    output_dir,
+    bp_windows_dir=None,
+    check=False,
+    registration_dir=None,
+    trace=False,
+    batch_rows=None,
+):
+    # Evaluate the plan for one extracted cohort and return the number of
+    # patients that differ per variable (empty unless check is True) and
+    # the spans of the trace (empty unless trace is True). With batch_rows,
+    # the cohort is evaluated and written in batches of rows and the window
+    # and registration files are merged batch by batch (see batches.py).
+    path = pathlib.Path(path)
+    index_date = index_date_from_path(path)
+    spans = Trace("rules")
+    merges = []
+    if bp_windows_dir:
+        windows_path = pathlib.Path(bp_windows_dir) / f"input_bp_windows_{index_date}.feather"
+        merges.append(("merge_bp_windows", merge_bp_windows, SortedReader(windows_path, batch_rows)))
+    if registration_dir:
+        registration_path = (
+            pathlib.Path(registration_dir) / f"input_registration_{index_date}.feather"
+        )
+        merges.append(
+            ("merge_registration", merge_registration, SortedReader(registration_path, batch_rows))
+        )
+
+    differences = {}
+    writer = BatchWriter(pathlib.Path(output_dir) / path.name)
+    batches = read_batches(path, batch_rows=batch_rows)
+    while True:
+        start = time.perf_counter()
+        table = next(batches, None)
+        if table is None:
+            break
+        df = table.to_pandas()
+        spans.add([index_date, "read"], time.perf_counter() - start, rows=len(df))
+        for name, merge, reader in merges:
+            with spans.span(index_date, name, rows=len(df)):
+                rows = reader.rows(df["patient_id"].to_numpy()).to_pandas()
+                df = merge(df, rows)
+
+        evaluated = plan.run(df, spans if trace else None, [index_date])
+        if check:
+            for name, count in compare_rules(df, evaluated).items():
+                differences[name] = differences.get(name, 0) + count
+        with spans.span(index_date, "write", rows=len(df)):
+            writer.write(pa.Table.from_pandas(apply_rules(df, evaluated), preserve_index=False))
+    writer.close()
+    return differences, spans.spans if trace else []
+
+
+def engine_plan(demographics=False):
+    # Plan of the BP002 rules of all lookbacks (and of age_band and imd_q5)
+    rules = bp002_engine_rules()
+    if demographics:
+        rules.update(demographic_rules())
+    return compile_rules(rules)
+
+
+def evaluate_files(
+    input_files,
+    output_dir,
+    plan=None,
+    bp_windows_dir=None,
+    check=False,
+    registration_dir=None,
+    trace=False,
+    workers=None,
+    memory_limit=None,
+):
+    # Evaluate the plan for every extracted cohort (see evaluate_file) in a
+    # pool of workers and return the results in the order of input_files
+    if plan is None:
+        plan = engine_plan()
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    workers, batch_rows = batch_plan(input_files, workers, memory_limit)
+    return parallel_map(
+        functools.partial(
+            evaluate_file,
+            plan=plan,
+            output_dir=output_dir,
+            bp_windows_dir=bp_windows_dir,
+            check=check,
+            registration_dir=registration_dir,
+            trace=trace,
+            batch_rows=batch_rows,
+        ),
+        input_files,
+        workers=workers,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--input-files",
+        nargs="+",
+        required=True,
+        help="Extracted cohort files or glob patterns",
+    )
+    parser.add_argument("--output-dir", default="output/rules")
+    parser.add_argument(
+        "--bp-windows-dir",
+        help="Directory with input_bp_windows_<date>.feather (see bp_windows.py)",
+    )
+    parser.add_argument(
+        "--registration-dir",
+        help="Directory with input_registration_<date>.feather (see registration.py)",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Compare the evaluated rules with the extracted rules",
+    )
+    parser.add_argument(
+        "--demographics",
+        action="store_true",
+        help="Also evaluate age_band and imd_q5 (requires age and imd columns)",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="Write the time, rows and cardinality of every variable to logs/ (see tracing.py)",
+    )
+    parser.add_argument(
+        "--show-plan",
+        action="store_true",
+        help="Print the compiled plan and how many evaluations are shared",
+    )
+    add_parallel_arguments(parser)
+    args = parser.parse_args()
+
+    input_files = expand_paths(args.input_files)
+    plan = engine_plan(args.demographics)
+    if args.show_plan:
+        print(plan.describe())
+
+    results = evaluate_files(
+        input_files,
+        args.output_dir,
+        plan,
+        bp_windows_dir=args.bp_windows_dir,
+        check=args.check,
+        registration_dir=args.registration_dir,
+        trace=args.trace,
+        workers=args.workers,
+        memory_limit=args.memory_limit,
+    )
+
+    if args.trace:
+        trace = Trace("rules")
+        for _, spans in results:
+            trace.extend(spans)
+        trace.write()
+        print(trace.format_summary())
+
+    mismatches = 0
+    for path, (differences, _) in zip(input_files, results):
+        for name, count in differences.items():
+            if count:
+                mismatches += 1
+                print(f"{pathlib.Path(path).name}: {name} differs for {count} patients")
+
+    if mismatches:
+        raise SystemExit(f"{mismatches} rule variables differ from the extracted cohort")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,415 @@
+# This script runs the actions of project.yaml locally, as a DAG:
+# (1) the actions to run are the requested actions (default: all) and the
+#     actions they need
+# (2) an action is started as soon as all actions it needs have finished,
+#     so independent actions (e.g., the ethnicity and BP002 extractions, or
+#     the deciles charts and the disclosure control) run concurrently
+# (3) actions are only started while they fit into the CPU and memory
+#     budgets (--workers, --memory-limit); the CPUs and memory an action
+#     needs are estimated from its last run (CPU time / wall clock time and
+#     peak memory, recorded with os.wait4), an action without a previous run
+#     is assumed to need one CPU. An action that needs more than the budget
+#     runs on its own.
+# (4) an action is skipped if it is up to date: its run command, the code it
+#     runs (the script or study definition and the modules in analysis/ it
+#     imports, directly or indirectly), the codelists and the outputs of the
+#     actions it needs are unchanged since its last successful run and its
+#     outputs still exist unchanged
+#
+# Outputs of the actions are fingerprinted by path, size and modification
+# time, so an action whose needed actions were rerun is rerun as well. The
+# state of every action is kept in output/cache/actions.json and the output
+# of every run in metadata/<action>.log.
+#
+# Actions run with the local tools of their image: python:latest with the
+# current python interpreter, cohortextractor:latest with cohortextractor
+# and r:latest with Rscript. With --local-backend, the cohortextractor
+# actions run the study definitions against the local event store instead
+# (see local_backend.py and event_store.py).
+#
+# Usage:
+#   python analysis/run_project.py                        # all actions
+#   python analysis/run_project.py generate_measures_bp002 --dry-run
+#   python analysis/run_project.py --force join_ethnicity
+#   python analysis/run_project.py --local-backend
+
+import argparse
+import ast
+import glob
+import hashlib
+import json
+import math
+import os
+import pathlib
+import shlex
+import subprocess
+import sys
+import time
+
+import yaml
+
+from parallel import available_memory, parse_size
+from utils import content_hash
+
+ANALYSIS_DIR = pathlib.Path(__file__).resolve().parent
+ROOT_DIR = ANALYSIS_DIR.parent
+
+DEFAULT_PROJECT = ROOT_DIR / "project.yaml"
+DEFAULT_STATE = "output/cache/actions.json"
+LOG_DIR = "metadata"
+
+# Local command of every image
+IMAGES = {
+    "python": [sys.executable],
+    "cohortextractor": ["cohortextractor"],
+    "r": ["Rscript"],
+}
+
+# Command of cohortextractor:latest with --local-backend
+LOCAL_BACKEND = [sys.executable, str(ANALYSIS_DIR / "local_backend.py")]
+
+# Arguments that are scripts (other file arguments are inputs or outputs)
+SCRIPT_SUFFIXES = (".py", ".R", ".r")
+
+# Files every action depends on (relative to the project directory)
+DATA_FILES = ["codelists/*.csv", "codelists/codelists.json"]
+
+
+class Action:
+    def __init__(self, name, spec, images=None):
+        self.name = name
+        self.images = images or IMAGES
+        self.run = " ".join(spec["run"].split())
+        self.arguments = shlex.split(self.run)
+        self.needs = list(spec.get("needs") or [])
+        self.outputs = [
+            pattern
+            for outputs in (spec.get("outputs") or {}).values()
+            for pattern in outputs.values()
+        ]
+
+    def command(self):
+        image, *arguments = self.arguments
+        tool = image.split(":")[0]
+        if tool not in self.images:
+            raise ValueError(f"Action {self.name}: unknown image {image}")
+        return self.images[tool] + arguments
+
+    def scripts(self, project_dir):
+        # Files the command runs: scripts (also of the image, e.g., the
+        # local backend) and study definitions
+        tool = self.arguments[0].split(":")[0]
+        scripts = [
+            pathlib.Path(part)
+            for part in self.images.get(tool, [])
+            if part.endswith(SCRIPT_SUFFIXES)
+        ]
+        arguments = self.arguments[1:]
+        for i, argument in enumerate(arguments):
+            if argument == "--study-definition" and i + 1 < len(arguments):
+                scripts.append(ANALYSIS_DIR / f"{arguments[i + 1]}.py")
+            elif argument.startswith("--study-definition="):
+                scripts.append(ANALYSIS_DIR / f"{argument.split('=', 1)[1]}.py")
+            elif argument.endswith(SCRIPT_SUFFIXES):
+                scripts.append(pathlib.Path(project_dir) / argument)
+        return scripts
+
+    def code_files(self, project_dir):
+        files = module_closure(self.scripts(project_dir))
+        for pattern in DATA_FILES:
+            files.extend(sorted(pathlib.Path(project_dir).glob(pattern)))
+        return files
+
+    def output_files(self, project_dir):
+        # Sorted output files, None if a pattern matches no file
+        files = set()
+        for pattern in self.outputs:
+            matches = glob.glob(str(pathlib.Path(project_dir) / pattern))
+            if not matches:
+                return None
+            files.update(matches)
+        return sorted(files)
+
+
+def load_actions(path=DEFAULT_PROJECT, images=None):
+    with open(path) as f:
+        project = yaml.safe_load(f)
+    actions = {
+        name: Action(name, spec, images) for name, spec in project["actions"].items()
+    }
+    for action in actions.values():
+        for need in action.needs:
+            if need not in actions:
+                raise ValueError(f"Action {action.name} needs unknown action {need}")
+    return actions
+
+
+def module_closure(scripts):
+    # The scripts and the modules in analysis/ they import (directly or
+    # indirectly), in a stable order
+    seen = {}
+    queue = [pathlib.Path(script) for script in scripts]
+    while queue:
+        path = queue.pop(0)
+        if path in seen or not path.exists():
+            continue
+        seen[path] = True
+        if path.suffix != ".py":
+            continue
+        for node in ast.walk(ast.parse(path.read_text(), str(path))):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                module = ANALYSIS_DIR / f"{name.split('.')[0]}.py"
+                if module.exists():
+                    queue.append(module)
+    return sorted(seen)
+
+
+def fingerprint(paths):
+    # Hash of the path, size and modification time of files
+    digest = hashlib.sha256()
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def select(actions, targets=None):
+    # Names of the targets and all actions they need, in project order
+    if not targets:
+        return list(actions)
+    selected = set()
+    queue = list(targets)
+    while queue:
+        name = queue.pop()
+        if name not in actions:
+            raise ValueError(f"Unknown action {name}")
+        if name not in selected:
+            selected.add(name)
+            queue.extend(actions[name].needs)
+    return [name for name in actions if name in selected]
+
+
+class State:
+    # Key, outputs and resource use of the last successful run of every
+    # action
+
+    def __init__(self, path=DEFAULT_STATE):
+        self.path = pathlib.Path(path)
+        self.actions = {}
+        if self.path.exists():
+            with open(self.path) as f:
+                self.actions = json.load(f)["actions"]
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"actions": dict(sorted(self.actions.items()))}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def key(self, action, project_dir):
+        # Hash of the command, the code and the outputs of the needed
+        # actions (None if a needed action has no recorded outputs)
+        needs = {}
+        for need in action.needs:
+            if need not in self.actions:
+                return None
+            needs[need] = self.actions[need]["outputs_hash"]
+        extra = json.dumps({"run": action.run, "needs": needs}, sort_keys=True)
+        return content_hash(action.code_files(project_dir), extra=extra)
+
+    def up_to_date(self, action, key, project_dir):
+        entry = self.actions.get(action.name)
+        if entry is None or key is None or entry["key"] != key:
+            return False
+        outputs = action.output_files(project_dir)
+        return outputs is not None and fingerprint(outputs) == entry["outputs_hash"]
+
+    def estimate(self, name, cpu_budget):
+        # (CPUs, memory) of an action from its last run; actions with worker
+        # processes are assumed to need the peak memory per CPU used
+        entry = self.actions.get(name)
+        if entry is None or not entry.get("seconds"):
+            return 1, 0
+        cpus = math.ceil(entry["cpu_seconds"] / entry["seconds"] - 0.25)
+        cpus = max(1, min(cpus, cpu_budget))
+        return cpus, entry["max_rss_bytes"] * cpus
+
+
+def start(action, project_dir):
+    log_dir = pathlib.Path(project_dir) / LOG_DIR
+    log_dir.mkdir(parents=True, exist_ok=True)
+    with open(log_dir / f"{action.name}.log", "w") as log:
+        return subprocess.Popen(
+            action.command(), cwd=project_dir, stdout=log, stderr=subprocess.STDOUT
+        )
+
+
+def run_project(
+    project=DEFAULT_PROJECT,
+    targets=None,
+    state_path=DEFAULT_STATE,
+    workers=None,
+    memory_limit=None,
+    force=False,
+    dry_run=False,
+    local_backend=False,
+):
+    # Run the selected actions, return {name: status} with status one of
+    # ran, skipped, failed or blocked (a needed action failed)
+    project_dir = pathlib.Path(project).resolve().parent
+    images = dict(IMAGES, cohortextractor=LOCAL_BACKEND) if local_backend else IMAGES
+    actions = load_actions(project, images)
+    state = State(pathlib.Path(project_dir) / state_path)
+    cpu_budget = workers or os.cpu_count() or 1
+    memory_budget = memory_limit or available_memory() or math.inf
+
+    pending = select(actions, targets)
+    status = {}
+    if dry_run:
+        for name in pending:
+            action = actions[name]
+            rerun = force or any(status[need] == "run" for need in action.needs)
+            key = None if rerun else state.key(action, project_dir)
+            status[name] = "skip" if key and state.up_to_date(action, key, project_dir) else "run"
+            print(f"{status[name]:<5} {name}")
+        return status
+
+    running = {}
+    while pending or running:
+        # Start or skip every action whose needed actions have finished
+        finished = len(status)
+        for name in list(pending):
+            action = actions[name]
+            if any(status.get(need) in ("failed", "blocked") for need in action.needs):
+                status[name] = "blocked"
+                pending.remove(name)
+                print(f"blocked {name}", flush=True)
+                continue
+            if not all(status.get(need) in ("ran", "skipped") for need in action.needs):
+                continue
+            key = state.key(action, project_dir)
+            if not force and state.up_to_date(action, key, project_dir):
+                status[name] = "skipped"
+                pending.remove(name)
+                print(f"skipped {name} (up to date)", flush=True)
+                continue
+            cpus, memory = state.estimate(name, cpu_budget)
+            used_cpus = sum(job["cpus"] for job in running.values())
+            used_memory = sum(job["memory"] for job in running.values())
+            if running and (
+                used_cpus + cpus > cpu_budget or used_memory + memory > memory_budget
+            ):
+                continue
+            pending.remove(name)
+            try:
+                process = start(action, project_dir)
+            except (OSError, ValueError) as error:
+                status[name] = "failed"
+                print(f"failed {name}: {error}", flush=True)
+                continue
+            running[process.pid] = dict(
+                action=action,
+                process=process,
+                key=key,
+                cpus=cpus,
+                memory=memory,
+                start=time.perf_counter(),
+            )
+            print(f"started {name}", flush=True)
+
+        if not running:
+            if pending and len(status) == finished:
+                # Every pending action waits for another pending action
+                raise ValueError(f"Circular needs: {', '.join(pending)}")
+            # Actions that finished in this pass (skipped, failed to start or
+            # blocked) may be needed by pending actions listed before them
+            continue
+
+        pid, wait_status, usage = os.wait4(-1, 0)
+        if pid not in running:
+            continue
+        job = running.pop(pid)
+        action = job["action"]
+        seconds = time.perf_counter() - job["start"]
+        if os.WIFEXITED(wait_status):
+            returncode = os.WEXITSTATUS(wait_status)
+        else:
+            returncode = -os.WTERMSIG(wait_status)
+        # The process has been waited for with os.wait4()
+        job["process"].returncode = returncode
+        outputs = action.output_files(project_dir)
+        if returncode != 0 or outputs is None:
+            status[action.name] = "failed"
+            state.actions.pop(action.name, None)
+            reason = f"exit code {returncode}" if returncode != 0 else "missing outputs"
+            print(
+                f"failed {action.name} ({reason}, see {LOG_DIR}/{action.name}.log)", flush=True
+            )
+        else:
+            status[action.name] = "ran"
+            state.actions[action.name] = {
+                # The key of the code that ran (needed outputs are unchanged
+                # while the action runs)
+                "key": job["key"],
+                "outputs": [os.path.relpath(path, project_dir) for path in outputs],
+                "outputs_hash": fingerprint(outputs),
+                "seconds": round(seconds, 3),
+                "cpu_seconds": round(usage.ru_utime + usage.ru_stime, 3),
+                # ru_maxrss is in KiB on Linux
+                "max_rss_bytes": usage.ru_maxrss * 1024,
+            }
+            print(f"ran {action.name} in {seconds:.1f}s", flush=True)
+        state.save()
+    return status
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("actions", nargs="*", help="Actions to run (default: all)")
+    parser.add_argument("--project", default=DEFAULT_PROJECT)
+    parser.add_argument("--state", default=DEFAULT_STATE, help="Relative to the project directory")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="CPUs for all running actions (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--memory-limit",
+        type=parse_size,
+        default=None,
+        help="Memory for all running actions, e.g. 16G (default: available memory)",
+    )
+    parser.add_argument("--force", action="store_true", help="Run up to date actions as well")
+    parser.add_argument("--dry-run", action="store_true", help="List the actions that would run")
+    parser.add_argument(
+        "--local-backend",
+        action="store_true",
+        help="Run the extractions against the local event store (see local_backend.py)",
+    )
+    args = parser.parse_args()
+
+    status = run_project(
+        args.project,
+        args.actions,
+        args.state,
+        args.workers,
+        args.memory_limit,
+        args.force,
+        args.dry_run,
+        args.local_backend,
+    )
+    failed = [name for name, result in status.items() if result in ("failed", "blocked")]
+    if failed:
+        raise SystemExit(f"{len(failed)} actions failed or were blocked: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
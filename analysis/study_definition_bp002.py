@@ -0,0 +1,49 @@
+from cohortextractor import StudyDefinition, patients
+
+# Import dates and codelists
+from config import (
+    start_date,
+    end_date,
+)
+
+# Import shared variable dictionaries
+from dict_bp_variables import bp002_combined_variables
+from dict_demographic_variables import demographic_variables
+
+# This study definition extracts the variables of indicator BP002 that do
+# not depend on the lookback period (see lookback_years in config.py):
+# demographic variables, the population and the shared rules. The lookback
+# specific variables, named bp002_<lookback>_<rule>, e.g., bp002_1y_numerator
+# and bp002_5y_numerator, are evaluated by the evaluate_rules_bp002 action
+# (rule_engine.py) from the BP events of all index dates, which are
+# extracted once (study_definition_bp_events.py and bp_windows.py).
+
+study = StudyDefinition(
+    index_date=start_date,
+    default_expectations={
+        "date": {"earliest": start_date, "latest": end_date},
+        "rate": "uniform",
+        "incidence": 0.5,
+    },
+    population=patients.satisfying(
+        """
+        # Define general population parameters
+        (NOT died) AND
+        (sex = 'F' OR sex = 'M') AND
+        (age_band != 'missing') AND
+
+        # Define GMS registration status
+        gms_reg_status AND
+
+        # Define list size type:
+        age >= 45
+        """,
+    ),
+    # Include blood pressure and demographic variable dictionaries
+    **demographic_variables,
+    **bp002_combined_variables(),
+)
+
+# The study definition has no measures: the measures of all lookback periods
+# (see bp002_measures.py) use the variables evaluated by rule_engine.py, so
+# they are calculated by generate_measures.py (generate_measures_bp002).
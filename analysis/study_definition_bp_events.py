@@ -0,0 +1,76 @@
+from cohortextractor import StudyDefinition, patients, params
+
+# Import dates and codelists
+from config import start_date, end_date, event_start_date, lookback_years
+from codelists_bp import bp_codes, bp_dec_codes
+from utils import add_months, last_day_of_month, month_starts
+
+# This study definition extracts the blood pressure (BP_COD) and blood
+# pressure declined (BPDEC_COD) events once for all index dates: the date
+# of the latest event in every calendar month from the start of the longest
+# lookback period of the first index date to the last index month
+# (bp_rec_date_<YYYY>_<MM> and bp_dec_date_<YYYY>_<MM>). The months do not
+# overlap, so every event is read once per codelist. The lookback variables
+# (bp_rec_*, bp_dec_*) of all lookbacks and index dates are derived from
+# these dates in analysis/bp_windows.py (the latest event up to the end of
+# an index month is carried forward month by month), instead of one query
+# per lookback and index date in study_definition_bp002.py.
+#
+# With --param start_date=<date> --param end_date=<date> only the months of
+# the index dates of that range are extracted (e.g., the months of a
+# refresh, see analysis/refresh.py).
+
+index_dates = month_starts(
+    params.get("start_date", start_date), params.get("end_date", end_date)
+)
+years = max(lookback_years.values())
+
+# Months with events of any of the index dates
+event_months = month_starts(add_months(index_dates[0], -12 * years), index_dates[-1])
+events_between = [
+    event_months[0].isoformat(),
+    last_day_of_month(event_months[-1]).isoformat(),
+]
+
+
+def latest_event_dates(prefix, codelist):
+    # Create one date variable per month, named <prefix>_date_<YYYY>_<MM>
+    variables = {}
+    for month in event_months:
+        variables[f"{prefix}_date_{month:%Y_%m}"] = patients.with_these_clinical_events(
+            codelist,
+            between=[month.isoformat(), last_day_of_month(month).isoformat()],
+            returning="date",
+            date_format="YYYY-MM-DD",
+            find_last_match_in_period=True,
+        )
+    return variables
+
+
+study = StudyDefinition(
+    index_date=end_date,
+    default_expectations={
+        "date": {"earliest": event_start_date, "latest": end_date},
+        "rate": "uniform",
+        "incidence": 0.5,
+    },
+    # Patients without any BP or BP declined event for the index dates have
+    # no lookback flags set and are therefore not extracted
+    population=patients.satisfying(
+        """
+        bp_any OR bp_dec_any
+        """,
+        bp_any=patients.with_these_clinical_events(
+            bp_codes,
+            between=events_between,
+            returning="binary_flag",
+        ),
+        bp_dec_any=patients.with_these_clinical_events(
+            bp_dec_codes,
+            between=events_between,
+            returning="binary_flag",
+        ),
+    ),
+    **latest_event_dates("bp_rec", bp_codes),
+    **latest_event_dates("bp_dec", bp_dec_codes),
+)
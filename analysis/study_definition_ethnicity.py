@@ -1,13 +1,23 @@
-from cohortextractor import (
-    StudyDefinition,
-    patients,
-    codelist,
-    codelist_from_csv,
-    Measure,
-)
+from cohortextractor import StudyDefinition, patients, params
 
 from config import end_date
-from codelists_demographic import ethnicity6_codes, ethnicity16_codes
+from codelists_demographic import ethnicity_codes
+
+# The latest ethnicity code of every patient is extracted with one query.
+# Both groupings (Grouping_16 and Grouping_6 of the ethnicity codelist) and
+# their labels (ethnicity16 and ethnicity6) are derived from this code when
+# the ethnicity cohort is joined (see analysis/ethnicity.py), instead of
+# extracting the latest Grouping_16 and Grouping_6 category separately.
+#
+# Records are searched up to --param until=<date> (config.end_date by
+# default), the watermark of the ethnicity state (see
+# analysis/ethnicity_state.py). With --param since=<date> only records from
+# that date onwards are searched (the latest code since the previous
+# watermark). The date of the code is extracted for the state.
+
+since = params.get("since")
+until = params.get("until", end_date)
+period = {"between": [since, until]} if since else {"on_or_before": until}
 
 study = StudyDefinition(
     default_expectations={
@@ -16,117 +26,35 @@ study = StudyDefinition(
     },
     index_date=end_date,
     population=patients.all(),
-    eth16=patients.with_these_clinical_events(
-        ethnicity16_codes,
-        returning="category",
+    ethnicity_code=patients.with_these_clinical_events(
+        ethnicity_codes,
+        returning="code",
         find_last_match_in_period=True,
-        include_date_of_match=False,
+        include_date_of_match=True,
+        **period,
         return_expectations={
+            # One code of each Grouping_16 category (1 to 16)
             "category": {
                 "ratios": {
-                    "1": 0.1,
-                    "2": 0.1,
-                    "3": 0.1,
-                    "4": 0.1,
-                    "5": 0.1,
-                    "6": 0.025,
-                    "7": 0.025,
-                    "8": 0.05,
-                    "9": 0.05,
-                    "10": 0.05,
-                    "11": 0.05,
-                    "12": 0.05,
-                    "13": 0.05,
-                    "14": 0.05,
-                    "15": 0.05,
-                    "16": 0.05,
+                    "110761000000106": 0.1,
+                    "154162007": 0.1,
+                    "10117001": 0.1,
+                    "154201009": 0.1,
+                    "154202002": 0.1,
+                    "154198004": 0.025,
+                    "110771000000104": 0.025,
+                    "110751000000108": 0.05,
+                    "154179001": 0.05,
+                    "154180003": 0.05,
+                    "10432001": 0.05,
+                    "107691000000105": 0.05,
+                    "10008004": 0.05,
+                    "110791000000100": 0.05,
+                    "154181004": 0.05,
+                    "10292001": 0.05,
                 }
             },
             "incidence": 0.75,
         },
     ),
-    ethnicity16=patients.categorised_as(
-        {
-            "Unknown": "DEFAULT",
-            "White - British": "eth16='1'",
-            "White - Irish": "eth16='2'",
-            "White - Any other White background": "eth16='3'",
-            "Mixed - White and Black Caribbean": "eth16='4'",
-            "Mixed - White and Black African": "eth16='5'",
-            "Mixed - White and Asian": "eth16='6'",
-            "Mixed - Any other mixed background": "eth16='7'",
-            "Asian or Asian British - Indian": "eth16='8'",
-            "Asian or Asian British - Pakistani": "eth16='9'",
-            "Asian or Asian British - Bangladeshi": "eth16='10'",
-            "Asian or Asian British - Any other Asian background": "eth16='11'",
-            "Black or Black British - Caribbean": "eth16='12'",
-            "Black or Black British - African": "eth16='13'",
-            "Black or Black British - Any other Black background": "eth16='14'",
-            "Other Ethnic Groups - Chinese": "eth16='15'",
-            "Other Ethnic Groups - Any other ethnic group": "eth16='16'",
-        },
-        return_expectations={
-            "category": {
-                "ratios": {
-                    "White - British": 0.1,
-                    "White - Irish": 0.1,
-                    "White - Any other White background": 0.1,
-                    "Mixed - White and Black Caribbean": 0.1,
-                    "Mixed - White and Black African": 0.1,
-                    "Mixed - White and Asian": 0.025,
-                    "Mixed - Any other mixed background": 0.025,
-                    "Asian or Asian British - Indian": 0.05,
-                    "Asian or Asian British - Pakistani": 0.05,
-                    "Asian or Asian British - Bangladeshi": 0.05,
-                    "Asian or Asian British - Any other Asian background": 0.05,
-                    "Black or Black British - Caribbean": 0.05,
-                    "Black or Black British - African": 0.05,
-                    "Black or Black British - Any other Black background": 0.05,
-                    "Other Ethnic Groups - Chinese": 0.05,
-                    "Other Ethnic Groups - Any other ethnic group": 0.05,
-                }
-            },
-            "incidence": 0.8,
-        },
-    ),
-    eth6=patients.with_these_clinical_events(
-        ethnicity6_codes,
-        returning="category",
-        find_last_match_in_period=True,
-        include_date_of_match=False,
-        return_expectations={
-            "category": {
-                "ratios": {
-                    "1": 0.5,
-                    "2": 0.2,
-                    "3": 0.1,
-                    "4": 0.1,
-                    "5": 0.1,
-                }
-            },
-            "incidence": 0.8,
-        },
-    ),
-    ethnicity6=patients.categorised_as(
-        {
-            "Unknown": "DEFAULT",
-            "White": "eth6='1'",
-            "Mixed": "eth6='2'",
-            "Asian or Asian British": "eth6='3'",
-            "Black or Black British": "eth6='4'",
-            "Chinese or Other Ethnic Groups": "eth6='5'",
-        },
-        return_expectations={
-            "category": {
-                "ratios": {
-                    "White": 0.2,
-                    "Mixed": 0.2,
-                    "Asian or Asian British": 0.2,
-                    "Black or Black British": 0.2,
-                    "Chinese or Other Ethnic Groups": 0.2,
-                }
-            },
-            "incidence": 0.8,
-        },
-    ),
 )
@@ -0,0 +1,143 @@
+# Per-variable timing and row count instrumentation
+#
+# A Trace records one span per evaluated variable (and per index date),
+# with the wall clock time, the number of rows touched (rows read to
+# evaluate it) and the output cardinality (patients with a non-zero value,
+# and the number of distinct values of categorical variables):
+#
+#   trace = Trace("rules")
+#   with trace.span("2019-03-01", "bp002_1y_numerator", rows=len(df)) as span:
+#       values = ...
+#       span.output(values)
+#   trace.write("logs")
+#
+# write() saves the spans as JSON (logs/trace_<name>.json), as folded
+# stacks for flamegraph.pl (logs/flame_<name>.folded, "stage;index
+# date;variable microseconds") and a flame-style summary
+# (logs/flame_<name>.txt) with the variables ranked by their total time
+# across index dates. Traces of worker processes are merged with
+# Trace.extend().
+
+import contextlib
+import json
+import os
+import pathlib
+import time
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_LOG_DIR = "logs"
+
+
+def cardinality(values):
+    # (patients with a non-zero / non-missing value, distinct values)
+    values = pd.Series(np.asarray(values).ravel())
+    # Text (object, string or categorical) values are present unless empty
+    if pd.api.types.is_numeric_dtype(values.dtype):
+        present = values.notna() & (values != 0)
+    else:
+        present = values.notna() & (values.astype(str) != "")
+    return int(present.sum()), int(values.nunique(dropna=True))
+
+
+class Span:
+    def __init__(self, path, rows=None):
+        self.path = list(path)
+        self.rows = rows
+        self.seconds = None
+        self.nonzero = None
+        self.distinct = None
+
+    def output(self, values):
+        self.nonzero, self.distinct = cardinality(values)
+
+    def to_dict(self):
+        return {
+            "path": self.path,
+            "seconds": self.seconds,
+            "rows": self.rows,
+            "nonzero": self.nonzero,
+            "distinct": self.distinct,
+        }
+
+
+class Trace:
+    def __init__(self, name):
+        self.name = name
+        self.spans = []
+
+    @contextlib.contextmanager
+    def span(self, *path, rows=None):
+        span = Span(path, rows)
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            span.seconds = time.perf_counter() - start
+            self.spans.append(span.to_dict())
+
+    def add(self, path, seconds, rows=None, values=None):
+        # Record a span that was timed elsewhere
+        span = Span(path, rows)
+        span.seconds = seconds
+        if values is not None:
+            span.output(values)
+        self.spans.append(span.to_dict())
+
+    def extend(self, spans):
+        self.spans.extend(spans)
+
+    def summary(self):
+        # Total time, rows and spans per variable (last element of the path)
+        if not self.spans:
+            return pd.DataFrame(columns=["variable", "seconds", "share", "rows", "spans"])
+        df = pd.DataFrame(
+            {
+                "variable": [span["path"][-1] for span in self.spans],
+                "seconds": [span["seconds"] for span in self.spans],
+                "rows": [span["rows"] or 0 for span in self.spans],
+            }
+        )
+        summary = df.groupby("variable").agg(
+            seconds=("seconds", "sum"), rows=("rows", "sum"), spans=("seconds", "size")
+        )
+        summary["share"] = summary["seconds"] / max(summary["seconds"].sum(), 1e-12)
+        summary = summary.sort_values("seconds", ascending=False).reset_index()
+        return summary[["variable", "seconds", "share", "rows", "spans"]]
+
+    def folded(self):
+        # Folded stacks (flamegraph.pl input), weights in microseconds
+        totals = {}
+        for span in self.spans:
+            key = ";".join([self.name] + [str(part) for part in span["path"]])
+            totals[key] = totals.get(key, 0) + span["seconds"]
+        return [f"{key} {int(round(seconds * 1e6))}" for key, seconds in sorted(totals.items())]
+
+    def write(self, log_dir=DEFAULT_LOG_DIR):
+        log_dir = pathlib.Path(log_dir)
+        log_dir.mkdir(parents=True, exist_ok=True)
+        trace_path = log_dir / f"trace_{self.name}.json"
+        tmp_path = trace_path.with_name(f".{trace_path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"name": self.name, "spans": self.spans}, f, indent=1)
+        os.replace(tmp_path, trace_path)
+
+        folded_path = log_dir / f"flame_{self.name}.folded"
+        folded_path.write_text("\n".join(self.folded()) + "\n")
+        flame_path = log_dir / f"flame_{self.name}.txt"
+        flame_path.write_text(self.format_summary() + "\n")
+        return trace_path, folded_path, flame_path
+
+    def format_summary(self, width=40):
+        summary = self.summary()
+        total = summary["seconds"].sum()
+        lines = [f"{self.name}: {total:.3f}s in {len(self.spans)} spans"]
+        name_width = max([len(name) for name in summary["variable"]] + [8])
+        for row in summary.itertuples(index=False):
+            bar = "#" * max(int(round(row.share * width)), 1 if row.seconds > 0 else 0)
+            lines.append(
+                f"{row.variable:<{name_width}} {bar:<{width}} {row.seconds:9.3f}s "
+                f"{row.share:6.1%} rows={row.rows} spans={row.spans}"
+            )
+        return "\n".join(lines)
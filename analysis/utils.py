@@ -0,0 +1,77 @@
+# Helper functions shared by the scripted (python) actions
+
+import calendar
+import datetime
+import glob
+import hashlib
+import pathlib
+import re
+
+
+def to_date(value):
+    # Accept ISO date strings, dates and datetimes
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.date.fromisoformat(str(value)[:10])
+
+
+def month_starts(start, end):
+    # First day of every month between start and end (inclusive),
+    # matching cohortextractor's "--index-date-range ... by month"
+    start = to_date(start).replace(day=1)
+    end = to_date(end)
+    months = []
+    current = start
+    while current <= end:
+        months.append(current)
+        current = add_months(current, 1)
+    return months
+
+
+def add_months(date, months):
+    date = to_date(date)
+    month_index = date.year * 12 + date.month - 1 + months
+    year, month = divmod(month_index, 12)
+    day = min(date.day, calendar.monthrange(year, month + 1)[1])
+    return datetime.date(year, month + 1, day)
+
+
+def last_day_of_month(date):
+    date = to_date(date)
+    return date.replace(day=calendar.monthrange(date.year, date.month)[1])
+
+
+def content_hash(paths, extra=None):
+    # SHA-256 of the contents of the given files (in the given order) and
+    # of any extra text, e.g., to detect changes to variable dictionaries,
+    # codelists or config
+    digest = hashlib.sha256()
+    for path in paths:
+        path = pathlib.Path(path)
+        digest.update(path.name.encode())
+        digest.update(path.read_bytes())
+    if extra is not None:
+        digest.update(str(extra).encode())
+    return digest.hexdigest()
+
+
+def index_date_from_path(path):
+    # Index date of a monthly file, e.g., input_bp002_2019-03-01.feather
+    match = re.search(r"\d{4}-\d{2}-\d{2}", pathlib.Path(path).name)
+    if match is None:
+        raise ValueError(f"No index date in file name: {path}")
+    return match.group(0)
+
+
+def expand_paths(patterns):
+    # Sorted file paths matching any of the glob patterns (actions are not
+    # run in a shell, so patterns are expanded here)
+    paths = set()
+    for pattern in patterns:
+        matches = glob.glob(str(pattern))
+        if not matches:
+            raise FileNotFoundError(f"No files match {pattern}")
+        paths.update(matches)
+    return sorted(paths)
@@ -0,0 +1,8 @@
+# The analysis scripts import each other by module name (they are run as
+# `python analysis/<script>.py`), so the tests import them the same way
+import pathlib
+import sys
+
+ANALYSIS_DIR = pathlib.Path(__file__).parent.parent / "analysis"
+
+sys.path.insert(0, str(ANALYSIS_DIR))
@@ -0,0 +1,126 @@
+# Streamed reads, joins and writes are checked against reading the whole
+# files with pandas
+import warnings
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+import pytest
+
+from batches import MIN_BATCH_ROWS, BatchWriter, SortedReader, batch_plan, read_batches
+from parallel import MEMORY_PER_INPUT_BYTE
+
+
+@pytest.fixture
+def cohort():
+    rng = np.random.default_rng(5)
+    n = 1000
+    return pd.DataFrame(
+        {
+            "patient_id": np.sort(rng.choice(5000, n, replace=False)),
+            "value": rng.integers(0, 100, n),
+            "region": rng.choice(["East", "London"], n),
+        }
+    )
+
+
+@pytest.fixture(params=["feather", "parquet"])
+def path(request, tmp_path, cohort):
+    # Files with several stored record batches (row groups)
+    if request.param == "feather":
+        path = tmp_path / "cohort.feather"
+        feather.write_feather(cohort, path, chunksize=300)
+    else:
+        path = tmp_path / "cohort.parquet"
+        pq.write_table(pa.Table.from_pandas(cohort, preserve_index=False), path, row_group_size=300)
+    return path
+
+
+@pytest.mark.parametrize("batch_rows", [None, 1, 7, 300, 450, 10_000])
+def test_read_batches_matches_whole_file(path, cohort, batch_rows):
+    tables = list(read_batches(path, ["patient_id", "value"], batch_rows))
+    if batch_rows is not None:
+        assert all(0 < table.num_rows <= batch_rows for table in tables)
+    df = pa.concat_tables(tables).to_pandas()
+    pd.testing.assert_frame_equal(df, cohort[["patient_id", "value"]], check_dtype=False)
+
+
+def test_read_batches_of_an_empty_file(tmp_path, cohort):
+    path = tmp_path / "empty.feather"
+    feather.write_feather(cohort.iloc[:0], path)
+    tables = list(read_batches(path, ["patient_id"], batch_rows=10))
+    assert len(tables) == 1
+    assert tables[0].num_rows == 0
+    assert tables[0].column_names == ["patient_id"]
+
+
+@pytest.mark.parametrize("batch_rows", [None, 50, 333])
+def test_sorted_reader_matches_merge(tmp_path, cohort, batch_rows):
+    rng = np.random.default_rng(6)
+    windows = pd.DataFrame({"patient_id": np.sort(rng.choice(5000, 400, replace=False))})
+    windows["flag"] = rng.integers(0, 2, len(windows))
+    windows_path = tmp_path / "windows.feather"
+    feather.write_feather(windows, windows_path, chunksize=64)
+
+    reader = SortedReader(windows_path, batch_rows)
+    cohort_path = tmp_path / "cohort.feather"
+    feather.write_feather(cohort, cohort_path)
+    joined = []
+    for table in read_batches(cohort_path, batch_rows=batch_rows):
+        batch = table.to_pandas()
+        rows = reader.rows(batch["patient_id"].to_numpy()).to_pandas()
+        joined.append(batch.merge(rows, on="patient_id", how="left"))
+    result = pd.concat(joined, ignore_index=True)
+    expected = cohort.merge(windows, on="patient_id", how="left")
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_sorted_reader_rejects_unsorted_files(tmp_path):
+    path = tmp_path / "windows.feather"
+    feather.write_feather(pd.DataFrame({"patient_id": [1, 3, 2, 4]}), path)
+    reader = SortedReader(path, batch_rows=10)
+    with pytest.raises(ValueError):
+        reader.rows(np.array([1, 2]))
+
+
+def test_batch_writer(tmp_path, cohort):
+    path = tmp_path / "out.feather"
+    writer = BatchWriter(path)
+    for first in range(0, len(cohort), 300):
+        writer.write(pa.Table.from_pandas(cohort.iloc[first : first + 300], preserve_index=False))
+    assert writer.close() == [path]
+    pd.testing.assert_frame_equal(pd.read_feather(path), cohort)
+    assert BatchWriter(tmp_path / "none.feather").close() == []
+
+
+def test_batch_plan(tmp_path):
+    n = 50_000
+    df = pd.DataFrame({"patient_id": np.arange(n), "value": np.arange(n) % 7})
+    paths = []
+    for name in ["a", "b", "c", "d"]:
+        paths.append(tmp_path / f"{name}.feather")
+        feather.write_feather(df, paths[-1], compression="uncompressed")
+    file_memory = MEMORY_PER_INPUT_BYTE * paths[0].stat().st_size
+    row_bytes = file_memory / n
+
+    # Whole files fit
+    assert batch_plan(paths, 4, file_memory * 4) == (4, None)
+    # Batches for all workers
+    memory_limit = file_memory * 2.5
+    workers, batch_rows = batch_plan(paths, 4, memory_limit)
+    assert workers == 4
+    assert MIN_BATCH_ROWS <= batch_rows < n
+    assert workers * batch_rows * row_bytes <= memory_limit
+    # Fewer workers rather than batches below MIN_BATCH_ROWS
+    memory_limit = 2.5 * MIN_BATCH_ROWS * row_bytes
+    workers, batch_rows = batch_plan(paths, 4, memory_limit)
+    assert workers == 2
+    assert MIN_BATCH_ROWS <= batch_rows < n
+    assert workers * batch_rows * row_bytes <= memory_limit
+    # Below MIN_BATCH_ROWS: warn and use MIN_BATCH_ROWS
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        assert batch_plan(paths, 4, MIN_BATCH_ROWS * row_bytes / 2) == (1, MIN_BATCH_ROWS)
+    assert len(caught) == 1
@@ -0,0 +1,53 @@
+# Smoke test of the benchmark on a tiny dummy population: every stage runs
+# as its own process and the JSON results have the timings of all stages
+import json
+import subprocess
+import sys
+
+from benchmark import compare, stages
+from conftest import ANALYSIS_DIR
+
+
+def test_benchmark_tiny_population(tmp_path, capsys):
+    subprocess.run(
+        [
+            sys.executable,
+            str(ANALYSIS_DIR / "benchmark.py"),
+            "--sizes",
+            "200",
+            "--months",
+            "2",
+            "--work-dir",
+            str(tmp_path / "work"),
+            "--output-dir",
+            str(tmp_path),
+            "--workers",
+            "1",
+            "--keep",
+        ],
+        check=True,
+        capture_output=True,
+    )
+    (path,) = tmp_path.glob("benchmark_*.json")
+    results = json.loads(path.read_text())
+    assert results["months"] == 2
+    assert list(results["sizes"]) == ["200"]
+    size_results = results["sizes"]["200"]
+    assert list(size_results) == [name for name, _ in stages(200, 2, [])]
+    for name, result in size_results.items():
+        assert result["status"] == "ok", name
+        assert result["returncode"] == 0
+        assert result["seconds"] > 0
+        assert result["cpu_seconds"] >= 0
+        assert result["max_rss_bytes"] > 0
+
+    # The stages wrote their outputs (kept with --keep)
+    output_dir = tmp_path / "work" / "200" / "output"
+    assert len(list((output_dir / "rules").glob("input_bp002_*.feather"))) == 2
+    assert (output_dir / "joined" / "measures_bp002_achievem_long.csv").exists()
+    assert (output_dir / "joined" / "measures" / "measures_bp002_achievem.csv").exists()
+
+    compare(path, path)
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 1 + len(size_results)
+    assert all("time x 1.00" in line and "memory x 1.00" in line for line in lines[1:])
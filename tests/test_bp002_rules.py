@@ -0,0 +1,72 @@
+# The BP002 rules of all lookbacks extracted side by side are checked
+# against the business rules written out with boolean columns, one lookback
+# at a time
+import numpy as np
+import pandas as pd
+import pytest
+
+from bp002_rules import bp002_rules, bp002_shared_rules
+from config import lookback_years
+from rule_engine import evaluate_rules
+
+
+def naive_rules(age, bp_rec, bp_dec, reg_dat_3m):
+    r1 = age >= 45
+    r2 = bp_rec
+    r3 = ~bp_dec
+    r4 = reg_dat_3m
+    denominator = r1 & (r2 | (r3 & r4))
+    return {
+        "denominator_r1": r1,
+        "denominator_r2": r2,
+        "denominator_r3": r3,
+        "denominator_r4": r4,
+        "excl_denominator_r3": bp_dec,
+        "excl_denominator_r4": ~reg_dat_3m,
+        "denominator_r1_reject": r1,
+        "denominator_r2_select": r1 & r2,
+        "denominator_r3_reject": r1 & ~r2 & bp_dec,
+        "denominator_r4_reject": r1 & ~r2 & r3 & ~r4,
+        "denominator": denominator,
+        "numerator": denominator & r2,
+    }
+
+
+@pytest.fixture
+def cohort():
+    rng = np.random.default_rng(20)
+    n = 5000
+    df = pd.DataFrame({"age": rng.integers(18, 100, n), "reg_dat_3m": rng.integers(0, 2, n)})
+    for lookback in lookback_years:
+        df[f"bp_rec_{lookback}"] = rng.integers(0, 2, n)
+        df[f"bp_dec_{lookback}"] = rng.integers(0, 2, n)
+    return df
+
+
+def test_combined_rules_match_business_rules(cohort):
+    rules = bp002_shared_rules()
+    for lookback in lookback_years:
+        rules.update(bp002_rules(lookback, combined=True))
+    result = evaluate_rules(cohort, rules)
+    for lookback in lookback_years:
+        expected = naive_rules(
+            cohort["age"].to_numpy(),
+            cohort[f"bp_rec_{lookback}"].to_numpy() == 1,
+            cohort[f"bp_dec_{lookback}"].to_numpy() == 1,
+            cohort["reg_dat_3m"].to_numpy() == 1,
+        )
+        for rule, values in expected.items():
+            name = f"bp002_{rule}" if f"bp002_{rule}" in rules else f"bp002_{lookback}_{rule}"
+            assert result[name].tolist() == values.astype(int).tolist(), name
+
+
+def test_single_lookback_rules(cohort):
+    for lookback in lookback_years:
+        combined = bp002_shared_rules()
+        combined.update(bp002_rules(lookback, combined=True))
+        single = evaluate_rules(cohort, bp002_rules(lookback))
+        combined = evaluate_rules(cohort, combined)
+        prefix = f"bp002_{lookback}_"
+        combined = combined.rename(columns=lambda name: name.replace(prefix, "bp002_"))
+        assert sorted(single.columns) == sorted(combined.columns)
+        pd.testing.assert_frame_equal(single, combined[single.columns], check_dtype=False)
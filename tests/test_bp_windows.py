@@ -0,0 +1,117 @@
+# The lookback flags derived from the latest event date of every month are
+# checked against a naive reference that looks for an event in every
+# lookback period of every patient and index date
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from bp_windows import event_months, latest_event_dates, window_flags, write_windows
+from config import lookback_years
+from utils import add_months, last_day_of_month, month_starts
+
+START_DATE = "2019-01-01"
+END_DATE = "2019-12-01"
+INDEX_DATES = month_starts(START_DATE, END_DATE)
+LOOKBACKS = lookback_years
+MONTHS = event_months(INDEX_DATES)
+
+
+def naive_flag(dates, index_date, years):
+    start = add_months(index_date, -12 * years)
+    end = last_day_of_month(index_date)
+    return int(any(start <= date <= end for date in dates))
+
+
+@pytest.fixture
+def events():
+    rng = np.random.default_rng(10)
+    # Event dates on and around the boundaries of the lookback periods
+    boundaries = []
+    for index_date in INDEX_DATES:
+        for years in LOOKBACKS.values():
+            start = add_months(index_date, -12 * years)
+            boundaries += [start, start - datetime.timedelta(days=1)]
+        end = last_day_of_month(index_date)
+        boundaries += [end, end + datetime.timedelta(days=1)]
+    n = 1500
+    return pd.DataFrame(
+        {
+            "patient_id": rng.integers(1, 300, n),
+            "date": [boundaries[i] for i in rng.choice(len(boundaries), n)],
+        }
+    )
+
+
+def test_flags_match_naive_reference(events):
+    patients = np.arange(0, 320)
+    latest = {"bp_rec": latest_event_dates(events["patient_id"], events["date"], patients, MONTHS)}
+    flags = dict(window_flags(patients, latest, MONTHS, INDEX_DATES, LOOKBACKS))
+    assert list(flags) == INDEX_DATES
+    dates = events.groupby("patient_id")["date"].apply(list).to_dict()
+    for index_date in INDEX_DATES:
+        df = flags[index_date]
+        assert df["patient_id"].tolist() == patients.tolist()
+        for lookback, years in LOOKBACKS.items():
+            expected = [
+                naive_flag(dates.get(patient, []), index_date, years) for patient in patients
+            ]
+            assert df[f"bp_rec_{lookback}"].tolist() == expected
+
+
+def test_latest_event_dates_per_month(events):
+    patients = np.arange(0, 320)
+    latest = latest_event_dates(events["patient_id"], events["date"], patients, MONTHS)
+    events = events[
+        (events["date"] >= MONTHS[0]) & (events["date"] <= last_day_of_month(MONTHS[-1]))
+    ]
+    month = pd.to_datetime(events["date"]).dt.to_period("M")
+    expected = events.groupby(["patient_id", month])["date"].max()
+    rows, columns = np.nonzero(~np.isnat(latest))
+    result = {
+        (patients[row], pd.Period(MONTHS[column], "M")): latest[row, column].item()
+        for row, column in zip(rows, columns)
+    }
+    assert result == expected.to_dict()
+
+
+def test_window_flags_require_covered_months(events):
+    patients = np.arange(0, 320)
+    with pytest.raises(ValueError):
+        latest_event_dates(events["patient_id"], events["date"], [3, 1, 2], MONTHS)
+    latest = {"bp_rec": latest_event_dates(events["patient_id"], events["date"], patients, MONTHS)}
+    # The first index date needs the months before MONTHS[1]
+    with pytest.raises(ValueError):
+        list(window_flags(patients, {"bp_rec": latest["bp_rec"][:, 1:]}, MONTHS[1:], INDEX_DATES))
+    # By default, all index dates whose lookback periods are covered
+    assert [d for d, _ in window_flags(patients, latest, MONTHS)] == INDEX_DATES
+
+
+def test_write_windows(events, tmp_path):
+    # An extraction with the latest event date per month, unsorted
+    patients = np.sort(events["patient_id"].unique())[::-1]
+    columns = {"patient_id": patients}
+    for prefix in ["bp_rec", "bp_dec"]:
+        latest = latest_event_dates(
+            events["patient_id"], events["date"], np.sort(patients), MONTHS
+        )[::-1]
+        for position, month in enumerate(MONTHS):
+            columns[f"{prefix}_date_{month:%Y_%m}"] = pd.to_datetime(latest[:, position])
+    cohort = pd.DataFrame(columns)
+    path = tmp_path / "input_bp_events.feather"
+    cohort.to_feather(path)
+
+    paths = write_windows(path, tmp_path / "windows")
+    assert len(paths) == len(INDEX_DATES)
+    dates = events.groupby("patient_id")["date"].apply(list).to_dict()
+    for index_date, window_path in zip(INDEX_DATES, paths):
+        df = pd.read_feather(window_path)
+        # Sorted by patient_id, only patients with a flag
+        assert (np.diff(df["patient_id"]) > 0).all()
+        flagged = sorted(
+            patient
+            for patient in patients
+            if any(naive_flag(dates[patient], index_date, years) for years in LOOKBACKS.values())
+        )
+        assert df["patient_id"].tolist() == flagged
@@ -0,0 +1,87 @@
+# Membership tests and category lookups of the compiled codelists are
+# checked against a Python set and dict read from every codelist CSV file
+import numpy as np
+import pandas as pd
+import pytest
+
+from codelist_index import (
+    ROOT_DIR,
+    codelists_hash,
+    compile_codelists,
+    load_codelists,
+    read_codelist_definitions,
+)
+
+
+def naive_codelist(definition):
+    df = pd.read_csv(ROOT_DIR / definition["path"], dtype=str)
+    codes = df[definition["column"]].astype(int)
+    if definition["category_column"] is None:
+        return dict.fromkeys(codes)
+    return dict(zip(codes, df[definition["category_column"]]))
+
+
+@pytest.fixture(scope="module")
+def definitions():
+    return read_codelist_definitions()
+
+
+def test_definitions(definitions):
+    assert {"bp_codes", "ethnicity_codes", "ethnicity16_codes", "ethnicity6_codes"} <= set(
+        definitions
+    )
+    assert definitions["ethnicity16_codes"]["path"] == definitions["ethnicity_codes"]["path"]
+    assert definitions["ethnicity16_codes"]["category_column"] == "Grouping_16"
+    assert definitions["ethnicity6_codes"]["category_column"] == "Grouping_6"
+
+
+def test_codelists_match_csv(definitions, tmp_path):
+    rng = np.random.default_rng(15)
+    # Built and cached on the first call, read from the cache on the second
+    for codelists in [load_codelists(tmp_path), load_codelists(tmp_path)]:
+        assert set(codelists) == set(definitions)
+        for name, definition in definitions.items():
+            expected = naive_codelist(definition)
+            codes = np.array(list(expected), dtype=np.int64)
+            values = np.concatenate(
+                [codes, codes + 1, codes - 1, rng.integers(0, 10**15, 1000), [0, -1]]
+            )
+            rng.shuffle(values)
+            codelist = codelists[name]
+            assert len(codelist) == len(expected)
+            assert codelist.contains(values).tolist() == [v in expected for v in values], name
+            if definition["category_column"] is None:
+                with pytest.raises(ValueError):
+                    codelist.categorise(values)
+            else:
+                assert codelist.categorise(values).tolist() == [
+                    expected.get(v) for v in values
+                ], name
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_duplicate_codes(tmp_path):
+    pd.DataFrame({"code": ["1", "2", "1"]}).to_csv(tmp_path / "dup.csv", index=False)
+    definitions = {"dup": {"path": "dup.csv", "column": "code", "category_column": None}}
+    with pytest.raises(ValueError):
+        compile_codelists(definitions, root=tmp_path)
+
+
+def test_empty_codelist(tmp_path):
+    pd.DataFrame({"code": []}).to_csv(tmp_path / "empty.csv", index=False)
+    definitions = {"empty": {"path": "empty.csv", "column": "code", "category_column": None}}
+    codelist = compile_codelists(definitions, root=tmp_path)["empty"]
+    assert codelist.contains([1, 2]).tolist() == [False, False]
+
+
+def test_hash_changes_with_csv(tmp_path):
+    # Editing a codelist CSV (not its definition) changes the cache key
+    definitions = tmp_path / "codelists_test.py"
+    definitions.write_text(
+        'test_codes = codelist_from_csv("test.csv", system="snomed", column="code")\n'
+    )
+    pd.DataFrame({"code": ["1", "2"]}).to_csv(tmp_path / "test.csv", index=False)
+    key = codelists_hash([definitions], root=tmp_path)
+    assert codelists_hash([definitions], root=tmp_path) == key
+    pd.DataFrame({"code": ["1", "3"]}).to_csv(tmp_path / "test.csv", index=False)
+    assert codelists_hash([definitions], root=tmp_path) != key
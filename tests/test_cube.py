@@ -0,0 +1,82 @@
+# Every grouping of the cube (aggregated from the rows or rolled up from a
+# finer grouping) is checked against a pandas groupby of the rows
+import numpy as np
+import pandas as pd
+import pytest
+
+from cube import aggregate_cube, plan
+
+GROUPINGS = [
+    (),
+    ("sex",),
+    ("age_band",),
+    ("region",),
+    ("practice",),
+    ("age_band", "sex"),
+    ("sex", "age_band"),
+    ("age_band", "sex", "region"),
+    ("region", "practice"),
+]
+
+VALUES = ["numerator", "denominator"]
+
+
+@pytest.fixture
+def df():
+    rng = np.random.default_rng(2)
+    n = 2000
+    age_band = rng.choice(["18-29", "30-39", "40-49", "50-59", "60+"], n).astype(object)
+    age_band[rng.random(n) < 0.05] = None
+    sex = rng.choice(["F", "M"], n).astype(object)
+    sex[rng.random(n) < 0.02] = None
+    region = pd.Categorical(rng.choice(["East", "London", "North", "South"], n))
+    denominator = rng.integers(0, 2, n)
+    return pd.DataFrame(
+        {
+            "age_band": age_band,
+            "sex": sex,
+            "region": region,
+            "practice": rng.integers(1, 60, n),
+            "numerator": denominator * rng.integers(0, 2, n),
+            "denominator": denominator,
+        }
+    )
+
+
+def naive_aggregate(df, grouping):
+    if not grouping:
+        return df[VALUES].sum().to_frame().T.astype(np.int64)
+    result = df.groupby(list(grouping), sort=True, dropna=True, observed=True)[VALUES].sum()
+    return result.reset_index().astype({value: np.int64 for value in VALUES})
+
+
+@pytest.mark.parametrize("max_cells", [1_000_000, 50, 1])
+def test_cube_matches_groupby(df, max_cells):
+    results = aggregate_cube(df, GROUPINGS, VALUES, max_cells=max_cells)
+    assert set(results) == set(GROUPINGS)
+    for grouping in GROUPINGS:
+        result = results[grouping].reset_index(drop=True)
+        expected = naive_aggregate(df, grouping)
+        for column in grouping:
+            result[column] = result[column].astype(object)
+            expected[column] = expected[column].astype(object)
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_rows_with_missing_values_are_kept_in_coarser_groupings(df):
+    # age_band x sex leaves out rows without a sex, age_band (rolled up from
+    # it) and the total must not
+    results = aggregate_cube(df, [("age_band", "sex"), ("age_band",), ()], VALUES)
+    by_age_sex = results[("age_band", "sex")]["denominator"].sum()
+    by_age = results[("age_band",)]["denominator"].sum()
+    assert by_age == df.loc[df["age_band"].notna(), "denominator"].sum()
+    assert by_age_sex < by_age
+    assert results[()]["denominator"].item() == df["denominator"].sum()
+
+
+def test_plan_merges_groupings_within_max_cells():
+    cardinalities = {"a": 3, "b": 4, "c": 1000}
+    groupings = [("a",), ("b",), ("a", "b"), ("c",)]
+    # ("a",) and ("b",) are rolled up from ("a", "b")
+    assert plan(groupings, cardinalities, max_cells=10) == [("c",), ("a", "b")]
+    assert plan(groupings, cardinalities, max_cells=1_000_000) == [("c", "a", "b")]
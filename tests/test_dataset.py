@@ -0,0 +1,101 @@
+# Cohorts written to the Parquet dataset (in batches) are read back and
+# checked against splitting the cohort by lookback with pandas
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+import pytest
+
+from dataset import CohortWriter, partitions, read_dataset, read_partition, variable_lookback
+
+INDEX_DATES = ["2021-01-01", "2021-02-01"]
+
+
+@pytest.fixture
+def cohorts():
+    rng = np.random.default_rng(14)
+    cohorts = {}
+    for index_date in INDEX_DATES:
+        n = 1000
+        region = rng.choice(["London", "East", "North"], n).astype(object)
+        region[rng.random(n) < 0.05] = None
+        cohorts[index_date] = pd.DataFrame(
+            {
+                "patient_id": np.arange(n),
+                "region": region,
+                "bp002_1y_numerator": rng.integers(0, 2, n),
+                "bp002_5y_numerator": rng.integers(0, 2, n),
+                "bp_rec_1y": rng.integers(0, 2, n),
+                "bp_rec_5y": rng.integers(0, 2, n),
+                "bp002_denominator_r1": rng.integers(0, 2, n),
+            }
+        )
+    return cohorts
+
+
+@pytest.fixture
+def dataset_dir(tmp_path, cohorts):
+    for index_date, df in cohorts.items():
+        writer = CohortWriter(tmp_path / "bp002", index_date)
+        # Batches with different categories (and dictionaries)
+        df = df.sort_values("region", na_position="first")
+        for start in range(0, len(df), 400):
+            writer.write(df.iloc[start : start + 400].sort_index())
+        writer.close()
+    return tmp_path / "bp002"
+
+
+def naive_split(df, lookback):
+    columns = {}
+    for name in df.columns:
+        name_lookback, variable = variable_lookback(name)
+        if name_lookback in (None, lookback):
+            columns[name] = variable
+    return df[list(columns)].rename(columns=columns)
+
+
+def rows(df):
+    # Rows as tuples with None for missing values, in patient_id order
+    df = df.sort_values("patient_id").astype(object)
+    return [tuple(None if pd.isna(v) else v for v in row) for row in df.itertuples(index=False)]
+
+
+def test_variable_lookback():
+    assert variable_lookback("bp002_1y_numerator") == ("1y", "bp002_numerator")
+    assert variable_lookback("bp002_5y_excl_denominator_r3") == ("5y", "bp002_excl_denominator_r3")
+    assert variable_lookback("bp_dec_5y") == ("5y", "bp_dec")
+    assert variable_lookback("bp002_denominator_r1") == (None, "bp002_denominator_r1")
+    assert variable_lookback("region") == (None, "region")
+
+
+def test_partitions(dataset_dir):
+    found = partitions(dataset_dir)
+    assert [(lookback, index_date) for lookback, index_date, _ in found] == [
+        (lookback, index_date) for lookback in ["1y", "5y"] for index_date in INDEX_DATES
+    ]
+    assert len(partitions(dataset_dir, lookbacks=["5y"], index_dates=INDEX_DATES[1:])) == 1
+
+
+def test_partitions_match_split_cohorts(dataset_dir, cohorts):
+    for lookback, index_date, path in partitions(dataset_dir):
+        df = read_partition(path)
+        expected = naive_split(cohorts[index_date], lookback)
+        assert list(df.columns) == list(expected.columns)
+        assert rows(df) == rows(expected)
+        # Text columns are categoricals with sorted categories
+        assert list(df["region"].cat.categories) == ["East", "London", "North"]
+
+
+def test_read_dataset_with_filters(dataset_dir, cohorts):
+    df = read_dataset(
+        dataset_dir,
+        columns=["patient_id", "region", "bp002_numerator"],
+        lookbacks=["5y"],
+        index_dates=[INDEX_DATES[0]],
+        filter=ds.field("region") == "London",
+    )
+    cohort = cohorts[INDEX_DATES[0]]
+    expected = naive_split(cohort[cohort["region"] == "London"], "5y")
+    expected = expected[["patient_id", "region", "bp002_numerator"]]
+    assert set(df["lookback"]) == {"5y"}
+    assert set(df["index_date"]) == {INDEX_DATES[0]}
+    assert rows(df.drop(columns=["lookback", "index_date"])) == rows(expected)
@@ -0,0 +1,101 @@
+# The vectorised disclosure control is checked against a naive reference
+# that suppresses and rounds one table at a time
+import numpy as np
+import pandas as pd
+import pytest
+
+from disclosure import THRESHOLD, disclosure_control, round_counts, suppress
+
+
+def naive_suppress(df, by, threshold=THRESHOLD):
+    # Redacted rows (primary, secondary) of every table
+    primary = np.zeros(len(df), dtype=bool)
+    secondary = np.zeros(len(df), dtype=bool)
+    for _, table in df.reset_index(drop=True).groupby(by, sort=False, dropna=False):
+        rows = []
+        for row, num, den in zip(table.index, table["numerator"], table["denominator"]):
+            primary[row] = 0 < num <= threshold or 0 < den <= threshold
+            rows.append((row, num))
+        redacted = sum(num for row, num in rows if primary[row])
+        if 0 < redacted <= threshold:
+            candidates = [(num, row) for row, num in rows if not primary[row] and num > 0]
+            if candidates:
+                secondary[min(candidates)[1]] = True
+    return primary, secondary
+
+
+def naive_round(value, base=10):
+    # Python rounds halves to even
+    return None if pd.isna(value) else int(round(value / base) * base)
+
+
+@pytest.fixture
+def df():
+    rng = np.random.default_rng(3)
+    n = 3000
+    denominator = rng.choice([0, 1, 3, 5, 6, 7, 12, 25, 40, 300], n)
+    numerator = np.minimum(denominator, rng.choice([0, 1, 2, 4, 5, 6, 9, 15, 35, 200], n))
+    return pd.DataFrame(
+        {
+            "lookback": rng.choice(["1y", "5y"], n),
+            "date": rng.choice(["2021-01-01", "2021-02-01"], n),
+            "group": rng.choice(["population", "sex", "age_band", "region"], n),
+            "numerator": numerator,
+            "denominator": denominator,
+        }
+    )
+
+
+def test_suppression_matches_naive_reference(df):
+    by = ["lookback", "date", "group"]
+    released, primary, secondary = suppress(df, "numerator", "denominator", by)
+    expected_primary, expected_secondary = naive_suppress(df, by)
+    np.testing.assert_array_equal(primary, expected_primary)
+    np.testing.assert_array_equal(secondary, expected_secondary)
+    redacted = primary | secondary
+    assert released.loc[redacted, ["numerator", "denominator"]].isna().all().all()
+    assert (released.loc[~redacted, "numerator"] == df.loc[~redacted, "numerator"]).all()
+
+
+def test_disclosure_control_matches_naive_reference(df):
+    by = ["lookback", "date", "group"]
+    released, audit = disclosure_control(df, "numerator", "denominator", by)
+    primary, secondary = naive_suppress(df, by)
+    redacted = primary | secondary
+    for column in ["numerator", "denominator"]:
+        expected = [None if r else naive_round(v) for r, v in zip(redacted, df[column])]
+        assert [None if pd.isna(v) else int(v) for v in released[column]] == expected
+    num = released["numerator"].astype("Float64")
+    den = released["denominator"].astype("Float64")
+    expected_value = (num / den).mask(den == 0)
+    pd.testing.assert_series_equal(released["value"], expected_value, check_names=False)
+    assert audit[["check_small", "check_rounded", "check_secondary"]].all().all()
+    assert audit["primary_suppressed"].sum() == primary.sum()
+    assert audit["secondary_suppressed"].sum() == secondary.sum()
+
+
+@pytest.mark.parametrize(
+    "numerators, denominators, primary, secondary",
+    [
+        # 0 is not a small number, 5 is, 6 is not
+        ([0, 5, 6], [10, 10, 10], [False, True, False], [False, False, True]),
+        # Small denominators are redacted with their numerators
+        ([0, 0, 8], [4, 10, 10], [True, False, False], [False, False, False]),
+        # More than THRESHOLD redacted in total: no secondary suppression
+        ([3, 4, 9], [10, 10, 10], [True, True, False], [False, False, False]),
+        # Ties: the first of the smallest numerators
+        ([2, 7, 7], [10, 10, 10], [True, False, False], [False, True, False]),
+        # Nothing left to redact
+        ([2, 0, 0], [10, 10, 10], [True, False, False], [False, False, False]),
+    ],
+)
+def test_suppression_edge_cases(numerators, denominators, primary, secondary):
+    df = pd.DataFrame({"date": "2021-01-01", "numerator": numerators, "denominator": denominators})
+    _, result_primary, result_secondary = suppress(df, "numerator", "denominator", ["date"])
+    assert result_primary.tolist() == primary
+    assert result_secondary.tolist() == secondary
+
+
+def test_round_counts_halves_to_even():
+    values = pd.Series([0, 4, 5, 14, 15, 25, 35, 996, None], dtype="Int64")
+    assert round_counts(values).tolist() == [0, 0, 0, 10, 20, 20, 40, 1000, pd.NA]
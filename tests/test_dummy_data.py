@@ -0,0 +1,80 @@
+# The generated cohorts are checked for consistency with the generated
+# patients and events: the latest event date of every month is recomputed
+# from the event level data with pandas and the population rules are checked row by row
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from codelist_index import load_codelists
+from bp_windows import event_months
+from config import end_date, start_date
+from dummy_data import generate
+from utils import last_day_of_month, month_starts
+
+INDEX_DATES = month_starts(start_date, "2019-05-01")
+
+
+@pytest.fixture(scope="module")
+def data(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("dummy")
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        # The codelist index is cached below the working directory
+        monkeypatch.chdir(directory)
+        generate(directory, 3000, chunk_size=700, seed=3, index_dates=INDEX_DATES)
+        codelists = load_codelists()
+    return directory, codelists
+
+
+def test_patients(data):
+    directory, _ = data
+    patients = pd.read_feather(directory / "dummy_patients.feather")
+    assert patients["patient_id"].tolist() == list(range(1, 3001))
+    spells = pd.read_feather(directory / "input_registration_spells.feather")
+    assert set(spells["patient_id"]) <= set(patients["patient_id"])
+    ethnicity = pd.read_feather(directory / "input_ethnicity.feather")
+    assert ethnicity["patient_id"].tolist() == patients["patient_id"].tolist()
+
+
+def test_latest_event_dates_match_events(data):
+    directory, codelists = data
+    events = pd.read_feather(directory / "dummy_events.feather")
+    cohort = pd.read_feather(directory / "input_bp_events.feather").set_index("patient_id")
+    months = event_months(month_starts(start_date, end_date))
+    event_patients = set()
+    for prefix, codelist in [("bp_rec", "bp_codes"), ("bp_dec", "bp_dec_codes")]:
+        selected = events[codelists[codelist].contains(events["code"])]
+        event_patients |= set(selected["patient_id"])
+        # Latest event of every patient and month
+        month = selected["date"].dt.to_period("M").dt.start_time.dt.date
+        expected = selected.groupby(["patient_id", month])["date"].max().dt.date
+        result = {}
+        for month in months:
+            dates = cohort[f"{prefix}_date_{month:%Y_%m}"].dropna().dt.date
+            result.update({(patient_id, month): date for patient_id, date in dates.items()})
+        assert result == expected.to_dict()
+    assert sorted(cohort.index) == sorted(event_patients)
+
+
+def test_cohorts_follow_population_rules(data):
+    directory, _ = data
+    patients = pd.read_feather(directory / "dummy_patients.feather").set_index("patient_id")
+    for index_date in INDEX_DATES:
+        cohort = pd.read_feather(directory / f"input_bp002_{index_date}.feather")
+        assert len(cohort) > 0
+        assert not any(name.startswith(("bp002_1y_", "bp_rec_")) for name in cohort.columns)
+        rows = patients.loc[cohort["patient_id"]]
+        reference = last_day_of_month(index_date) + datetime.timedelta(days=1)
+        birth = rows["date_of_birth"].dt.date
+        age = [
+            reference.year - b.year - ((reference.month, reference.day) < (b.month, b.day))
+            for b in birth
+        ]
+        assert cohort["age"].tolist() == age
+        assert (cohort["age"] >= 45).all()
+        assert cohort["sex"].isin(["F", "M"]).all()
+        assert (cohort["gms_reg_status"] == 1).all()
+        died_on = rows["died_on"].dt.date
+        assert not (died_on <= last_day_of_month(index_date)).fillna(False).any()
+        assert np.array_equal(cohort["bp002_denominator_r1"], (cohort["age"] >= 45).astype(int))
@@ -0,0 +1,37 @@
+# The ethnicity groupings are checked against a lookup of every code in the
+# Grouping_16 and Grouping_6 columns of the ethnicity codelist CSV file
+import numpy as np
+import pandas as pd
+
+from codelist_index import ROOT_DIR
+from ethnicity import ETHNICITY6_LABELS, ETHNICITY16_LABELS, UNKNOWN, add_ethnicity_groupings
+
+
+def none_if_missing(value):
+    return None if pd.isna(value) else value
+
+
+def test_groupings_match_csv(tmp_path, monkeypatch):
+    # The codelist index is cached below the working directory
+    monkeypatch.chdir(tmp_path)
+    csv = pd.read_csv(
+        ROOT_DIR / "codelists" / "opensafely-ethnicity-snomed-0removed.csv", dtype=str
+    )
+    lookup = dict(zip(csv["snomedcode"], zip(csv["Grouping_16"], csv["Grouping_6"])))
+    rng = np.random.default_rng(16)
+    n = 5000
+    values = rng.choice(list(lookup) + ["123", "", " ", "x"], n).astype(object)
+    values[rng.random(n) < 0.1] = None
+    df = add_ethnicity_groupings(
+        pd.DataFrame({"patient_id": np.arange(n), "ethnicity_code": values, "eth16": "stale"})
+    )
+    assert list(df.columns) == [
+        "patient_id", "ethnicity_code", "eth16", "ethnicity16", "eth6", "ethnicity6"
+    ]
+    for value, eth16, ethnicity16, eth6, ethnicity6 in df[
+        ["ethnicity_code", "eth16", "ethnicity16", "eth6", "ethnicity6"]
+    ].values:
+        g16, g6 = lookup.get(value, (None, None))
+        assert none_if_missing(eth16) == g16 and none_if_missing(eth6) == g6
+        assert ethnicity16 == ETHNICITY16_LABELS.get(g16, UNKNOWN)
+        assert ethnicity6 == ETHNICITY6_LABELS.get(g6, UNKNOWN)
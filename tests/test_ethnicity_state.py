@@ -0,0 +1,84 @@
+# The state folded from a full extraction and incremental extractions since
+# the watermark is checked against the latest record of every patient in
+# the full event history, like a full extraction at the last watermark
+import datetime
+
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+import pytest
+
+from ethnicity_state import EthnicityState
+
+PATIENTS = np.arange(500)
+
+
+@pytest.fixture
+def events():
+    rng = np.random.default_rng(17)
+    n = 3000
+    dates = pd.Timestamp("2018-01-01") + pd.to_timedelta(rng.integers(0, 900, n), unit="D")
+    df = pd.DataFrame(
+        {
+            "patient_id": rng.choice(PATIENTS, n),
+            "ethnicity_code": rng.integers(10**8, 10**9, n).astype(str),
+            "ethnicity_code_date": dates,
+        }
+    )
+    # One record per patient and date, so that the latest record is unique
+    return df.drop_duplicates(["patient_id", "ethnicity_code_date"])
+
+
+def extract(events, path, since=None, until=None):
+    # Latest record of every patient between since and until (inclusive),
+    # like study_definition_ethnicity.py
+    dates = events["ethnicity_code_date"]
+    period = dates <= pd.Timestamp(until)
+    if since is not None:
+        period &= dates >= pd.Timestamp(since)
+    latest = events[period].sort_values("ethnicity_code_date").groupby("patient_id").last()
+    df = pd.DataFrame({"patient_id": PATIENTS}).merge(
+        latest.reset_index(), on="patient_id", how="left"
+    )
+    feather.write_feather(df, path)
+    return path
+
+
+def test_incremental_state_matches_full_extraction(events, tmp_path):
+    state = EthnicityState(tmp_path / "state")
+    assert state.since() is None
+    watermarks = ["2018-12-31", "2019-03-15", "2019-03-16", "2020-06-30"]
+    path = extract(events, tmp_path / "full.feather", until=watermarks[0])
+    state.update(path, watermarks[0], full=True)
+    for watermark in watermarks[1:]:
+        path = extract(events, tmp_path / "update.feather", state.since(), watermark)
+        state.update(path, watermark)
+        assert state.since() == watermark
+
+    state.export(tmp_path / "input_ethnicity.feather")
+    result = pd.read_feather(tmp_path / "input_ethnicity.feather").sort_values("patient_id")
+    expected = pd.read_feather(extract(events, tmp_path / "expected.feather", until=watermarks[-1]))
+    assert result["patient_id"].tolist() == expected["patient_id"].tolist()
+    for column in ["ethnicity_code", "ethnicity_code_date"]:
+        assert [None if pd.isna(v) else v for v in result[column]] == [
+            None if pd.isna(v) else v for v in expected[column]
+        ], column
+
+
+def test_update_errors(events, tmp_path):
+    state = EthnicityState(tmp_path / "state")
+    path = extract(events, tmp_path / "full.feather", until="2019-01-01")
+    # No state yet
+    with pytest.raises(ValueError):
+        state.update(path, "2019-01-01")
+    with pytest.raises(ValueError):
+        state.export(tmp_path / "input_ethnicity.feather")
+    # Records after the watermark
+    with pytest.raises(ValueError):
+        state.update(path, datetime.date(2018, 12, 31), full=True)
+    state.update(path, "2019-01-01", full=True)
+    # Extraction until a date before the watermark
+    path = extract(events, tmp_path / "update.feather", "2018-11-01", "2018-12-01")
+    with pytest.raises(ValueError):
+        state.update(path, "2018-12-01")
+    assert state.since() == "2019-01-01"
@@ -0,0 +1,102 @@
+# The flowchart counts (bitsets and popcounts) are checked against a naive
+# reference that evaluates the select / reject cascade with boolean columns
+# and counts every step with a pandas groupby
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+import pytest
+
+from batches import batch_plan
+from dataset import CohortWriter
+from flowchart import STEPS, flowchart, rule_columns
+
+INDEX_DATES = ["2021-01-01", "2021-02-01"]
+LOOKBACKS = ["1y", "5y"]
+BREAKDOWNS = ["sex", "region", "imd_q5"]
+
+
+def naive_steps(df, columns):
+    r1, r2, r3, r4 = (df[columns[rule]].fillna(0) > 0 for rule in sorted(columns))
+    denominator = r1 & (r2 | (r3 & r4))
+    return pd.DataFrame(
+        {
+            "denominator_r1_reject": r1,
+            "denominator_r2_select": r1 & r2,
+            "denominator_r3_reject": r1 & ~r2 & ~r3,
+            "denominator_r4_reject": r1 & ~r2 & r3 & ~r4,
+            "denominator": denominator,
+            "numerator": denominator & r2,
+            "excl_denominator_r3": ~r3,
+            "excl_denominator_r4": ~r4,
+        }
+    )[STEPS]
+
+
+def naive_flowchart(cohorts):
+    rows = []
+    for lookback in LOOKBACKS:
+        for index_date, df in cohorts.items():
+            steps = naive_steps(df, rule_columns(lookback)).astype(int)
+            steps["population"] = 1
+            groups = [("population", pd.Series("population", index=df.index))]
+            groups += [(breakdown, df[breakdown]) for breakdown in BREAKDOWNS]
+            for group, values in groups:
+                counts = steps.groupby(values).sum()
+                for category, row in counts.sort_index().iterrows():
+                    for step in STEPS:
+                        row_key = (lookback, index_date, group, str(category), step)
+                        rows.append(row_key + (row[step], row["population"]))
+    return rows
+
+
+@pytest.fixture
+def cohorts(tmp_path):
+    rng = np.random.default_rng(18)
+    cohorts = {}
+    for index_date in INDEX_DATES:
+        n = 20_000
+        df = pd.DataFrame({"patient_id": np.arange(n)})
+        columns = {column for lookback in LOOKBACKS for column in rule_columns(lookback).values()}
+        for column in sorted(columns):
+            values = rng.integers(0, 2, n).astype(float)
+            values[rng.random(n) < 0.02] = np.nan
+            df[column] = values
+        for column, categories in [("sex", ["M", "F"]), ("region", ["North", "East", "London"])]:
+            values = rng.choice(categories, n).astype(object)
+            values[rng.random(n) < 0.02] = None
+            df[column] = values
+        df["imd_q5"] = rng.integers(0, 6, n)
+        cohorts[index_date] = df
+        feather.write_feather(df, tmp_path / f"input_bp002_{index_date}.feather")
+        writer = CohortWriter(tmp_path / "bp002", index_date)
+        writer.write(df)
+        writer.close()
+    return cohorts
+
+
+@pytest.mark.parametrize(
+    "workers, memory_limit, dataset",
+    [(1, None, False), (2, None, False), (1, 3_000_000, False), (1, None, True)],
+)
+def test_counts_match_naive_reference(cohorts, tmp_path, workers, memory_limit, dataset):
+    # With the memory limit every cohort is counted in batches
+    paths = [tmp_path / f"input_bp002_{index_date}.feather" for index_date in INDEX_DATES]
+    if memory_limit is not None:
+        assert batch_plan(paths, workers, memory_limit)[1] < len(cohorts[INDEX_DATES[0]])
+    df = flowchart(
+        [] if dataset else paths,
+        tmp_path / "bp002" if dataset else None,
+        LOOKBACKS,
+        BREAKDOWNS,
+        workers=workers,
+        memory_limit=memory_limit,
+    )
+    assert list(df.itertuples(index=False, name=None)) == naive_flowchart(cohorts)
+
+
+def test_index_dates(cohorts, tmp_path):
+    paths = [tmp_path / f"input_bp002_{index_date}.feather" for index_date in INDEX_DATES]
+    df = flowchart(paths, lookbacks=["1y"], breakdowns=[], index_dates=INDEX_DATES[1:])
+    assert set(df["date"]) == {INDEX_DATES[1]}
+    assert set(df["lookback"]) == {"1y"}
+    assert set(df["group"]) == {"population"}
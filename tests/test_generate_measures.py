@@ -0,0 +1,151 @@
+# The measure files are checked against a naive reference that groups
+# every monthly cohort by each measure's group_by with pandas, like
+# cohortextractor generate_measures
+import io
+
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+import pytest
+
+from bp002_measures import bp002_measures
+from disclosure import calculate_value, suppress
+from generate_measures import LONG_COLUMNS, generate_measures, measure_columns
+
+INDEX_DATES = ["2021-01-01", "2021-02-01"]
+
+CATEGORIES = {
+    "age_band": ["18-29", "30-39", "40-49", "50-59", "60-69", "70-79", "80+"],
+    "sex": ["F", "M"],
+    "region": ["East", "London", "North East", "South West"],
+    "ethnicity6": ["White", "Mixed", "Asian or Asian British", "Unknown"],
+    "ethnicity16": ["White - British", "White - Irish", "Unknown"],
+}
+
+
+def naive_measure(cohorts, measure):
+    frames = []
+    for index_date, df in cohorts.items():
+        columns = [measure["numerator"], measure["denominator"]]
+        if measure["group_by"] == ["population"]:
+            result = df[columns].sum().to_frame().T.assign(population=1)
+        else:
+            result = df.groupby(measure["group_by"], sort=True, dropna=True)[columns].sum()
+            result = result.reset_index()
+        result["date"] = index_date
+        frames.append(result)
+    df = pd.concat(frames, ignore_index=True)
+    if measure["small_number_suppression"]:
+        df, _, _ = suppress(df, measure["numerator"], measure["denominator"], by=["date"])
+    df["value"] = calculate_value(df, measure["numerator"], measure["denominator"])
+    return df[measure["group_by"] + [measure["numerator"], measure["denominator"], "value", "date"]]
+
+
+@pytest.fixture
+def cohorts(tmp_path):
+    rng = np.random.default_rng(13)
+    cohorts = {}
+    for index_date in INDEX_DATES:
+        n = 20_000
+        df = pd.DataFrame({"patient_id": np.arange(n)})
+        for column in measure_columns(bp002_measures()):
+            if column in CATEGORIES:
+                values = rng.choice(CATEGORIES[column], n).astype(object)
+                values[rng.random(n) < 0.01] = None
+                df[column] = values
+            elif column == "practice":
+                # Small practices, so that rows are suppressed
+                df[column] = rng.integers(1, 3000, n)
+            elif column == "imd_q5":
+                df[column] = rng.integers(0, 6, n)
+            else:
+                df[column] = rng.integers(0, 2, n)
+        cohorts[index_date] = df
+        feather.write_feather(df, tmp_path / f"input_bp002_{index_date}.feather")
+    return cohorts
+
+
+@pytest.mark.parametrize("workers, memory_limit", [(1, None), (2, None), (1, 6_000_000)])
+def test_measures_match_naive_reference(cohorts, tmp_path, workers, memory_limit):
+    # With the memory limit every cohort is aggregated in two batches
+    paths = [tmp_path / f"input_bp002_{index_date}.feather" for index_date in INDEX_DATES]
+    output_dir = tmp_path / "measures"
+    generate_measures(paths, output_dir, workers=workers, memory_limit=memory_limit)
+    for measure in bp002_measures():
+        result = pd.read_csv(output_dir / f"measure_{measure['id']}.csv")
+        expected = naive_measure(cohorts, measure)
+        expected = pd.read_csv(io.StringIO(expected.to_csv(index=False)))
+        pd.testing.assert_frame_equal(result, expected, obj=measure["id"])
+
+
+def test_no_cohorts_write_empty_measures(tmp_path):
+    # No matching cohorts: every measure file has the header only
+    output_dir = tmp_path / "measures"
+    generate_measures([], output_dir)
+    for measure in bp002_measures():
+        result = pd.read_csv(output_dir / f"measure_{measure['id']}.csv")
+        columns = measure["group_by"] + [measure["numerator"], measure["denominator"]]
+        assert list(result.columns) == columns + ["value", "date"]
+        assert result.empty
+
+
+def naive_long_measures(cohorts):
+    # Population and single breakdown measures (not practice), unsuppressed
+    frames = []
+    for measure in bp002_measures():
+        group = measure["group_by"][0]
+        if len(measure["group_by"]) > 1 or group == "practice":
+            continue
+        df = naive_measure(cohorts, dict(measure, small_number_suppression=False))
+        frames.append(
+            pd.DataFrame(
+                {
+                    "lookback": measure["numerator"].split("_")[1],
+                    "date": df["date"],
+                    "group": group,
+                    "category": "population" if group == "population" else df[group],
+                    "numerator": df[measure["numerator"]],
+                    "denominator": df[measure["denominator"]],
+                    "population": df["population"] if group == "population" else None,
+                    "value": df["value"],
+                }
+            )
+        )
+    return pd.concat(frames, ignore_index=True)
+
+
+def csv_rows(df):
+    # Rows as written to CSV, in sorted order
+    df = pd.read_csv(io.StringIO(df.to_csv(index=False)), dtype=str, keep_default_na=False)
+    return sorted(df.itertuples(index=False, name=None))
+
+
+def test_long_measures_match_naive_reference(cohorts, tmp_path):
+    paths = [tmp_path / f"input_bp002_{index_date}.feather" for index_date in INDEX_DATES]
+    long_path = tmp_path / "measures" / "long.csv"
+    generate_measures(paths, tmp_path / "measures", long_output=long_path)
+    result = pd.read_csv(long_path, dtype=str, keep_default_na=False)
+    assert list(result.columns) == LONG_COLUMNS
+    assert csv_rows(result) == csv_rows(naive_long_measures(cohorts))
+
+
+def test_append_keeps_other_dates(cohorts, tmp_path):
+    # Appending the months one by one gives the files of one run over all
+    # months, and a month that is calculated again replaces its rows
+    paths = [tmp_path / f"input_bp002_{index_date}.feather" for index_date in INDEX_DATES]
+    full_dir = tmp_path / "full"
+    generate_measures(paths, full_dir, long_output=full_dir / "long.csv")
+    append_dir = tmp_path / "append"
+    for index_dates in [INDEX_DATES[:1], INDEX_DATES[1:], INDEX_DATES[1:]]:
+        generate_measures(
+            paths,
+            append_dir,
+            long_output=append_dir / "long.csv",
+            append=True,
+            index_dates=index_dates,
+        )
+    for name in ["long.csv"] + [f"measure_{m['id']}.csv" for m in bp002_measures()]:
+        expected = pd.read_csv(full_dir / name, dtype=str, keep_default_na=False)
+        result = pd.read_csv(append_dir / name, dtype=str, keep_default_na=False)
+        assert list(result.columns) == list(expected.columns)
+        assert csv_rows(result) == csv_rows(expected), name
@@ -0,0 +1,82 @@
+# The joined cohorts are checked against a pandas left merge of every
+# monthly cohort with the ethnicity cohort
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+import pytest
+
+from codelist_index import ROOT_DIR, load_codelists
+from ethnicity import add_ethnicity_groupings
+from join_ethnicity import join_files
+
+
+def values(series):
+    # Values with None for any missing value
+    return [None if pd.isna(value) else value for value in series.astype(object)]
+
+
+@pytest.fixture
+def cohorts(tmp_path):
+    rng = np.random.default_rng(11)
+    paths = []
+    for index_date in ["2021-01-01", "2021-02-01", "2021-03-01"]:
+        n = 30_000
+        df = pd.DataFrame(
+            {
+                "patient_id": np.sort(rng.choice(60_000, n, replace=False)),
+                "bp002_numerator": rng.integers(0, 2, n),
+                # Replaced by the joined column
+                "ethnicity16": "stale",
+            }
+        )
+        paths.append(tmp_path / f"input_bp002_{index_date}.feather")
+        feather.write_feather(df, paths[-1])
+    return paths
+
+
+@pytest.fixture
+def ethnicity(tmp_path):
+    rng = np.random.default_rng(12)
+    codes = pd.read_csv(
+        ROOT_DIR / "codelists" / "opensafely-ethnicity-snomed-0removed.csv", dtype=str
+    )
+    n = 40_000
+    # Unsorted, with codes that are not in the codelist and missing codes
+    patient_id = rng.permutation(60_000)[:n]
+    ethnicity_code = rng.choice(list(codes["snomedcode"]) + ["123", ""], n).astype(object)
+    ethnicity_code[rng.random(n) < 0.1] = None
+    df = pd.DataFrame(
+        {
+            "patient_id": patient_id,
+            "ethnicity_code": ethnicity_code,
+            "ethnicity_code_date": pd.Timestamp("2020-01-01"),
+        }
+    )
+    path = tmp_path / "input_ethnicity.feather"
+    feather.write_feather(df, path)
+    return path
+
+
+@pytest.mark.parametrize("workers, memory_limit", [(1, None), (2, None), (1, 2_000_000)])
+def test_join_matches_merge(cohorts, ethnicity, tmp_path, monkeypatch, workers, memory_limit):
+    # The codelist index is cached below the working directory
+    monkeypatch.chdir(tmp_path)
+    joined = join_files(cohorts, ethnicity, tmp_path / "joined", workers, memory_limit)
+    assert joined == [[tmp_path / "joined" / path.name] for path in cohorts]
+
+    rhs = pd.read_feather(ethnicity).drop(columns="ethnicity_code_date")
+    rhs = add_ethnicity_groupings(rhs, codelists=load_codelists())
+    for path in cohorts:
+        lhs = pd.read_feather(path).drop(columns="ethnicity16")
+        expected = lhs.merge(rhs, on="patient_id", how="left")
+        result = pd.read_feather(tmp_path / "joined" / path.name)
+        assert list(result.columns) == list(expected.columns)
+        for column in expected.columns:
+            assert values(result[column]) == values(expected[column]), column
+
+
+def test_duplicate_patients(cohorts, tmp_path):
+    path = tmp_path / "rhs.feather"
+    feather.write_feather(pd.DataFrame({"patient_id": [1, 2, 2], "x": [1, 2, 3]}), path)
+    with pytest.raises(ValueError):
+        join_files(cohorts, path, tmp_path / "joined", workers=1)
@@ -0,0 +1,189 @@
+# Cohorts of a small study definition extracted by the local backend from
+# the event store are checked against a naive reference that evaluates every
+# variable for every patient from the source tables with plain Python
+import datetime
+import sys
+import textwrap
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import local_backend
+from event_store import EventStore, build, day_numbers
+from local_backend import generate_cohort
+
+BP_CODES = [1001, 1002, 1003]
+OTHER_CODES = [2001, 2002]
+INDEX_DATES = [datetime.date(2021, 1, 1), datetime.date(2021, 2, 1), datetime.date(2021, 3, 1)]
+
+STUDY = """
+from cohortextractor import StudyDefinition, codelist, patients
+
+bp_codes = codelist([1001, 1002, 1003], system="snomed")
+other_codes = codelist([2001, 2002], system="snomed")
+
+study = StudyDefinition(
+    index_date="2021-03-01",
+    population=patients.satisfying(
+        "registered AND NOT died",
+        registered=patients.registered_as_of("last_day_of_month(index_date)"),
+        died=patients.died_from_any_cause(on_or_before="last_day_of_month(index_date)"),
+    ),
+    age=patients.age_as_of("last_day_of_month(index_date)"),
+    bp_flag=patients.with_these_clinical_events(
+        bp_codes,
+        between=["first_day_of_month(index_date) - 1 year", "last_day_of_month(index_date)"],
+    ),
+    bp_date=patients.with_these_clinical_events(
+        bp_codes,
+        on_or_before="last_day_of_month(index_date)",
+        returning="date",
+        find_last_match_in_period=True,
+    ),
+    other_count=patients.with_these_clinical_events(
+        other_codes, on_or_after="2020-01-01", returning="number_of_matches_in_period"
+    ),
+    other_code=patients.with_these_clinical_events(
+        other_codes, returning="code", find_first_match_in_period=True
+    ),
+)
+"""
+
+
+@pytest.fixture(scope="module")
+def tables():
+    rng = np.random.default_rng(19)
+    n = 300
+    days = pd.Timestamp("2018-01-01") + pd.to_timedelta(rng.integers(0, 1300, 6000), unit="D")
+    events = pd.DataFrame(
+        {
+            "patient_id": rng.integers(1, n + 1, 6000),
+            "code": rng.choice(BP_CODES + OTHER_CODES + [3001], 6000).astype(str),
+            "date": days,
+        }
+    ).drop_duplicates(["patient_id", "date"])
+    died_on = pd.Series(pd.Timestamp("2020-06-01") + pd.to_timedelta(rng.integers(0, 400, n), "D"))
+    died_on[rng.random(n) < 0.8] = pd.NaT
+    patients = pd.DataFrame(
+        {
+            "patient_id": np.arange(1, n + 1),
+            "date_of_birth": pd.Timestamp("1930-01-01")
+            + pd.to_timedelta(rng.integers(0, 30_000, n), unit="D"),
+            "sex": rng.choice(["F", "M"], n),
+            "imd": rng.integers(1, 32_000, n).astype(float),
+            "died_on": died_on,
+        }
+    )
+    start = pd.Timestamp("2020-06-01") + pd.to_timedelta(rng.integers(0, 400, n), unit="D")
+    end = pd.Series(start + pd.to_timedelta(rng.integers(0, 300, n), unit="D"))
+    end[rng.random(n) < 0.5] = pd.NaT
+    registrations = pd.DataFrame(
+        {
+            "patient_id": np.arange(1, n + 1),
+            "start_date": start,
+            "end_date": end,
+            "practice": rng.integers(1, 20, n),
+            "region": rng.choice(["East", "London"], n),
+        }
+    )
+    return patients, events, registrations
+
+
+@pytest.fixture(scope="module")
+def store(tables, tmp_path_factory):
+    directory = tmp_path_factory.mktemp("store")
+    paths = []
+    for name, df in zip(["patients", "events", "registrations"], tables):
+        paths.append(directory / f"{name}.feather")
+        df.to_feather(paths[-1])
+    build(directory / "store.sqlite", paths[0], [paths[1]], paths[2])
+    return directory / "store.sqlite"
+
+
+def last_day(date):
+    return (pd.Timestamp(date) + pd.offsets.MonthEnd(0)).date()
+
+
+def naive_cohort(tables, index_date):
+    patients, events, registrations = tables
+    end = last_day(index_date)
+    start = datetime.date(index_date.year - 1, index_date.month, 1)
+    rows = []
+    for patient in patients.itertuples():
+        spells = registrations[registrations["patient_id"] == patient.patient_id]
+        registered = any(
+            s.start_date.date() <= end and (pd.isna(s.end_date) or end <= s.end_date.date())
+            for s in spells.itertuples()
+        )
+        died = pd.notna(patient.died_on) and patient.died_on.date() <= end
+        if not registered or died:
+            continue
+        birth = patient.date_of_birth.date()
+        age = end.year - birth.year - ((end.month, end.day) < (birth.month, birth.day))
+        own = [
+            (e.date.date(), int(e.code))
+            for e in events[events["patient_id"] == patient.patient_id].itertuples()
+        ]
+        bp = [(date, code) for date, code in own if code in BP_CODES]
+        other = sorted((date, code) for date, code in own if code in OTHER_CODES)
+        bp_dates = [date for date, _ in bp if date <= end]
+        rows.append(
+            (
+                patient.patient_id,
+                age,
+                int(any(start <= date <= end for date, _ in bp)),
+                max(bp_dates) if bp_dates else None,
+                sum(date >= datetime.date(2020, 1, 1) for date, _ in other),
+                str(other[0][1]) if other else None,
+            )
+        )
+    return rows
+
+
+def test_tagged_events(tables, store):
+    _, events, _ = tables
+    start, end = day_numbers(["2019-01-01", "2020-12-31"])
+    scanned = EventStore(store).tagged_events(
+        [np.array(BP_CODES), np.array([1003, 2001])], start, end
+    )
+    dates = events["date"].dt.date
+    selected = events[
+        events["code"].astype(int).isin(BP_CODES + [2001])
+        & (dates >= datetime.date(2019, 1, 1))
+        & (dates <= datetime.date(2020, 12, 31))
+    ]
+    expected = sorted(
+        (patient_id, int(code), (int(code) in BP_CODES) + 2 * (int(code) in (1003, 2001)))
+        for patient_id, code in zip(selected["patient_id"], selected["code"])
+    )
+    result = sorted(zip(scanned["patient_id"], scanned["code"], scanned["tags"]))
+    assert result == expected
+
+
+def test_cohorts_match_naive_reference(tables, store, tmp_path, monkeypatch):
+    # The study definition is imported from the (temporary) analysis
+    # directory with the stand-in cohortextractor module
+    (tmp_path / "study_definition_test.py").write_text(textwrap.dedent(STUDY))
+    monkeypatch.setattr(local_backend, "ANALYSIS_DIR", tmp_path)
+    monkeypatch.setitem(sys.modules, "cohortextractor", None)
+    paths = generate_cohort(
+        "study_definition_test",
+        "2021-01-01 to 2021-03-01 by month",
+        tmp_path / "output",
+        store=store,
+    )
+    assert [path.name for path in paths] == [
+        f"input_test_{index_date}.feather" for index_date in INDEX_DATES
+    ]
+    for index_date, path in zip(INDEX_DATES, paths):
+        df = pd.read_feather(path)
+        assert list(df.columns) == [
+            "patient_id", "age", "bp_flag", "bp_date", "other_count", "other_code"
+        ]
+        df["bp_date"] = df["bp_date"].dt.date
+        result = [
+            tuple(None if pd.isna(value) else value for value in row)
+            for row in df.itertuples(index=False, name=None)
+        ]
+        assert result == naive_cohort(tables, index_date)
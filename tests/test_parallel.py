@@ -0,0 +1,63 @@
+# parallel_map is checked against map(), and the worker count against the
+# --workers and --memory-limit bounds
+import os
+
+import pytest
+
+from parallel import parallel_map, parse_size, worker_count
+
+OFFSET = 0
+
+
+def set_offset(offset):
+    global OFFSET
+    OFFSET = offset
+
+
+def add_offset(item):
+    return (item + OFFSET, os.getpid())
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_parallel_map_matches_map(workers):
+    items = list(range(50))
+    results = parallel_map(add_offset, items, workers, initializer=set_offset, initargs=(100,))
+    # Results in input order, from the initialised workers
+    assert [value for value, _ in results] == [item + 100 for item in items]
+    pids = {pid for _, pid in results}
+    if workers == 1:
+        assert pids == {os.getpid()}
+    else:
+        assert os.getpid() not in pids
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        (None, None),
+        ("1000000", 1_000_000),
+        ("512M", 512 * 1024**2),
+        ("16G", 16 * 1024**3),
+        ("1.5gb", int(1.5 * 1024**3)),
+        (" 2 K ", 2048),
+    ],
+)
+def test_parse_size(value, expected):
+    assert parse_size(value) == expected
+
+
+@pytest.mark.parametrize("value", ["", "G", "-1G", "16X"])
+def test_parse_size_invalid(value):
+    with pytest.raises(ValueError):
+        parse_size(value)
+
+
+def test_worker_count():
+    assert worker_count(10, workers=4) == 4
+    # No more workers than tasks, at least one worker
+    assert worker_count(2, workers=4) == 2
+    assert worker_count(0, workers=4) == 1
+    # As many workers as fit into the memory limit
+    assert worker_count(10, workers=4, memory_limit=250, memory_per_worker=100) == 2
+    assert worker_count(10, workers=4, memory_limit=50, memory_per_worker=100) == 1
+    assert worker_count(10, workers=4, memory_limit=250) == 4
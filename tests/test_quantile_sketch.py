@@ -0,0 +1,113 @@
+# Quantiles of the t-digest are checked against pandas quantiles of the
+# values: exact below the compression, within a small rank error above it
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+import pytest
+
+from generate_measures import generate_measures
+from quantile_sketch import (
+    TDigest,
+    merge_digests,
+    rate_digest,
+    read_sketches,
+    sketch_path,
+    write_sketches,
+)
+
+QUANTILES = np.linspace(0, 1, 101)
+
+
+def rank_error(digest, values):
+    # Largest difference between q and the share of values below the
+    # estimated q quantile
+    values = np.sort(values)
+    estimates = digest.quantile(QUANTILES)
+    ranks = np.searchsorted(values, estimates, side="right") / len(values)
+    return np.abs(ranks - QUANTILES).max()
+
+
+@pytest.mark.parametrize("n", [1, 2, 17, 200])
+def test_exact_below_compression(n):
+    values = np.random.default_rng(n).normal(size=n)
+    digest = TDigest().update(values)
+    np.testing.assert_allclose(digest.quantile(QUANTILES), pd.Series(values).quantile(QUANTILES))
+
+
+def test_rank_error_above_compression():
+    values = np.random.default_rng(7).lognormal(size=100_000)
+    digest = TDigest()
+    for chunk in np.array_split(values, 37):
+        digest.update(chunk)
+    assert len(digest.means) < 1000
+    assert digest.count == len(values)
+    assert rank_error(digest, values) < 0.01
+
+
+def test_merge_matches_one_digest():
+    values = np.random.default_rng(8).uniform(size=20_000)
+    parts = [TDigest().update(chunk) for chunk in np.array_split(values, 12)]
+    merged = merge_digests(parts)
+    assert merged.count == len(values)
+    assert rank_error(merged, values) < 0.01
+
+
+def test_missing_values_and_empty_digest():
+    digest = TDigest().update([np.nan, 1.0, np.nan, 3.0])
+    assert digest.count == 2
+    assert digest.quantile(0.5) == 2.0
+    assert np.isnan(TDigest().quantile(0.5))
+
+
+def test_rate_digest_ignores_zero_denominators():
+    df = pd.DataFrame({"numerator": [1, 0, 3, 2], "denominator": [2, 0, 4, 0]})
+    digest = rate_digest(df, "numerator", "denominator")
+    np.testing.assert_array_equal(digest.means, [0.5, 0.75])
+
+
+def test_write_sketches_append(tmp_path):
+    path = sketch_path(tmp_path, "m")
+    write_sketches(path, "m", {"2021-01-01": TDigest().update([1, 2]), "2021-02-01": TDigest()})
+    write_sketches(path, "m", {"2021-02-01": TDigest().update([3])}, append=True)
+    digests = read_sketches(path)
+    assert sorted(digests) == ["2021-01-01", "2021-02-01"]
+    assert digests["2021-01-01"].means.tolist() == [1.0, 2.0]
+    assert digests["2021-02-01"].means.tolist() == [3.0]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_practice_sketches_use_suppressed_practice_rates(tmp_path, workers):
+    rng = np.random.default_rng(9)
+    paths = []
+    for index_date in ["2021-01-01", "2021-02-01"]:
+        n = 3000
+        denominator = rng.integers(0, 2, n)
+        df = pd.DataFrame(
+            {
+                "patient_id": np.arange(n),
+                "practice": rng.integers(1, 80, n),
+                "numerator": denominator * rng.integers(0, 2, n),
+                "denominator": denominator,
+            }
+        )
+        paths.append(tmp_path / f"input_{index_date}.feather")
+        feather.write_feather(df, paths[-1])
+    measures = [
+        dict(
+            id="practice_rate",
+            numerator="numerator",
+            denominator="denominator",
+            group_by=["practice"],
+            small_number_suppression=True,
+        )
+    ]
+    generate_measures(paths, tmp_path, measures, workers=workers)
+    # The sketched rates are the (not redacted) values of the measure file
+    measure = pd.read_csv(tmp_path / "measure_practice_rate.csv")
+    digests = read_sketches(sketch_path(tmp_path, "practice_rate"))
+    assert sorted(digests) == ["2021-01-01", "2021-02-01"]
+    for date, rows in measure.groupby("date"):
+        rates = np.sort(rows["value"].dropna().to_numpy())
+        assert rows["value"].isna().any()
+        np.testing.assert_allclose(np.sort(digests[date].means), rates)
+        assert digests[date].count == len(rates)
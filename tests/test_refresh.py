@@ -0,0 +1,115 @@
+# A refresh that moves the end date forward month by month must give the
+# same outputs as a refresh of all months at once. The months are extracted
+# with the local backend (local_backend.py) from an event store built from
+# dummy data.
+import filecmp
+import shlex
+import sys
+
+import pandas as pd
+import pytest
+
+from conftest import ANALYSIS_DIR
+from dummy_data import generate
+from event_store import build
+from codelist_index import ROOT_DIR
+from refresh import DEFAULT_EVENTS_COMMAND, DEFAULT_EXTRACT_COMMAND, check_output_dirs, refresh
+from utils import month_starts
+
+START_DATE = "2019-03-01"
+END_DATE = "2019-05-01"
+
+
+def local_command(command, store):
+    # Run a cohortextractor command with the local backend
+    local_backend = shlex.join([sys.executable, str(ANALYSIS_DIR / "local_backend.py")])
+    command = command.replace("cohortextractor", local_backend, 1)
+    return f"{command} --store {shlex.quote(str(store))}"
+
+
+@pytest.fixture(scope="module")
+def data(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("dummy")
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        # Caches (e.g., of the codelists) are written below the working
+        # directory
+        monkeypatch.chdir(directory)
+        generate(directory, 400, seed=1, index_dates=month_starts(START_DATE, END_DATE))
+        build(
+            directory / "store.sqlite",
+            directory / "dummy_patients.feather",
+            [directory / "dummy_events.feather"],
+            directory / "input_registration_spells.feather",
+        )
+    return directory
+
+
+def run_refresh(data, output_dir, end_date):
+    return refresh(
+        manifest_path=output_dir / "manifest.json",
+        start_date=START_DATE,
+        end_date=end_date,
+        cohort_dir=output_dir / "cohorts",
+        ethnicity=data / "input_ethnicity.feather",
+        dataset_dir=output_dir / "joined" / "bp002",
+        measures_dir=output_dir / "measures",
+        long_output=output_dir / "measures" / "long.csv",
+        extract_command=local_command(DEFAULT_EXTRACT_COMMAND, data / "store.sqlite"),
+        workers=1,
+        events_command=local_command(DEFAULT_EVENTS_COMMAND, data / "store.sqlite"),
+        bp_windows_dir=output_dir / "bp_windows",
+        rules_dir=output_dir / "rules",
+    )
+
+
+def test_incremental_refresh_matches_full_refresh(data, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    full = run_refresh(data, tmp_path / "full", END_DATE)
+    assert full.extract == ["2019-03-01", "2019-04-01", "2019-05-01"]
+
+    incremental = tmp_path / "incremental"
+    run_refresh(data, incremental, "2019-03-01")
+    plan = run_refresh(data, incremental, "2019-04-01")
+    assert plan.extract == plan.join == plan.measure == ["2019-04-01"]
+    plan = run_refresh(data, incremental, END_DATE)
+    assert plan.extract == plan.join == plan.measure == ["2019-05-01"]
+    # Nothing to do once all months are up to date
+    plan = run_refresh(data, incremental, END_DATE)
+    assert plan.extract == plan.join == plan.measure == []
+
+    files = sorted(path.name for path in (tmp_path / "full" / "measures").iterdir())
+    assert sorted(path.name for path in (incremental / "measures").iterdir()) == files
+    assert "long.csv" in files
+    assert any(name.startswith("sketch_") for name in files)
+    # The measure files and the sketches are written in date order
+    _, mismatch, errors = filecmp.cmpfiles(
+        tmp_path / "full" / "measures",
+        incremental / "measures",
+        [name for name in files if name != "long.csv"],
+        shallow=False,
+    )
+    assert mismatch == [] and errors == []
+    # Appended months are added to the end of the long file
+    full_long, incremental_long = [
+        pd.read_csv(path / "measures" / "long.csv", dtype=str, keep_default_na=False)
+        .sort_values(["lookback", "date", "group", "category"], kind="stable")
+        .reset_index(drop=True)
+        for path in [tmp_path / "full", incremental]
+    ]
+    pd.testing.assert_frame_equal(full_long, incremental_long)
+    # Every run of months is extracted into a directory of its own
+    assert sorted(path.name for path in (incremental / "cohorts").iterdir()) == [
+        "2019-03-01_2019-03-01",
+        "2019-04-01_2019-04-01",
+        "2019-05-01_2019-05-01",
+    ]
+
+
+def test_refresh_never_writes_declared_outputs(monkeypatch):
+    monkeypatch.chdir(ROOT_DIR)
+    check_output_dirs(["output/refresh", "output/refresh/extracts", "output/refresh/joined"])
+    for directory in ["output", "output/rules", "output/joined", "output/joined/bp002"]:
+        with pytest.raises(ValueError):
+            check_output_dirs([directory])
+    with pytest.raises(ValueError):
+        refresh(cohort_dir="output", dry_run=True)
@@ -0,0 +1,100 @@
+# The registration variables of the interval index are checked against a
+# naive reference that checks every spell of every patient for every index
+# date
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from registration import RegistrationIndex, registration_variables
+from utils import add_months, last_day_of_month, month_starts
+
+INDEX_DATES = month_starts("2019-01-01", "2019-12-01")
+
+
+def naive_variables(spells, index_date):
+    rows = []
+    for patient_id, patient_spells in spells.groupby("patient_id", sort=True):
+        # Spells in the order of the index: by start date, stable
+        patient_spells = patient_spells.sort_values("start_date", kind="stable")
+        as_of = last_day_of_month(index_date)
+        practice, region = 0, ""
+        for spell in patient_spells.itertuples():
+            end = spell.end_date if pd.notna(spell.end_date) else datetime.date.max
+            if spell.start_date <= as_of <= end:
+                practice, region = spell.practice, spell.region
+        covered = any(
+            spell.start_date <= add_months(index_date, -3)
+            and (pd.isna(spell.end_date) or spell.end_date >= index_date)
+            for spell in patient_spells.itertuples()
+        )
+        rows.append(
+            {
+                "patient_id": patient_id,
+                "gms_reg_status": int(practice != 0),
+                "reg_dat_3m": int(covered),
+                "practice": practice,
+                "region": region,
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+@pytest.fixture(scope="module")
+def spells():
+    rng = np.random.default_rng(4)
+    n = 600
+    # Spell boundaries on and around the queried dates
+    boundaries = sorted(
+        {date for month in INDEX_DATES for date in [month, last_day_of_month(month)]}
+        | {add_months(month, -3) for month in INDEX_DATES}
+        | {datetime.date(2018, 6, 15), datetime.date(2019, 5, 17), datetime.date(2020, 3, 1)}
+    )
+    start = rng.choice(len(boundaries), n)
+    length = rng.integers(0, 10, n)
+    end = [
+        boundaries[min(s + l, len(boundaries) - 1)] if rng.random() < 0.7 else None
+        for s, l in zip(start, length)
+    ]
+    return pd.DataFrame(
+        {
+            "patient_id": rng.integers(1, 150, n),
+            "start_date": [boundaries[s] for s in start],
+            "end_date": end,
+            "practice": rng.integers(1, 20, n),
+            "region": rng.choice(["East", "London", "North"], n),
+        }
+    )
+
+
+@pytest.fixture(scope="module")
+def expected(spells):
+    return {index_date: naive_variables(spells, index_date) for index_date in INDEX_DATES}
+
+
+@pytest.mark.parametrize("block_size", [1, 5, 12])
+def test_registration_variables_match_naive_reference(spells, expected, block_size):
+    results = dict(registration_variables(spells, INDEX_DATES, block_size=block_size))
+    assert list(results) == INDEX_DATES
+    for index_date, df in results.items():
+        result = df.astype({"practice": np.int64, "region": object})
+        reference = expected[index_date].astype({"practice": np.int64, "region": object})
+        pd.testing.assert_frame_equal(result, reference, check_dtype=False)
+
+
+def test_containing_boundaries():
+    spells = pd.DataFrame(
+        {
+            "patient_id": [1, 2, 3, 4],
+            "start_date": ["2019-01-31", "2019-02-01", "2018-01-01", "2019-01-01"],
+            "end_date": ["2019-01-31", None, "2019-01-30", None],
+            "practice": [1, 2, 3, 4],
+            "region": ["East", "East", "East", "East"],
+        }
+    )
+    index = RegistrationIndex(spells)
+    spell = index.containing(["2019-01-31"])[:, 0]
+    # A spell of one day on the date counts, one starting the day after or
+    # ending the day before does not, an open spell does
+    assert (spell >= 0).tolist() == [True, False, False, True]
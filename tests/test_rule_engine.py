@@ -0,0 +1,191 @@
+# The compiled rules are checked against a naive reference: every
+# expression is translated to Python and evaluated row by row. Python has
+# the same precedence as the rule expressions (OR, AND, NOT, comparisons,
+# + and -, * and /), and integer division of non-negative values truncates
+# in both.
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from rule_engine import (
+    ExpressionError,
+    bp002_engine_rules,
+    compile_rules,
+    engine_plan,
+    evaluate_rules,
+    parse,
+)
+
+EXPRESSIONS = [
+    "a AND b OR c",
+    "a OR b AND c",
+    "NOT a AND b",
+    "NOT a OR NOT b AND c",
+    "NOT a = 1 OR b",
+    "NOT NOT a",
+    "a OR (b AND NOT c)",
+    "(a OR b) AND c",
+    "a + b * c > 10",
+    "(a + b) * c > 10",
+    "a - b - c < 0",
+    "a * 32844 / 5 >= 6568",
+    "a / 2 * 2 = a",
+    "-a + b > 0",
+    "a != b AND b <= c OR a >= 3",
+    "b * 1 / 5 + 2 < a",
+    "a",
+]
+
+
+def python_expression(expression):
+    replacements = {"AND": " and ", "OR": " or ", "NOT": " not ", "=": "==", "/": "//"}
+    pattern = re.compile(r"\b(?:AND|OR|NOT)\b|(?<![<>!=])=(?!=)|/")
+    return pattern.sub(lambda match: replacements[match.group(0)], expression).strip()
+
+
+def naive_evaluate(df, expression):
+    code = compile(python_expression(expression), "<rule>", "eval")
+    return np.array(
+        [int(bool(eval(code, {}, row))) for row in df.to_dict(orient="records")],
+        dtype=np.int64,
+    )
+
+
+@pytest.fixture
+def df():
+    rng = np.random.default_rng(1)
+    return pd.DataFrame({name: rng.integers(0, 4, 500) for name in ["a", "b", "c"]})
+
+
+@pytest.mark.parametrize("expression", EXPRESSIONS)
+def test_expressions_match_naive_evaluation(df, expression):
+    result = evaluate_rules(df, {"x": expression})
+    np.testing.assert_array_equal(result["x"].to_numpy(), naive_evaluate(df, expression))
+
+
+def test_precedence():
+    assert parse("a OR b AND NOT c") == (
+        "or", ("name", "a"), ("and", ("name", "b"), ("not", ("name", "c")))
+    )
+    assert parse("a + b * c = 1") == (
+        "compare",
+        "=",
+        ("arithmetic", "+", ("name", "a"), ("arithmetic", "*", ("name", "b"), ("name", "c"))),
+        ("const", 1),
+    )
+
+
+def test_constants_are_folded(df):
+    plan = compile_rules({"x": "a * 1000 > 32844 * 1 / 5"})
+    kinds = [kind for kind, _, _ in plan.nodes]
+    # a * 1000 is not constant, 32844 * 1 / 5 truncates to 6568
+    assert kinds.count("arithmetic") == 1
+    assert ("const", 6568, ()) in plan.nodes
+    np.testing.assert_array_equal(
+        plan.run(df)["x"].to_numpy(), naive_evaluate(df, "a * 1000 > 32844 * 1 / 5")
+    )
+
+
+def test_references_are_expanded_and_shared(df):
+    rules = {
+        "r1": "a > 1 AND b",
+        "r2": "r1 OR c = 2",
+        "r3": "NOT r1 AND a > 1",
+    }
+    plan = compile_rules(rules)
+    # a > 1 (and r1) are evaluated once
+    assert [node[:2] for node in plan.nodes].count(("compare", ">")) == 1
+    result = plan.run(df)
+    expanded = {
+        "r1": "a > 1 AND b",
+        "r2": "(a > 1 AND b) OR c = 2",
+        "r3": "NOT (a > 1 AND b) AND a > 1",
+    }
+    for name, expression in expanded.items():
+        np.testing.assert_array_equal(result[name].to_numpy(), naive_evaluate(df, expression))
+
+
+def test_categorised(df):
+    result = evaluate_rules(
+        df, {"group": {"low": "a < 1", "high": "a > 2 OR b = 3", "other": "DEFAULT"}}
+    )
+    expected = [
+        "low" if row["a"] < 1 else "high" if row["a"] > 2 or row["b"] == 3 else "other"
+        for row in df.to_dict(orient="records")
+    ]
+    assert result["group"].tolist() == expected
+
+
+def test_missing_values_are_false():
+    df = pd.DataFrame({"a": [np.nan, 0.0, 1.0, 2.0], "b": [1.0, np.nan, 1.0, 1.0]})
+    result = evaluate_rules(df, {"x": "a", "y": "a >= b", "z": "a + 1 > 1"})
+    assert result["x"].tolist() == [0, 0, 1, 1]
+    assert result["y"].tolist() == [0, 0, 1, 1]
+    assert result["z"].tolist() == [0, 0, 1, 1]
+
+
+@pytest.mark.parametrize("expression", ["", "a AND", "(a OR b", "a b", "a ? b"])
+def test_invalid_expressions(expression):
+    with pytest.raises(ExpressionError):
+        compile_rules({"x": expression})
+
+
+def test_circular_reference():
+    with pytest.raises(ExpressionError):
+        compile_rules({"x": "y AND a", "y": "x OR b"})
+
+
+def test_commutative_subterms_are_shared():
+    plan = compile_rules({"x": "a > 1 AND b", "y": "b AND a > 1", "z": "NOT (c OR a > 1)"})
+    assert plan.outputs["x"] == plan.outputs["y"]
+    # a, 1, a > 1, b, bool(b), AND, c, bool(c), OR, NOT
+    assert len(plan.nodes) == 10
+
+
+def test_plan_stats():
+    plan = compile_rules({"r1": "a > 1 AND b", "r2": "r1 OR c = 2"})
+    # r1: a, 1, a > 1, b, bool(b), AND (6 terms)
+    # r2: the 6 terms of r1, c, 2, c = 2, OR (10 terms)
+    assert plan.stats() == {
+        "variables": 2,
+        "expanded_terms": 16,
+        "unique_nodes": 10,
+        "shared_nodes": 1,
+        "evaluations_saved": 6,
+    }
+    assert plan.describe().splitlines()[0] == (
+        "2 variables, 16 expression terms compiled to 10 unique nodes "
+        "(6 evaluations saved, 1 nodes shared)"
+    )
+
+
+def test_bp002_plan_matches_variables_evaluated_one_by_one():
+    # Every variable is compiled into a plan of its own, with the variables
+    # it refers to evaluated before as input columns (nothing is shared)
+    rules = bp002_engine_rules()
+    plan = engine_plan()
+    assert len(set(plan.nodes)) == len(plan.nodes)
+    stats = plan.stats()
+    assert stats["variables"] == len(rules)
+    assert stats["unique_nodes"] < stats["expanded_terms"]
+    assert stats["evaluations_saved"] == stats["expanded_terms"] - stats["unique_nodes"]
+
+    rng = np.random.default_rng(4)
+    columns = [value for kind, value, _ in plan.nodes if kind == "column"]
+    df = pd.DataFrame(
+        {name: rng.integers(0, 100 if name == "age" else 3, 2000) for name in columns}
+    )
+    separate = df.copy()
+    pending = dict(rules)
+    while pending:
+        for name, expression in list(pending.items()):
+            references = set(re.findall(r"\w+", expression)) & set(pending)
+            if references - {name}:
+                continue
+            separate[name] = evaluate_rules(separate, {name: expression})[name]
+            del pending[name]
+    result = plan.run(df)
+    for name in rules:
+        np.testing.assert_array_equal(result[name].to_numpy(), separate[name].to_numpy(), name)
@@ -0,0 +1,158 @@
+# Runs of a small project are checked against the DAG of its needs: every
+# action starts after the actions it needs have finished, up to date
+# actions are skipped and changes rerun the changed action and the actions
+# that need it
+import json
+import os
+import textwrap
+
+import pytest
+
+from run_project import load_actions, run_project, select
+
+STEP = """
+import json, pathlib, sys, time
+name = sys.argv[1]
+start = time.time()
+time.sleep(0.2)
+pathlib.Path("output").mkdir(exist_ok=True)
+pathlib.Path(f"output/{name}.json").write_text(json.dumps([start, time.time()]))
+"""
+
+PROJECT = """
+version: '3.0'
+actions:
+  a:
+    run: python:latest step.py a
+    outputs: {moderately_sensitive: {out: output/a.json}}
+  b:
+    run: python:latest step.py b
+    outputs: {moderately_sensitive: {out: output/b.json}}
+  c:
+    run: python:latest step.py c
+    needs: [a, b]
+    outputs: {moderately_sensitive: {out: output/c.json}}
+  d:
+    run: python:latest other_step.py d
+    needs: [c]
+    outputs: {moderately_sensitive: {out: output/d.json}}
+  fail:
+    run: python:latest fail.py
+    needs: [a]
+    outputs: {moderately_sensitive: {out: output/fail.json}}
+  blocked:
+    run: python:latest step.py blocked
+    needs: [fail]
+    outputs: {moderately_sensitive: {out: output/blocked.json}}
+"""
+
+
+@pytest.fixture
+def project(tmp_path):
+    (tmp_path / "project.yaml").write_text(textwrap.dedent(PROJECT))
+    (tmp_path / "step.py").write_text(STEP)
+    (tmp_path / "other_step.py").write_text(STEP)
+    (tmp_path / "fail.py").write_text("raise SystemExit(1)\n")
+    return tmp_path / "project.yaml"
+
+
+def times(project, name):
+    return json.loads((project.parent / "output" / f"{name}.json").read_text())
+
+
+def test_select(project):
+    actions = load_actions(project)
+    assert select(actions) == ["a", "b", "c", "d", "fail", "blocked"]
+    assert select(actions, ["d"]) == ["a", "b", "c", "d"]
+    with pytest.raises(ValueError):
+        select(actions, ["unknown"])
+
+
+def test_runs_follow_needs(project):
+    actions = load_actions(project)
+    status = run_project(project, workers=2)
+    assert status == {
+        "a": "ran", "b": "ran", "c": "ran", "d": "ran", "fail": "failed", "blocked": "blocked"
+    }
+    for name in ["a", "b", "c", "d"]:
+        start, _ = times(project, name)
+        for need in actions[name].needs:
+            assert times(project, need)[1] <= start
+    # a and b need nothing and run concurrently
+    assert times(project, "b")[0] < times(project, "a")[1]
+    assert (project.parent / "metadata" / "a.log").exists()
+
+    # Up to date
+    status = run_project(project, ["d"], workers=2)
+    assert status == dict.fromkeys("abcd", "skipped")
+    assert run_project(project, ["d"], dry_run=True) == dict.fromkeys("abcd", "skip")
+
+    # A changed script reruns its actions and the actions that need them
+    (project.parent / "other_step.py").write_text(STEP + "\n")
+    assert run_project(project, ["d"], dry_run=True) == {
+        "a": "skip", "b": "skip", "c": "skip", "d": "run"
+    }
+    (project.parent / "step.py").write_text(STEP + "\n")
+    assert run_project(project, ["d"], workers=2) == dict.fromkeys("abcd", "ran")
+
+    # A changed output of a needed action reruns the actions that need it
+    os.utime(project.parent / "output" / "c.json", ns=(0, 0))
+    assert run_project(project, ["d"], dry_run=True) == {
+        "a": "skip", "b": "skip", "c": "run", "d": "run"
+    }
+    assert run_project(project, ["b"], force=True, dry_run=True) == {"b": "run"}
+
+
+def test_needs_listed_later(tmp_path):
+    # Actions listed before the actions they need are blocked when a need
+    # fails to start and skipped when their needs are skipped
+    (tmp_path / "project.yaml").write_text(
+        textwrap.dedent(
+            """
+            version: '3.0'
+            actions:
+              blocked:
+                run: python:latest step.py blocked
+                needs: [unknown_image]
+                outputs: {moderately_sensitive: {out: output/blocked.json}}
+              unknown_image:
+                run: foo:latest step.py unknown_image
+                outputs: {moderately_sensitive: {out: output/unknown_image.json}}
+              c:
+                run: python:latest step.py c
+                needs: [b]
+                outputs: {moderately_sensitive: {out: output/c.json}}
+              b:
+                run: python:latest step.py b
+                outputs: {moderately_sensitive: {out: output/b.json}}
+            """
+        )
+    )
+    (tmp_path / "step.py").write_text(STEP)
+    project = tmp_path / "project.yaml"
+    assert run_project(project) == {
+        "blocked": "blocked", "unknown_image": "failed", "b": "ran", "c": "ran"
+    }
+    assert run_project(project, ["c"]) == {"b": "skipped", "c": "skipped"}
+
+
+def test_circular_needs(tmp_path):
+    (tmp_path / "project.yaml").write_text(
+        textwrap.dedent(
+            """
+            version: '3.0'
+            actions:
+              a:
+                run: python:latest step.py a
+                needs: [b]
+                outputs: {moderately_sensitive: {out: output/a.json}}
+              b:
+                run: python:latest step.py b
+                needs: [a]
+                outputs: {moderately_sensitive: {out: output/b.json}}
+            """
+        )
+    )
+    (tmp_path / "step.py").write_text(STEP)
+    with pytest.raises(ValueError, match="Circular needs"):
+        run_project(tmp_path / "project.yaml")
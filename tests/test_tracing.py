@@ -0,0 +1,57 @@
+# Trace summaries and folded stacks are checked against totals of the
+# recorded spans added up by hand
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from tracing import Trace, cardinality
+
+
+@pytest.mark.parametrize(
+    "values, expected",
+    [
+        (np.array([0, 1, 2, 0, 2]), (3, 3)),
+        (np.array([np.nan, 0.5, 0.0]), (1, 2)),
+        (np.array(["a", None, "", "b", "a"], dtype=object), (3, 3)),
+        (pd.Categorical(["x", None, "y", "x"]), (3, 2)),
+    ],
+)
+def test_cardinality(values, expected):
+    assert cardinality(values) == expected
+
+
+def test_summary_and_folded(tmp_path):
+    trace = Trace("rules")
+    spans = [
+        (["2021-01-01", "a"], 0.5, 10),
+        (["2021-02-01", "a"], 0.25, 10),
+        (["2021-01-01", "b"], 1.0, 20),
+    ]
+    for path, seconds, rows in spans:
+        trace.add(path, seconds, rows=rows, values=[0, 1, 1])
+    with trace.span("2021-02-01", "c", rows=5) as span:
+        span.output(np.array([1, 2, 3]))
+    other = Trace("worker")
+    other.add(["2021-02-01", "b"], 0.75, rows=20)
+    trace.extend(other.spans)
+
+    summary = trace.summary().set_index("variable")
+    assert summary.index[:2].tolist() == ["b", "a"]
+    assert summary.loc["b", "seconds"] == 1.75
+    assert summary.loc["a", "seconds"] == 0.75
+    assert summary.loc["a", "rows"] == 20 and summary.loc["a", "spans"] == 2
+    assert summary["share"].sum() == pytest.approx(1)
+
+    folded = dict(line.rsplit(" ", 1) for line in trace.folded())
+    assert folded["rules;2021-01-01;a"] == "500000"
+    assert folded["rules;2021-02-01;b"] == "750000"
+
+    trace_path, folded_path, flame_path = trace.write(tmp_path)
+    spans = json.loads(trace_path.read_text())["spans"]
+    assert len(spans) == 5
+    assert spans[3]["path"] == ["2021-02-01", "c"]
+    assert (spans[3]["nonzero"], spans[3]["distinct"]) == (3, 3)
+    assert folded_path.read_text().splitlines() == trace.folded()
+    assert flame_path.read_text().startswith("rules: ")